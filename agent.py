@@ -1,57 +1,190 @@
-# ====================================================================
-# FILE: agent.py - Logic Xử lý AI (RAG) (ĐÃ SỬA LỖI PROMPT)
-# ====================================================================
-import os
-from langchain.chains import RetrievalQA
-from langchain_openai import ChatOpenAI
-from langchain_community.vectorstores import Chroma 
-# >>> IMPORT CẦN THIẾT <<<
-from langchain.prompts import PromptTemplate, ChatPromptTemplate 
-# >>>>>>>>>>>>>>>>>>>>>>>>
-
-# Khởi tạo mô hình ngôn ngữ lớn (LLM) chỉ một lần
-llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
-
-# TẠO PROMPT TEMPLATE TÙY CHỈNH (GLOBAL)
-RAG_PROMPT_TEMPLATE = """
-Bạn là trợ lý AI thân thiện và chuyên nghiệp cho Page Yêu Công Nghệ - bacninhtech.
-Nhiệm vụ của bạn là **TÓM TẮT** và **CHỈ TRẢ LỜI** dựa trên ngữ cảnh được cung cấp dưới đây, tuyệt đối không bịa ra thông tin.
-Nếu thông tin trong ngữ cảnh không đủ để trả lời, hãy nói một cách lịch sự rằng bạn sẽ kiểm tra lại hoặc đề nghị khách hàng liên hệ trực tiếp.
-
-NGỮ CẢNH:
-{context}
-
-CÂU HỎI:
-{question}
-"""
-
-def get_answer(query: str, vectorstore: Chroma) -> str:
-    """
-    Sử dụng RetrievalQA Chain với Prompt Tùy chỉnh để trả lời câu hỏi.
-    """
-    
-    # 1. Tạo đối tượng truy vấn (Retriever)
-    retriever = vectorstore.as_retriever(search_kwargs={"k": 5}) # Thử tăng k lên 5 để lấy nhiều ngữ cảnh hơn
-
-    # 2. Định nghĩa Prompt Tùy chỉnh
-    custom_prompt = PromptTemplate(
-        template=RAG_PROMPT_TEMPLATE,
-        input_variables=["context", "question"],
-    )
-
-    # 3. Tạo RetrievalQA Chain với custom_prompt
-    qa_chain = RetrievalQA.from_chain_type(
-        llm=llm,
-        chain_type="stuff",
-        retriever=retriever,
-        return_source_documents=False,
-        # >>> THÊM THAM SỐ CẤU HÌNH PROMPT TẠI ĐÂY <<<
-        chain_type_kwargs={"prompt": custom_prompt}
-        # >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
-    )
-    
-    # 4. Thực thi truy vấn
-    result = qa_chain.invoke({"query": query})
-
-    # 5. Trả về kết quả
-    return result['result']
\ No newline at end of file
+# ====================================================================
+# FILE: agent.py - Logic Xử lý AI (RAG) (ĐÃ SỬA LỖI PROMPT)
+# ====================================================================
+import os
+import time
+import asyncio
+import threading
+from langchain.chains import RetrievalQA
+from langchain_openai import ChatOpenAI
+from langchain_community.callbacks import get_openai_callback
+from langchain_community.vectorstores import Chroma 
+# >>> IMPORT CẦN THIẾT <<<
+from langchain.prompts import PromptTemplate, ChatPromptTemplate 
+# >>>>>>>>>>>>>>>>>>>>>>>>
+
+from answer_cache import ANSWER_CACHE, filter_scope
+from context_builder import build_context
+from lexical_index import BM25Index
+from listing_metadata import ListingFilterParser
+from retrieval import HybridRetriever
+from metrics import METRICS_ENABLED, stage, timed, record_context, record_openai_usage
+
+# Số chunk truy xuất; context_builder ghép/loại trùng rồi cắt theo CONTEXT_TOKEN_BUDGET
+# nên tăng k làm tăng recall mà không làm prompt dài thêm
+RAG_RETRIEVAL_K = int(os.getenv("RAG_RETRIEVAL_K", "10"))
+
+# Khởi tạo mô hình ngôn ngữ lớn (LLM) chỉ một lần
+llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+
+# TẠO PROMPT TEMPLATE TÙY CHỈNH (GLOBAL)
+RAG_PROMPT_TEMPLATE = """
+Bạn là trợ lý AI thân thiện và chuyên nghiệp cho Page Yêu Công Nghệ - bacninhtech.
+Nhiệm vụ của bạn là **TÓM TẮT** và **CHỈ TRẢ LỜI** dựa trên ngữ cảnh được cung cấp dưới đây, tuyệt đối không bịa ra thông tin.
+Nếu thông tin trong ngữ cảnh không đủ để trả lời, hãy nói một cách lịch sự rằng bạn sẽ kiểm tra lại hoặc đề nghị khách hàng liên hệ trực tiếp.
+
+NGỮ CẢNH:
+{context}
+
+CÂU HỎI:
+{question}
+"""
+
+class RagAnswerer:
+    """
+    Chain RAG được dựng MỘT LẦN và gắn với một vectorstore cụ thể.
+    Đối tượng không giữ trạng thái theo từng lời gọi nên có thể dùng chung
+    giữa nhiều background task (thread hoặc event loop) cùng lúc.
+    """
+
+    def __init__(self, vectorstore: Chroma, lexical: BM25Index = None, k: int = RAG_RETRIEVAL_K):
+        self.vectorstore = vectorstore
+        self.lexical = lexical
+        # Vectorstore mới (rebuild) -> cache câu trả lời cũ không còn hợp lệ
+        ANSWER_CACHE.bind(vectorstore)
+
+        # 1. Tạo đối tượng truy vấn (Retriever)
+        # Embedding câu hỏi dùng chung cache với bước ingest (xem embedding_cache.py)
+        # BM25 + vector trộn bằng RRF; từ khoá khớp rõ ràng thì không cần embedding.
+        # Phường/huyện, loại nhà, giá, diện tích trong câu hỏi -> lọc metadata trước khi tìm.
+        metadatas = lexical.metadatas() if lexical is not None else vectorstore.get(include=["metadatas"])["metadatas"]
+        self.filter_parser = ListingFilterParser(metadatas)
+        self.retriever = HybridRetriever(
+            vectorstore=vectorstore, lexical=lexical, filter_parser=self.filter_parser, k=k,
+        )
+
+        # 2. Định nghĩa Prompt Tùy chỉnh
+        custom_prompt = PromptTemplate(
+            template=RAG_PROMPT_TEMPLATE,
+            input_variables=["context", "question"],
+        )
+
+        # 3. Tạo RetrievalQA Chain với custom_prompt
+        self.qa_chain = RetrievalQA.from_chain_type(
+            llm=llm,
+            chain_type="stuff",
+            retriever=self.retriever,
+            return_source_documents=False,
+            chain_type_kwargs={"prompt": custom_prompt}
+        )
+
+    def _embed_query(self, query: str):
+        try:
+            # Đi qua embedding cache nên bước retrieval phía sau không phải gọi API lại
+            return self.vectorstore.embeddings.embed_query(query)
+        except Exception:
+            return None
+
+    # Tách retrieval và gọi LLM của RetrievalQA thành 2 bước để đo riêng từng bước
+    def _generate(self, query: str, docs: list) -> str:
+        inputs = {"input_documents": docs, "question": query}
+        if not METRICS_ENABLED:
+            return self.qa_chain.combine_documents_chain.invoke(inputs)["output_text"]
+        with stage("llm"), get_openai_callback() as usage:
+            result = self.qa_chain.combine_documents_chain.invoke(inputs)
+        record_openai_usage(usage.prompt_tokens, usage.completion_tokens)
+        return result["output_text"]
+
+    async def _agenerate(self, query: str, docs: list) -> str:
+        inputs = {"input_documents": docs, "question": query}
+        if not METRICS_ENABLED:
+            return (await self.qa_chain.combine_documents_chain.ainvoke(inputs))["output_text"]
+        with stage("llm"), get_openai_callback() as usage:
+            result = await self.qa_chain.combine_documents_chain.ainvoke(inputs)
+        record_openai_usage(usage.prompt_tokens, usage.completion_tokens)
+        return result["output_text"]
+
+    def _fast_path(self, query: str):
+        """Ngữ cảnh lấy thuần từ BM25 nếu đủ chắc chắn (không embedding), ngược lại None."""
+        with stage("retrieval_lexical"):
+            return self.retriever.fast_path(query)
+
+    def _run(self, query: str, docs: list = None) -> str:
+        if docs is None:
+            with stage("retrieval"):
+                docs = self.retriever.invoke(query)
+        with stage("context_build"):
+            docs = build_context(docs)
+        record_context(docs)
+        return self._generate(query, docs)
+
+    async def _arun(self, query: str, docs: list = None) -> str:
+        if docs is None:
+            with stage("retrieval"):
+                docs = await self.retriever.ainvoke(query)
+        with stage("context_build"):
+            docs = build_context(docs)
+        record_context(docs)
+        return await self._agenerate(query, docs)
+
+    def answer(self, query: str) -> str:
+        """Trả lời đồng bộ (dùng trong thread), có cache câu trả lời phía trước."""
+        # Câu hỏi khác phường/giá... không dùng chung câu trả lời dù câu chữ gần giống
+        scope = filter_scope(self.filter_parser.parse(query))
+        cached = ANSWER_CACHE.lookup_exact(query, scope)
+        if cached is not None:
+            return cached
+        docs, vector = self._fast_path(query), None
+        # Fast path BM25 đã có ngữ cảnh -> không embedding câu hỏi chỉ để tra cache
+        if docs is None and ANSWER_CACHE.enabled:
+            vector = self._embed_query(query)
+            cached = ANSWER_CACHE.lookup_similar(vector, scope) if vector else None
+            if cached is not None:
+                return cached
+        ANSWER_CACHE.record_miss()
+
+        started = time.perf_counter()
+        result = self._run(query, docs)
+        ANSWER_CACHE.store(query, result, time.perf_counter() - started, vector, scope)
+        return result
+
+    @timed("rag_answer")
+    async def aanswer(self, query: str) -> str:
+        """Trả lời bất đồng bộ trên event loop, không chiếm thread trong lúc chờ LLM."""
+        scope = filter_scope(self.filter_parser.parse(query))
+        cached = ANSWER_CACHE.lookup_exact(query, scope)
+        if cached is not None:
+            return cached
+        docs, vector = self._fast_path(query), None
+        if docs is None and ANSWER_CACHE.enabled:
+            vector = await asyncio.to_thread(self._embed_query, query)
+            # Dựng lại ma trận vector sau mỗi lần store tốn vài ms -> không chạy trên event loop
+            cached = await asyncio.to_thread(ANSWER_CACHE.lookup_similar, vector, scope) if vector else None
+            if cached is not None:
+                return cached
+        ANSWER_CACHE.record_miss()
+
+        started = time.perf_counter()
+        result = await self._arun(query, docs)
+        ANSWER_CACHE.store(query, result, time.perf_counter() - started, vector, scope)
+        return result
+
+
+_ANSWERER = None
+_ANSWERER_LOCK = threading.Lock()
+
+def get_answerer(vectorstore: Chroma, lexical: BM25Index = None) -> RagAnswerer:
+    """Trả về answerer dùng chung; chỉ dựng lại khi vectorstore/chỉ mục BM25 đổi (ví dụ sau khi rebuild)."""
+    global _ANSWERER
+    with _ANSWERER_LOCK:
+        if _ANSWERER is None or _ANSWERER.vectorstore is not vectorstore or _ANSWERER.lexical is not lexical:
+            _ANSWERER = RagAnswerer(vectorstore, lexical)
+        return _ANSWERER
+
+@timed("rag_answer")
+def get_answer(query: str, vectorstore: Chroma, lexical: BM25Index = None) -> str:
+    """
+    Sử dụng RetrievalQA Chain với Prompt Tùy chỉnh để trả lời câu hỏi.
+    Chain được dựng sẵn một lần (xem RagAnswerer) thay vì tạo lại mỗi bình luận.
+    """
+    return get_answerer(vectorstore, lexical).answer(query)
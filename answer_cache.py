@@ -0,0 +1,178 @@
+# ====================================================================
+# FILE: answer_cache.py - Cache câu trả lời cho câu hỏi lặp lại của khách
+# ====================================================================
+import os
+import re
+import json
+import time
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# ==== Cấu hình ====
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))          # giây
+ANSWER_CACHE_MAX_SIZE = int(os.getenv("ANSWER_CACHE_MAX_SIZE", "1000"))
+# Ngưỡng cosine để coi hai câu hỏi là "gần giống nhau"
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+
+
+def normalize_question(text: str) -> str:
+    """Bỏ dấu tiếng Việt, chữ thường, bỏ dấu câu và khoảng trắng thừa."""
+    text = text.replace("đ", "d").replace("Đ", "D")
+    text = unicodedata.normalize("NFD", text)
+    text = "".join(ch for ch in text if unicodedata.category(ch) != "Mn")
+    text = re.sub(r"[^\w\s]", " ", text.lower())
+    return " ".join(text.split())
+
+
+def filter_scope(conditions: dict) -> str:
+    """Dạng chuẩn của bộ lọc tin đăng (listing_metadata) trong câu hỏi; "" nếu không lọc."""
+    return json.dumps(conditions, sort_keys=True) if conditions else ""
+
+
+def _cache_key(question: str, scope: str) -> str:
+    key = normalize_question(question)
+    return f"{key}|{scope}" if scope else key
+
+
+def _unit(vector: list) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = float(np.linalg.norm(vector)) or 1.0
+    return vector / norm
+
+
+class AnswerCache:
+    """
+    Cache LRU + TTL cho câu trả lời RAG.
+    - Trùng khớp chính xác theo câu hỏi đã chuẩn hoá (normalize_question).
+    - Gần trùng theo độ tương đồng cosine của embedding câu hỏi.
+    Cả hai chỉ khớp khi bộ lọc tin đăng (phường, giá...) giống nhau: "nhà phường A giá 2 tỷ"
+    và "nhà phường B giá 2 tỷ" gần như trùng embedding nhưng không được dùng chung câu trả lời.
+    Mọi lần tra không trúng được đếm bằng record_miss() để hit_rate không bị thổi phồng.
+    Cache gắn với một vectorstore; khi vectorstore đổi (rebuild) cache tự xoá.
+    """
+
+    def __init__(self, max_size: int = ANSWER_CACHE_MAX_SIZE, ttl: float = ANSWER_CACHE_TTL,
+                 similarity: float = ANSWER_CACHE_SIMILARITY, enabled: bool = ANSWER_CACHE_ENABLED):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity = similarity
+        self.enabled = enabled
+        self._entries = OrderedDict()  # key -> {"answer", "created", "latency", "vector", "scope"}
+        self._lock = threading.Lock()
+        self._bound_to = None
+        # (keys, ma trận float32 các vector đã chuẩn hoá): dựng lại khi entry thay đổi
+        self._matrix = None
+        self._stats = {"hits_exact": 0, "hits_semantic": 0, "misses": 0,
+                       "latency_saved_seconds": 0.0, "invalidations": 0}
+
+    def bind(self, vectorstore):
+        """Gắn cache với vectorstore hiện tại; đổi vectorstore -> xoá toàn bộ entry."""
+        with self._lock:
+            if self._bound_to is not vectorstore:
+                if self._entries:
+                    logger.info(f"🧹 Xoá {len(self._entries)} câu trả lời cache do VECTORSTORE đã được dựng lại.")
+                    self._stats["invalidations"] += 1
+                self._entries.clear()
+                self._matrix = None
+                self._bound_to = vectorstore
+
+    def _is_fresh(self, entry: dict, now: float) -> bool:
+        return now - entry["created"] <= self.ttl
+
+    def _hit(self, key: str, entry: dict, kind: str) -> str:
+        self._entries.move_to_end(key)
+        self._stats[kind] += 1
+        self._stats["latency_saved_seconds"] += entry["latency"]
+        return entry["answer"]
+
+    def lookup_exact(self, question: str, scope: str = ""):
+        """Trả về câu trả lời nếu câu hỏi (đã chuẩn hoá, cùng bộ lọc) có sẵn, ngược lại None."""
+        if not self.enabled:
+            return None
+        key = _cache_key(question, scope)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if not self._is_fresh(entry, now):
+                del self._entries[key]
+                self._matrix = None
+                return None
+            return self._hit(key, entry, "hits_exact")
+
+    def _vector_matrix(self):
+        if self._matrix is None:
+            keys = [key for key, entry in self._entries.items() if entry["vector"] is not None]
+            matrix = np.stack([self._entries[key]["vector"] for key in keys]) if keys else None
+            self._matrix = (keys, matrix)
+        return self._matrix
+
+    def lookup_similar(self, vector: list, scope: str = ""):
+        """Tìm câu hỏi gần giống nhất cùng bộ lọc (cosine >= ngưỡng, một phép nhân ma trận)."""
+        if not self.enabled:
+            return None
+        query = _unit(vector)
+        now = time.time()
+        with self._lock:
+            keys, matrix = self._vector_matrix()
+            if matrix is not None and matrix.shape[1] == query.shape[0]:
+                scores = matrix @ query
+                for index in np.argsort(-scores):
+                    if scores[index] < self.similarity:
+                        break
+                    key = keys[index]
+                    entry = self._entries.get(key)
+                    if entry is None or entry["scope"] != scope:
+                        continue
+                    if not self._is_fresh(entry, now):
+                        del self._entries[key]
+                        self._matrix = None
+                        continue
+                    return self._hit(key, entry, "hits_semantic")
+            return None
+
+    def record_miss(self):
+        """Gọi khi câu hỏi phải chạy RAG (không trúng cache, kể cả khi bỏ qua bước tra gần trùng)."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._stats["misses"] += 1
+
+    def store(self, question: str, answer: str, latency: float, vector: list = None, scope: str = ""):
+        if not self.enabled:
+            return
+        key = _cache_key(question, scope)
+        with self._lock:
+            self._entries[key] = {
+                "answer": answer,
+                "created": time.time(),
+                "latency": latency,
+                "vector": _unit(vector) if vector else None,
+                "scope": scope,
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self._stats["hits_exact"] + self._stats["hits_semantic"]
+            total = hits + self._stats["misses"]
+            return {
+                **self._stats,
+                "size": len(self._entries),
+                "hit_rate": round(hits / total, 4) if total else 0.0,
+            }
+
+
+# Cache dùng chung cho toàn bộ ứng dụng
+ANSWER_CACHE = AnswerCache()
@@ -0,0 +1,83 @@
+# ====================================================================
+# FILE: async_cache.py - Cache TTL bất đồng bộ với stale-while-revalidate
+# ====================================================================
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncTTLCache:
+    """
+    Cache trong bộ nhớ cho các lời gọi bất đồng bộ:
+    - Còn hạn (tuổi <= ttl): trả ngay.
+    - Hết hạn nhưng còn trong cửa sổ stale (<= ttl + stale_ttl): trả bản cũ ngay
+      và làm mới ở nền.
+    - Quá cũ hoặc chưa có: chờ lấy mới. Nhiều request trùng key cùng lúc
+      chỉ tạo MỘT lời gọi thật (single-flight).
+    """
+
+    def __init__(self, ttl: float, stale_ttl: float = 0):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._entries = {}   # key -> (value, fetched_at)
+        self._inflight = {}  # key -> asyncio.Task
+        self._stats = {"hits": 0, "stale_hits": 0, "misses": 0, "merged": 0, "refreshes": 0}
+
+    def _start_fetch(self, key, fetcher, is_cacheable):
+        task = self._inflight.get(key)
+        if task is not None:
+            self._stats["merged"] += 1
+            return task
+
+        async def run():
+            try:
+                value = await fetcher()
+                if is_cacheable is None or is_cacheable(value):
+                    self._entries[key] = (value, time.time())
+                return value
+            finally:
+                self._inflight.pop(key, None)
+
+        task = asyncio.create_task(run())
+        task.add_done_callback(self._log_failure)
+        self._inflight[key] = task
+        return task
+
+    @staticmethod
+    def _log_failure(task):
+        # Lỗi của lần làm mới ở nền không có ai chờ -> ghi log thay vì để asyncio cảnh báo
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"❌ Lỗi làm mới cache: {task.exception()}")
+
+    async def get(self, key, fetcher, ttl: float = None, stale_ttl: float = None, is_cacheable=None):
+        """
+        Trả về (value, age_seconds). `fetcher` là hàm không tham số trả về coroutine.
+        `is_cacheable(value)` quyết định có lưu kết quả hay không (ví dụ bỏ qua lỗi).
+        """
+        ttl = self.ttl if ttl is None else ttl
+        stale_ttl = self.stale_ttl if stale_ttl is None else stale_ttl
+        now = time.time()
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, fetched_at = entry
+            age = now - fetched_at
+            if age <= ttl:
+                self._stats["hits"] += 1
+                return value, age
+            if age <= ttl + stale_ttl:
+                self._stats["stale_hits"] += 1
+                if key not in self._inflight:
+                    self._stats["refreshes"] += 1
+                    self._start_fetch(key, fetcher, is_cacheable)
+                return value, age
+
+        self._stats["misses"] += 1
+        # shield: request bị huỷ không làm huỷ lời gọi dùng chung của request khác
+        value = await asyncio.shield(self._start_fetch(key, fetcher, is_cacheable))
+        return value, 0.0
+
+    def stats(self) -> dict:
+        return {**self._stats, "entries": len(self._entries), "inflight": len(self._inflight)}
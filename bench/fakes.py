@@ -0,0 +1,315 @@
+# ====================================================================
+# FILE: bench/fakes.py - Fake cục bộ cho OpenAI, Graph API, Google Drive và connect.php
+# Tất cả chạy trong MỘT ứng dụng FastAPI, mỗi upstream một tiền tố đường dẫn:
+#   /openai/v1/...   -> OPENAI_API_BASE
+#   /graph/v19.0/... -> GRAPH_API_BASE
+#   /drive/v3/...    -> DRIVE_API_ENDPOINT
+#   /php/...         -> PHP_CONNECT_URL, PHP_BULK_URL
+# ====================================================================
+import json
+import time
+import base64
+import random
+import asyncio
+import hashlib
+import threading
+from array import array
+from dataclasses import dataclass, field
+from urllib.parse import parse_qs
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+DISTRICTS = ["Từ Sơn", "Yên Phong", "Quế Võ", "Tiên Du", "Thuận Thành", "Gia Bình", "Lương Tài"]
+WARDS = ["Đình Bảng", "Đông Ngàn", "Tân Hồng", "Châu Khê", "Đồng Nguyên", "Phù Khê"]
+TYPES = ["nhà phố", "đất nền", "chung cư", "nhà mặt phố", "biệt thự", "shophouse"]
+LEGAL = ["sổ đỏ chính chủ", "sổ hồng", "đang chờ sổ", "hợp đồng mua bán"]
+
+
+@dataclass
+class FakeConfig:
+    embedding_dim: int = 256
+    openai_chat_latency_ms: float = 800
+    openai_embedding_latency_ms: float = 50
+    graph_latency_ms: float = 80
+    drive_latency_ms: float = 30
+    php_latency_ms: float = 40
+    corpus_size: int = 20
+    page_size: int = 100
+    seed: int = 42
+    page_id: str = "bench-page"
+    folder_id: str = "bench-folder"
+    # Tỉ lệ mục trong Graph batch bị trả lỗi throttle (code 4) để thử retry
+    graph_throttle_rate: float = 0.0
+    reply_log: dict = field(default_factory=dict)  # comment_id -> thời điểm nhận phản hồi
+
+
+def listing_text(index: int, seed: int = 42) -> str:
+    """Sinh một tin đăng nhà đất giả nhưng có cấu trúc giống thật."""
+    rnd = random.Random(seed * 100003 + index)
+    kind = rnd.choice(TYPES)
+    price = rnd.choice([0.8, 1.2, 1.9, 2.5, 3.2, 4.5, 6.8])
+    area = rnd.choice([45, 60, 72, 80, 100, 120, 150])
+    lines = [
+        f"Mã tin BN{index:05d}: Bán {kind} tại phường {rnd.choice(WARDS)}, thị xã {rnd.choice(DISTRICTS)}, Bắc Ninh.",
+        f"Diện tích {area}m2, mặt tiền {rnd.choice([4, 5, 6, 8])}m, hướng {rnd.choice(['Đông', 'Tây', 'Nam', 'Bắc'])}.",
+        f"Giá bán {str(price).replace('.', ',')} tỷ, có thương lượng. Pháp lý: {rnd.choice(LEGAL)}.",
+        "Đường ô tô tránh nhau, gần chợ, trường học, khu công nghiệp VSIP.",
+        "Liên hệ Page Yêu Công Nghệ - bacninhtech để xem nhà, hỗ trợ vay ngân hàng 70%.",
+    ]
+    return "\n".join(lines * rnd.choice([1, 2, 3]))
+
+
+def fake_embedding(item, dim: int) -> list:
+    """Vector xác định (deterministic) từ hash của input, đã chuẩn hoá độ dài."""
+    seed = hashlib.sha256(json.dumps(item, ensure_ascii=False).encode("utf-8")).digest()
+    rnd = random.Random(seed)
+    vector = [rnd.uniform(-1, 1) for _ in range(dim)]
+    norm = sum(x * x for x in vector) ** 0.5 or 1.0
+    return [x / norm for x in vector]
+
+
+def create_fake_app(config: FakeConfig) -> FastAPI:
+    app = FastAPI()
+    app.state.config = config
+    app.state.counters = {"chat": 0, "embedding_requests": 0, "embedding_inputs": 0,
+                          "graph_batches": 0, "graph_replies": 0, "php_records": 0, "drive_downloads": 0}
+    files = {
+        f"file{i:05d}": {
+            "id": f"file{i:05d}",
+            "name": f"tin-dang-{i:05d}.txt",
+            "modifiedTime": "2025-01-01T00:00:00.000Z",
+            "md5Checksum": hashlib.md5(listing_text(i, config.seed).encode("utf-8")).hexdigest(),
+            "parents": [config.folder_id],
+        }
+        for i in range(config.corpus_size)
+    }
+    app.state.files = files
+    app.state.contents = {}   # file_id -> nội dung do bench đặt (ghi đè listing_text)
+    app.state.changes = []    # nhật ký thay đổi cho changes.list; page token = vị trí trong nhật ký
+
+    def record_change(file_id: str, removed: bool = False):
+        change = {"kind": "drive#change", "fileId": file_id, "removed": removed,
+                  "time": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())}
+        if not removed:
+            change["file"] = app.state.files[file_id]
+        app.state.changes.append(change)
+
+    async def delay(ms: float):
+        if ms > 0:
+            await asyncio.sleep(ms / 1000)
+
+    # ---------- OpenAI ----------
+    @app.post("/openai/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        # langchain có thể gửi token id (list[int]) thay vì chuỗi
+        if inputs and isinstance(inputs[0], int):
+            inputs = [inputs]
+        await delay(config.openai_embedding_latency_ms)
+        app.state.counters["embedding_requests"] += 1
+        app.state.counters["embedding_inputs"] += len(inputs)
+        data = []
+        for i, item in enumerate(inputs):
+            vector = fake_embedding(item, config.embedding_dim)
+            if body.get("encoding_format") == "base64":
+                vector = base64.b64encode(array("f", vector).tobytes()).decode("ascii")
+            data.append({"object": "embedding", "index": i, "embedding": vector})
+        tokens = sum(len(x) if isinstance(x, list) else len(str(x)) // 4 for x in inputs)
+        return {"object": "list", "data": data, "model": body.get("model"),
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+    @app.post("/openai/v1/chat/completions")
+    async def chat(request: Request):
+        body = await request.json()
+        await delay(config.openai_chat_latency_ms)
+        app.state.counters["chat"] += 1
+        prompt = " ".join(str(m.get("content", "")) for m in body.get("messages", []))
+        answer = "Dạ, căn này vẫn còn ạ. Anh/chị vui lòng inbox Page để được tư vấn chi tiết."
+        prompt_tokens, completion_tokens = len(prompt) // 4, len(answer) // 4
+        return {
+            "id": f"chatcmpl-bench-{app.state.counters['chat']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-4o-mini"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": answer}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    # ---------- Graph API ----------
+    def usage_headers():
+        used = min(100, app.state.counters["graph_replies"] // 50)
+        usage = json.dumps({"call_count": used, "total_cputime": used // 2, "total_time": used // 2})
+        return {"X-App-Usage": usage, "X-Page-Usage": usage}
+
+    @app.post("/graph/v19.0/")
+    async def graph_batch(request: Request):
+        form = parse_qs((await request.body()).decode("utf-8"))
+        batch = json.loads(form["batch"][0])
+        await delay(config.graph_latency_ms)
+        app.state.counters["graph_batches"] += 1
+        results = []
+        for item in batch:
+            comment_id = item["relative_url"].split("/")[0]
+            if random.random() < config.graph_throttle_rate:
+                body = {"error": {"message": "Application request limit reached", "code": 4}}
+                results.append({"code": 400, "headers": [], "body": json.dumps(body)})
+                continue
+            config.reply_log[comment_id] = time.time()
+            app.state.counters["graph_replies"] += 1
+            headers = [{"name": k, "value": v} for k, v in usage_headers().items()]
+            results.append({"code": 200, "headers": headers,
+                            "body": json.dumps({"id": f"{comment_id}_reply"})})
+        return JSONResponse(results, headers=usage_headers())
+
+    @app.post("/graph/v19.0/{comment_id}/comments")
+    async def graph_reply(comment_id: str):
+        await delay(config.graph_latency_ms)
+        config.reply_log[comment_id] = time.time()
+        app.state.counters["graph_replies"] += 1
+        return JSONResponse({"id": f"{comment_id}_reply"}, headers=usage_headers())
+
+    @app.get("/graph/v19.0/{page_id}/posts")
+    async def graph_posts(page_id: str, limit: int = 3):
+        await delay(config.graph_latency_ms)
+        return {"data": [{"id": f"{page_id}_post{i}", "message": listing_text(i, config.seed)[:120],
+                          "created_time": "2025-01-01T00:00:00+0000"} for i in range(limit)]}
+
+    @app.get("/graph/v19.0/{page_id}")
+    async def graph_page(page_id: str):
+        await delay(config.graph_latency_ms)
+        return {"id": page_id, "name": "Bench Page", "fan_count": 1234, "about": "Fake page"}
+
+    # ---------- Google Drive ----------
+    @app.get("/drive/v3/files")
+    async def drive_list(pageToken: str = None, pageSize: int = 100):
+        await delay(config.drive_latency_ms)
+        ordered = sorted(app.state.files.values(), key=lambda f: f["id"])
+        start = int(pageToken or 0)
+        size = min(pageSize, config.page_size)
+        result = {"files": ordered[start:start + size]}
+        if start + size < len(ordered):
+            result["nextPageToken"] = str(start + size)
+        return result
+
+    @app.get("/drive/v3/files/{file_id}")
+    async def drive_download(file_id: str):
+        await delay(config.drive_latency_ms)
+        app.state.counters["drive_downloads"] += 1
+        if file_id in app.state.contents:
+            return Response(app.state.contents[file_id].encode("utf-8"), media_type="text/plain")
+        index = int(file_id.replace("file", ""))
+        return Response(listing_text(index, config.seed).encode("utf-8"), media_type="text/plain")
+
+    @app.get("/drive/v3/changes/startPageToken")
+    async def drive_start_page_token():
+        await delay(config.drive_latency_ms)
+        return {"kind": "drive#startPageToken", "startPageToken": str(len(app.state.changes))}
+
+    @app.get("/drive/v3/changes")
+    async def drive_changes(pageToken: str, pageSize: int = 100):
+        await delay(config.drive_latency_ms)
+        start = int(pageToken)
+        size = min(pageSize, config.page_size)
+        result = {"kind": "drive#changeList", "changes": app.state.changes[start:start + size]}
+        if start + size < len(app.state.changes):
+            result["nextPageToken"] = str(start + size)
+        else:
+            result["newStartPageToken"] = str(len(app.state.changes))
+        return result
+
+    @app.post("/_bench/drive/files")
+    async def bench_put_file(request: Request):
+        """Thêm/sửa một file trong thư mục: {"id"?, "name"?, "text"} -> ghi vào nhật ký thay đổi."""
+        body = await request.json()
+        file_id = body.get("id") or f"file{len(app.state.files):05d}"
+        text = body["text"]
+        app.state.contents[file_id] = text
+        app.state.files[file_id] = {
+            "id": file_id,
+            "name": body.get("name") or f"tin-dang-{file_id}.txt",
+            "modifiedTime": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+            "md5Checksum": hashlib.md5(text.encode("utf-8")).hexdigest(),
+            "parents": [config.folder_id],
+        }
+        record_change(file_id)
+        return app.state.files[file_id]
+
+    @app.delete("/_bench/drive/files/{file_id}")
+    async def bench_delete_file(file_id: str):
+        app.state.files.pop(file_id, None)
+        app.state.contents.pop(file_id, None)
+        record_change(file_id, removed=True)
+        return {"id": file_id, "removed": True}
+
+    # ---------- connect.php ----------
+    @app.post("/php/connect.php")
+    async def php_connect(request: Request):
+        await request.json()
+        await delay(config.php_latency_ms)
+        app.state.counters["php_records"] += 1
+        return {"status": "success"}
+
+    @app.post("/php/bulk.php")
+    async def php_bulk(request: Request):
+        body = await request.json()
+        await delay(config.php_latency_ms)
+        app.state.counters["php_records"] += len(body.get("records", []))
+        return {"status": "success"}
+
+    # ---------- Dành cho bench ----------
+    @app.get("/_bench/stats")
+    async def bench_stats():
+        return {"counters": app.state.counters, "replies": len(config.reply_log)}
+
+    @app.get("/_bench/replies")
+    async def bench_replies():
+        return config.reply_log
+
+    return app
+
+
+def start_fake_server(config: FakeConfig, host: str = "127.0.0.1", port: int = 9100):
+    """Chạy fake server trong thread nền; trả về (server, base_url)."""
+    server = uvicorn.Server(uvicorn.Config(create_fake_app(config), host=host, port=port,
+                                           log_level="warning", access_log=False))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, f"http://{host}:{port}"
+
+
+def fake_env(base_url: str, config: FakeConfig) -> dict:
+    """Biến môi trường để trỏ ứng dụng vào các fake."""
+    return {
+        "OPENAI_API_KEY": "sk-bench",
+        "OPENAI_API_BASE": f"{base_url}/openai/v1",
+        "OPENAI_BASE_URL": f"{base_url}/openai/v1",
+        "GRAPH_API_BASE": f"{base_url}/graph/v19.0",
+        "DRIVE_API_ENDPOINT": f"{base_url}/drive/v3/",
+        "DRIVE_FOLDER_ID": config.folder_id,
+        "PHP_CONNECT_URL": f"{base_url}/php/connect.php",
+        "PHP_BULK_URL": f"{base_url}/php/bulk.php",
+        "FB_PAGE_ID": config.page_id,
+        "FB_PAGE_ACCESS_TOKEN": "bench-token",
+        "VERIFY_TOKEN": "bench-verify",
+        "ANONYMIZED_TELEMETRY": "False",
+        "EMBEDDING_CHECK_CTX_LENGTH": "false",
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Chạy riêng fake server để thử thủ công.")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--corpus-size", type=int, default=20)
+    parser.add_argument("--chat-latency-ms", type=float, default=800)
+    args = parser.parse_args()
+    cfg = FakeConfig(corpus_size=args.corpus_size, openai_chat_latency_ms=args.chat_latency_ms)
+    uvicorn.run(create_fake_app(cfg), host="127.0.0.1", port=args.port)
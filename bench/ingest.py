@@ -0,0 +1,106 @@
+# ====================================================================
+# FILE: bench/ingest.py - Đo thời gian dựng snapshot index trên corpus giả lập
+#
+#   python -m bench.ingest --corpus-size 300
+#
+# Chạy 2 lần trên cùng thư mục (như `python build_index.py`): lần đầu (lạnh) và
+# lần hai (corpus không đổi, kỳ vọng không có lời gọi embedding nào).
+# --watch: sau đó sửa/thêm/xoá file trên fake Drive và cho drive_watcher phát hiện
+# qua changes.list, dựng snapshot tăng dần rồi hot-swap index đang dùng.
+# ====================================================================
+import os
+import time
+import argparse
+import tempfile
+
+import httpx
+
+from bench.fakes import FakeConfig, start_fake_server, fake_env
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark thời gian ingest (Drive -> Chroma) offline.")
+    parser.add_argument("--corpus-size", type=int, default=100)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--drive-latency-ms", type=float, default=30)
+    parser.add_argument("--embedding-latency-ms", type=float, default=50)
+    parser.add_argument("--embedding-dim", type=int, default=256)
+    parser.add_argument("--fake-port", type=int, default=9101)
+    parser.add_argument("--runs", type=int, default=2)
+    parser.add_argument("--watch", action="store_true", help="Thử theo dõi thay đổi Drive + hot-swap")
+    args = parser.parse_args()
+
+    config = FakeConfig(
+        corpus_size=args.corpus_size,
+        page_size=args.page_size,
+        drive_latency_ms=args.drive_latency_ms,
+        openai_embedding_latency_ms=args.embedding_latency_ms,
+        embedding_dim=args.embedding_dim,
+    )
+    _, fake_url = start_fake_server(config, port=args.fake_port)
+
+    # Cấu hình phải có trước khi import drive (đọc biến môi trường lúc import)
+    workdir = tempfile.mkdtemp(prefix="bench-ingest-")
+    os.environ.update(fake_env(fake_url, config))
+    os.environ.update({
+        "TEMP_DATA_DIR": os.path.join(workdir, "data"),
+        "CHROMA_DB_DIR": os.path.join(workdir, "chroma_db"),
+        "EMBEDDING_CACHE_PATH": os.path.join(workdir, "embedding_cache.sqlite3"),
+    })
+    import drive
+
+    for run in range(1, args.runs + 1):
+        before = httpx.get(f"{fake_url}/_bench/stats").json()["counters"]
+        started = time.perf_counter()
+        with drive.build_lock():
+            path = drive.build_snapshot()
+        elapsed = time.perf_counter() - started
+        vectorstore, _ = drive.open_snapshot(path)
+        after = httpx.get(f"{fake_url}/_bench/stats").json()["counters"]
+        print(
+            f"Lần {run}: {elapsed:.2f}s, {len(vectorstore)} chunk, "
+            f"{after['drive_downloads'] - before['drive_downloads']} lượt tải, "
+            f"{after['embedding_requests'] - before['embedding_requests']} request embedding "
+            f"({after['embedding_inputs'] - before['embedding_inputs']} đoạn)"
+        )
+
+    if args.watch:
+        watch(fake_url, drive)
+
+
+def watch(fake_url: str, drive):
+    from drive_watcher import DriveWatcher
+
+    watcher = DriveWatcher()
+    drive.activate_snapshot(drive.current_snapshot())
+    drive.INDEX_STATUS.update(state="ready")
+    # Lượt đầu chỉ lấy page token (corpus không đổi -> không dựng snapshot mới)
+    watcher.poll_drive()
+
+    text = ("Mã tin BN99999: Bán nhà phố tại phường Đình Bảng, thị xã Từ Sơn, Bắc Ninh.\n"
+            "Diện tích 66m2, giá bán 3,9 tỷ. Pháp lý: sổ đỏ chính chủ.")
+    httpx.post(f"{fake_url}/_bench/drive/files", json={"id": "watch-new", "text": text})
+    httpx.post(f"{fake_url}/_bench/drive/files", json={"id": "file00001", "text": text.replace("99999", "00001")})
+    httpx.delete(f"{fake_url}/_bench/drive/files/file00002")
+
+    old_vectorstore, _ = drive.get_index()
+    before = httpx.get(f"{fake_url}/_bench/stats").json()["counters"]
+    started = time.perf_counter()
+    rebuilt = watcher.poll_drive()
+    swapped = watcher.reload_index()
+    elapsed = time.perf_counter() - started
+    after = httpx.get(f"{fake_url}/_bench/stats").json()["counters"]
+    vectorstore, lexical = drive.get_index()
+    hits = lexical.search("mã tin BN99999", k=1)
+    print(
+        f"Watch: {elapsed:.2f}s, dựng lại={rebuilt}, hot-swap={swapped}, {len(vectorstore)} chunk, "
+        f"{after['drive_downloads'] - before['drive_downloads']} lượt tải, "
+        f"{after['embedding_inputs'] - before['embedding_inputs']} đoạn embedding; "
+        f"bản cũ vẫn đọc được {len(old_vectorstore)} chunk; "
+        f"tin mới tìm thấy: {bool(hits and 'BN99999' in hits[0][1].page_content)}"
+    )
+    print(f"Lượt hỏi Drive không có thay đổi: dựng lại={watcher.poll_drive()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+# ====================================================================
+# FILE: bench/load.py - Bắn các đợt bình luận vào /webhook và đo độ trễ
+#
+#   python -m bench.load --bursts 5 --burst-size 50 --concurrency 20
+#
+# Khởi động fake server + `uvicorn main:app` (tiến trình con, trỏ vào fake),
+# chờ /ready, rồi đo:
+#   - ack: thời gian /webhook trả 200
+#   - e2e: từ lúc gửi webhook tới lúc fake Graph API nhận được phản hồi
+#     (bình luận được gộp với bình luận sau của cùng người/bài viết tính theo
+#     phản hồi trên bình luận sau đó)
+# ====================================================================
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import httpx
+
+from bench.fakes import FakeConfig, start_fake_server, fake_env
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+QUESTIONS = [
+    "giá bao nhiêu ạ", "Giá bao nhiêu?", "còn không ạ", "ib", "ib em nhé", "địa chỉ ở đâu vậy",
+    "sổ đỏ chưa ạ", "diện tích bao nhiêu m2", "nhà này còn bán không", "có hỗ trợ vay ngân hàng không",
+    "đất ở phường Đình Bảng giá 2,5 tỷ còn không", "80m2 mặt tiền mấy mét", "xin thông tin chi tiết",
+    "hướng gì vậy ạ", "chính chủ không", "giá có thương lượng không ạ",
+]
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(name: str, values: list) -> str:
+    if not values:
+        return f"{name}: không có dữ liệu"
+    ms = [v * 1000 for v in values]
+    return (f"{name}: n={len(ms)} p50={percentile(ms, 50):.1f}ms p95={percentile(ms, 95):.1f}ms "
+            f"p99={percentile(ms, 99):.1f}ms max={max(ms):.1f}ms")
+
+
+def comment_payload(page_id: str, index: int, rnd: random.Random, author: tuple) -> dict:
+    user, post = author
+    return {
+        "object": "page",
+        "entry": [{
+            "id": page_id,
+            "time": int(time.time()),
+            "changes": [{
+                "field": "feed",
+                "value": {
+                    "item": "comment",
+                    "verb": "add",
+                    "comment_id": f"{page_id}_post{post}_c{index}",
+                    "post_id": f"{page_id}_post{post}",
+                    "from": {"id": f"user{user}", "name": "Khách"},
+                    "message": rnd.choice(QUESTIONS),
+                    "created_time": int(time.time()),
+                },
+            }],
+        }],
+    }
+
+
+def handled_at(comment_id: str, sent_at: dict, authors: dict, replies: dict):
+    """Thời điểm bình luận được trả lời: trên chính nó hoặc trên bình luận khác của cùng người/bài viết
+    (bình luận gửi đồng thời có thể tới server theo thứ tự khác)."""
+    times = [replies[other] for other in sent_at
+             if other in replies and authors[other] == authors[comment_id] and replies[other] >= sent_at[comment_id]]
+    return min(times) if times else None
+
+
+async def run_load(app_url: str, fake_url: str, config: FakeConfig, args) -> dict:
+    rnd = random.Random(config.seed)
+    sent_at, authors, ack = {}, {}, []
+    last_author = None
+    semaphore = asyncio.Semaphore(args.concurrency)
+    limits = httpx.Limits(max_connections=args.concurrency)
+
+    async with httpx.AsyncClient(timeout=30, limits=limits) as client:
+        async def send(index: int):
+            nonlocal last_author
+            # Một phần bình luận là câu hỏi nối tiếp của người vừa bình luận trên cùng bài viết
+            if last_author and rnd.random() < args.followup_rate:
+                author = last_author
+            else:
+                author = (rnd.randint(0, 500), rnd.randint(0, 9))
+            last_author = author
+            payload = comment_payload(config.page_id, index, rnd, author)
+            comment_id = payload["entry"][0]["changes"][0]["value"]["comment_id"]
+            authors[comment_id] = author
+            async with semaphore:
+                started = time.time()
+                response = await client.post(f"{app_url}/webhook", json=payload)
+                ack.append(time.time() - started)
+            if response.status_code == 200:
+                sent_at[comment_id] = started
+
+        started = time.time()
+        index = 0
+        for burst in range(args.bursts):
+            await asyncio.gather(*(send(index + i) for i in range(args.burst_size)))
+            index += args.burst_size
+            if burst < args.bursts - 1:
+                await asyncio.sleep(args.burst_interval)
+
+        # Chờ fake Graph API nhận đủ phản hồi (hoặc hết thời gian)
+        deadline = time.time() + args.reply_timeout
+        replies = {}
+        while time.time() < deadline:
+            replies = (await client.get(f"{fake_url}/_bench/replies")).json()
+            if all(handled_at(cid, sent_at, authors, replies) is not None for cid in sent_at):
+                break
+            await asyncio.sleep(0.25)
+        elapsed = time.time() - started
+        fake_stats = (await client.get(f"{fake_url}/_bench/stats")).json()
+
+    handled = {cid: handled_at(cid, sent_at, authors, replies) for cid in sent_at}
+    e2e = [handled[cid] - ts for cid, ts in sent_at.items() if handled[cid] is not None]
+    return {
+        "sent": len(sent_at),
+        "replied": len(e2e),
+        "reply_posts": sum(1 for cid in sent_at if cid in replies),
+        "elapsed": elapsed,
+        "ack": ack,
+        "e2e": e2e,
+        "fake": fake_stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark đầu-cuối webhook -> AI -> phản hồi Facebook (offline).")
+    parser.add_argument("--bursts", type=int, default=5)
+    parser.add_argument("--burst-size", type=int, default=50)
+    parser.add_argument("--burst-interval", type=float, default=2.0)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--corpus-size", type=int, default=20)
+    parser.add_argument("--chat-latency-ms", type=float, default=800)
+    parser.add_argument("--embedding-latency-ms", type=float, default=50)
+    parser.add_argument("--graph-latency-ms", type=float, default=80)
+    parser.add_argument("--php-latency-ms", type=float, default=40)
+    parser.add_argument("--graph-throttle-rate", type=float, default=0.0)
+    parser.add_argument("--reply-timeout", type=float, default=120)
+    parser.add_argument("--followup-rate", type=float, default=0.0,
+                        help="Tỉ lệ bình luận nối tiếp của cùng người trên cùng bài viết (thử gộp bình luận)")
+    parser.add_argument("--fake-port", type=int, default=9100)
+    parser.add_argument("--app-port", type=int, default=9200)
+    parser.add_argument("--workers", type=int, default=1, help="Số worker uvicorn của ứng dụng")
+    parser.add_argument("--prebuild", action="store_true",
+                        help="Dựng snapshot bằng build_index.py trước, app chỉ mở snapshot (INDEX_BUILD_ON_STARTUP=false)")
+    args = parser.parse_args()
+
+    config = FakeConfig(
+        corpus_size=args.corpus_size,
+        openai_chat_latency_ms=args.chat_latency_ms,
+        openai_embedding_latency_ms=args.embedding_latency_ms,
+        graph_latency_ms=args.graph_latency_ms,
+        php_latency_ms=args.php_latency_ms,
+        graph_throttle_rate=args.graph_throttle_rate,
+    )
+    _, fake_url = start_fake_server(config, port=args.fake_port)
+
+    # Mọi trạng thái (Chroma, hàng đợi, cache...) nằm trong thư mục tạm riêng
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    env = {
+        **os.environ,
+        **fake_env(fake_url, config),
+        "TEMP_DATA_DIR": os.path.join(workdir, "data"),
+        "CHROMA_DB_DIR": os.path.join(workdir, "chroma_db"),
+        "EMBEDDING_CACHE_PATH": os.path.join(workdir, "embedding_cache.sqlite3"),
+        "JOB_QUEUE_PATH": os.path.join(workdir, "job_queue.sqlite3"),
+        "DEDUP_DB_PATH": os.path.join(workdir, "dedup.sqlite3"),
+        "PHP_SPOOL_PATH": os.path.join(workdir, "php_spool.jsonl"),
+    }
+    app_log = open(os.path.join(workdir, "app.stdout.log"), "w")
+    if args.prebuild:
+        started = time.time()
+        subprocess.run([sys.executable, os.path.join(REPO_DIR, "build_index.py")], env=env, cwd=workdir,
+                       stdout=app_log, stderr=subprocess.STDOUT, check=True)
+        print(f"✅ Dựng snapshot xong sau {time.time() - started:.1f}s")
+        env["INDEX_BUILD_ON_STARTUP"] = "false"
+    else:
+        # Đo cả trường hợp app tự đồng bộ Drive khi khởi động
+        env["INDEX_BUILD_ON_STARTUP"] = "true"
+    app_url = f"http://127.0.0.1:{args.app_port}"
+    app = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", REPO_DIR, "--host", "127.0.0.1",
+         "--port", str(args.app_port), "--workers", str(args.workers), "--log-level", "warning"],
+        env=env, cwd=workdir, stdout=app_log, stderr=subprocess.STDOUT,
+    )
+    try:
+        started = time.time()
+        while True:
+            try:
+                if httpx.get(f"{app_url}/ready", timeout=2).status_code == 200:
+                    break
+            except httpx.HTTPError:
+                pass
+            if app.poll() is not None:
+                raise SystemExit("❌ Ứng dụng đã dừng trước khi sẵn sàng.")
+            time.sleep(0.5)
+        print(f"✅ Ứng dụng sẵn sàng sau {time.time() - started:.1f}s (log: {workdir})")
+
+        result = asyncio.run(run_load(app_url, fake_url, config, args))
+        print(f"Đã gửi {result['sent']} bình luận, {result['replied']} được trả lời "
+              f"({result['reply_posts']} phản hồi đăng lên) trong {result['elapsed']:.1f}s")
+        print(f"Throughput webhook: {result['sent'] / result['elapsed']:.1f} bình luận/s, "
+              f"phản hồi: {result['replied'] / result['elapsed']:.1f}/s")
+        print(summarize("ack  ", result["ack"]))
+        print(summarize("e2e  ", result["e2e"]))
+        print(f"Fake upstream: {result['fake']['counters']}")
+    finally:
+        app.terminate()
+        app.wait(timeout=30)
+        app_log.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+# ====================================================================
+# FILE: build_index.py - Dựng index (Drive -> Chroma + BM25) thành snapshot có version
+#
+#   python build_index.py            # cập nhật tăng dần (Drive không đổi -> giữ snapshot hiện tại)
+#   python build_index.py --force    # dựng lại từ đầu (embedding vẫn lấy từ cache)
+#
+# Snapshot mới nằm trong $CHROMA_DB_DIR/snapshots/<version>/; khi dựng xong con
+# trỏ $CHROMA_DB_DIR/current mới được chuyển sang (atomic). Web app (mặc định
+# INDEX_BUILD_ON_STARTUP=false) chỉ mở snapshot này, nên thêm worker uvicorn
+# không làm tăng số lần tải Drive/embedding.
+# ====================================================================
+import sys
+import argparse
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import drive
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dựng snapshot index từ Google Drive.")
+    parser.add_argument("--force", action="store_true", help="Không dùng snapshot hiện tại làm nền")
+    parser.add_argument("--keep", type=int, default=drive.INDEX_KEEP_SNAPSHOTS, help="Số snapshot giữ lại")
+    args = parser.parse_args()
+
+    try:
+        with drive.build_lock():
+            path = drive.build_snapshot(force=args.force, keep=args.keep)
+    except Exception as e:
+        print(f"❌ Dựng index thất bại: {e}")
+        return 1
+    print(path)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+# ====================================================================
+# FILE: context_builder.py - Ghép/loại trùng các chunk và đóng gói ngữ cảnh theo ngân sách token
+# ====================================================================
+import os
+import logging
+import threading
+
+import tiktoken
+from langchain_core.documents import Document
+
+from lexical_index import tokenize
+from metrics import record_context_packing
+
+logger = logging.getLogger(__name__)
+
+# ==== Cấu hình ====
+# Ngân sách token cho phần NGỮ CẢNH trong prompt (không tính câu hỏi và chỉ dẫn).
+# Mặc định ~ bằng 5 chunk 300 ký tự trước đây: k lớn hơn nhưng prompt không dài hơn
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "600"))
+# Hai chunk cùng nguồn cách nhau tối đa chừng này ký tự thì coi là liền kề và ghép lại
+CONTEXT_MERGE_GAP_CHARS = int(os.getenv("CONTEXT_MERGE_GAP_CHARS", "2"))
+# Jaccard trên cặp âm tiết >= ngưỡng -> coi là gần trùng, bỏ đoạn xếp hạng thấp hơn
+CONTEXT_DUPLICATE_THRESHOLD = float(os.getenv("CONTEXT_DUPLICATE_THRESHOLD", "0.8"))
+# Ước lượng khi không dùng được tiktoken (chạy offline): số ký tự trung bình mỗi token
+CONTEXT_CHARS_PER_TOKEN = float(os.getenv("CONTEXT_CHARS_PER_TOKEN", "3"))
+CONTEXT_TOKENIZER_MODEL = os.getenv("CONTEXT_TOKENIZER_MODEL", "gpt-4o-mini")
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def count_tokens(text: str) -> int:
+    """Đếm token bằng tiktoken; nếu không tải được bộ mã hoá thì ước lượng theo ký tự."""
+    global _encoding
+    if _encoding is None:
+        with _encoding_lock:
+            if _encoding is None:
+                try:
+                    _encoding = tiktoken.encoding_for_model(CONTEXT_TOKENIZER_MODEL)
+                except Exception as e:
+                    logger.warning(f"⚠️ Không dùng được tiktoken ({e}), ước lượng token theo số ký tự.")
+                    _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text))
+    return int(len(text) / CONTEXT_CHARS_PER_TOKEN) + 1
+
+
+def _source_key(doc: Document):
+    meta = doc.metadata
+    return (meta.get("drive_file_id") or meta.get("source"), meta.get("page"))
+
+
+def merge_adjacent(docs: list, max_tokens: int = None) -> list:
+    """
+    Ghép các chunk chồng lấn (chunk_overlap) hoặc liền kề của cùng một nguồn thành
+    một đoạn. Đoạn ghép giữ thứ hạng tốt nhất trong các chunk tạo nên nó.
+    Với max_tokens: không ghép thêm nếu đoạn sẽ vượt ngưỡng (bắt đầu đoạn mới), để
+    một dải chunk liền kề dài không kéo chunk xếp hạng cao ra khỏi ngân sách.
+    Trả về [(rank, Document)] theo thứ hạng.
+    """
+    groups = {}
+    passthrough = []
+    for rank, doc in enumerate(docs):
+        if doc.metadata.get("start_index") is None or _source_key(doc)[0] is None:
+            passthrough.append((rank, doc))
+        else:
+            groups.setdefault(_source_key(doc), []).append((rank, doc))
+
+    merged = list(passthrough)
+    for items in groups.values():
+        items.sort(key=lambda item: item[1].metadata["start_index"])
+        rank, doc = items[0]
+        text, start = doc.page_content, doc.metadata["start_index"]
+        for next_rank, next_doc in items[1:]:
+            end = start + len(text)
+            next_start = next_doc.metadata["start_index"]
+            next_text = next_doc.page_content
+            overlap = end - next_start
+            if next_start + len(next_text) <= end:
+                # Nằm trọn trong đoạn đang ghép
+                rank = min(rank, next_rank)
+                continue
+            if overlap >= 0 and text.endswith(next_text[:overlap]):
+                candidate = text + next_text[overlap:]
+            elif 0 < -overlap <= CONTEXT_MERGE_GAP_CHARS:
+                candidate = text + "\n" + next_text
+            else:
+                candidate = None
+            if candidate is not None and (max_tokens is None or count_tokens(candidate) <= max_tokens):
+                text, rank = candidate, min(rank, next_rank)
+            else:
+                merged.append((rank, Document(page_content=text, metadata={**doc.metadata, "start_index": start})))
+                rank, doc, text, start = next_rank, next_doc, next_text, next_start
+        merged.append((rank, Document(page_content=text, metadata={**doc.metadata, "start_index": start})))
+    return sorted(merged, key=lambda item: item[0])
+
+
+def _shingles(text: str) -> set:
+    return {t for t in tokenize(text) if "_" in t} or set(tokenize(text))
+
+def drop_near_duplicates(ranked: list) -> list:
+    """Bỏ đoạn gần trùng (tin đăng lặp lại, chunk trùng nội dung), giữ đoạn xếp hạng cao hơn."""
+    kept, kept_shingles = [], []
+    for rank, doc in ranked:
+        shingles = _shingles(doc.page_content)
+        duplicate = False
+        for other in kept_shingles:
+            union = len(shingles | other)
+            if union and len(shingles & other) / union >= CONTEXT_DUPLICATE_THRESHOLD:
+                duplicate = True
+                break
+        if not duplicate:
+            kept.append((rank, doc))
+            kept_shingles.append(shingles)
+    return kept
+
+
+def build_context(docs: list, budget: int = CONTEXT_TOKEN_BUDGET) -> list:
+    """
+    Ghép chunk liền kề, bỏ gần trùng rồi xếp theo độ liên quan cho tới khi hết
+    ngân sách token. Trả về danh sách Document dùng cho chain "stuff".
+    """
+    if not docs:
+        return []
+    tokens_before = sum(count_tokens(doc.page_content) for doc in docs)
+
+    packed, used = [], 0
+    for _, doc in drop_near_duplicates(merge_adjacent(docs, max_tokens=budget)):
+        tokens = count_tokens(doc.page_content)
+        if used + tokens <= budget:
+            packed.append(doc)
+            used += tokens
+        elif not packed:
+            # Đoạn liên quan nhất đã vượt ngân sách -> cắt bớt thay vì bỏ trống ngữ cảnh
+            chars = int(len(doc.page_content) * budget / tokens)
+            packed.append(Document(page_content=doc.page_content[:chars], metadata=doc.metadata))
+            used = count_tokens(packed[0].page_content)
+
+    record_context_packing(tokens_before, used)
+    logger.info(f"🧩 Ngữ cảnh: {len(docs)} chunk -> {len(packed)} đoạn, "
+                f"{tokens_before} -> {used} token (tiết kiệm {tokens_before - used}).")
+    return packed
@@ -0,0 +1,91 @@
+# ====================================================================
+# FILE: dedup.py - Chống xử lý trùng bình luận khi Facebook gửi lại webhook
+# ====================================================================
+import os
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# ==== Cấu hình ====
+DEDUP_DB_PATH = os.getenv("DEDUP_DB_PATH", "/tmp/dedup.sqlite3")
+DEDUP_WINDOW_SECONDS = float(os.getenv("DEDUP_WINDOW_SECONDS", str(48 * 3600)))
+DEDUP_MAX_MEMORY = int(os.getenv("DEDUP_MAX_MEMORY", "50000"))
+# Cứ sau N lần ghi thì dọn bản ghi quá hạn trong SQLite
+DEDUP_PRUNE_EVERY = int(os.getenv("DEDUP_PRUNE_EVERY", "1000"))
+
+
+class CommentDeduplicator:
+    """
+    Ghi nhớ comment_id đã xử lý trong cửa sổ thời gian DEDUP_WINDOW_SECONDS.
+    Tầng 1: OrderedDict trong bộ nhớ (giới hạn kích thước, LRU).
+    Tầng 2: SQLite trên đĩa để vẫn chống trùng sau khi khởi động lại.
+    """
+
+    def __init__(self, path: str = DEDUP_DB_PATH, window: float = DEDUP_WINDOW_SECONDS,
+                 max_memory: int = DEDUP_MAX_MEMORY):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.window = window
+        self.max_memory = max_memory
+        self._memory = OrderedDict()  # comment_id -> seen_at
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.duplicates_suppressed = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS seen_comments (comment_id TEXT PRIMARY KEY, seen_at REAL NOT NULL)"
+        )
+
+    def _remember(self, comment_id: str, seen_at: float):
+        self._memory[comment_id] = seen_at
+        self._memory.move_to_end(comment_id)
+        while len(self._memory) > self.max_memory:
+            self._memory.popitem(last=False)
+
+    def first_seen(self, comment_id: str) -> bool:
+        """True nếu đây là lần đầu thấy comment_id trong cửa sổ; False nếu là bản gửi lại."""
+        now = time.time()
+        cutoff = now - self.window
+        with self._lock:
+            seen_at = self._memory.get(comment_id)
+            if seen_at is not None and seen_at >= cutoff:
+                self.duplicates_suppressed += 1
+                return False
+
+            # Lấy "chỗ" trong SQLite một cách atomic (an toàn giữa nhiều worker uvicorn)
+            cur = self._conn.execute(
+                "INSERT INTO seen_comments (comment_id, seen_at) VALUES (?, ?) "
+                "ON CONFLICT(comment_id) DO UPDATE SET seen_at = excluded.seen_at "
+                "WHERE seen_comments.seen_at < ?",
+                (comment_id, now, cutoff),
+            )
+            if cur.rowcount == 0:
+                # Đã có bản ghi còn trong cửa sổ -> trùng
+                self.duplicates_suppressed += 1
+                self._remember(comment_id, now)
+                return False
+
+            self._remember(comment_id, now)
+            self._writes += 1
+            if self._writes % DEDUP_PRUNE_EVERY == 0:
+                self._conn.execute("DELETE FROM seen_comments WHERE seen_at < ?", (cutoff,))
+            return True
+
+    def forget(self, comment_id: str):
+        """Bỏ đánh dấu (xử lý thất bại) để lần Facebook gửi lại webhook được xử lý như mới."""
+        with self._lock:
+            self._memory.pop(comment_id, None)
+            self._conn.execute("DELETE FROM seen_comments WHERE comment_id = ?", (comment_id,))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "duplicates_suppressed": self.duplicates_suppressed,
+                "memory_entries": len(self._memory),
+                "window_seconds": self.window,
+            }
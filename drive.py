@@ -1,130 +1,529 @@
-# ====================================================================
-# FILE: drive.py - Xử lý tải tài liệu từ Google Drive và tạo Vectorstore
-# ====================================================================
-
-import os
-import io
-import requests
-from dotenv import load_dotenv
-
-# LangChain và Google Drive Imports
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-from langchain_community.document_loaders import PyPDFLoader, TextLoader, Docx2txtLoader
-from langchain_openai import OpenAIEmbeddings
-from langchain_community.vectorstores import Chroma
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-
-# Tải biến môi trường
-load_dotenv()
-
-# ==== Cấu hình API ====
-# CREDENTIALS_URL = os.getenv("CREDENTIALS_URL_PHP")
-# CREDENTIALS_TOKEN = os.getenv("CREDENTIALS_TOKEN")
-# JSON_ACCOUNT_FILE = os.getenv("JSON_ACCOUNT_FILE")
-JSON_CONTENT_CREDENTIALS= os.getenv("GCP_CREDENTIALS_JSON")
-# Thay thế bằng ID thư mục Google Drive của bạn
-DRIVE_FOLDER_ID = os.getenv("DRIVE_FOLDER_ID")
-TEMP_DATA_DIR = "/tmp/data"
-CHROMA_DB_DIR = "/tmp/chroma_db"
-SERVICE_ACCOUNT_FILE = "/tmp/drive-folder-temp.json" 
-
-def setup_vectorstore():
-    """
-    Tải file xác thực từ Biến Môi trường, tải tài liệu từ Google Drive, xử lý chúng
-    và trả về Vectorstore (ChromaDB) đã được khởi tạo.
-    """
-    
-    # === BƯỚC 1: TẠO FILE CREDENTIALS TỪ BIẾN MÔI TRƯỜNG (Thay thế API) ===
-    print("Bắt đầu: Tải file xác thực từ biến môi trường...")
-    
-    # 1a. Kiểm tra nội dung JSON
-    if not JSON_CONTENT_CREDENTIALS:
-        # Nếu biến môi trường bị thiếu, dừng ngay quá trình khởi tạo RAG
-        raise Exception("LỖI FATAL: Không tìm thấy biến môi trường GCP_CREDENTIALS_JSON.")
-        
-    # 1b. Ghi nội dung JSON vào file tạm /tmp/drive-folder-temp.json
-    try:
-        # Ghi file ở chế độ 'w' (write) để ghi nội dung JSON (string)
-        with open(SERVICE_ACCOUNT_FILE, "w") as f:
-            f.write(JSON_CONTENT_CREDENTIALS) 
-        print("Hoàn tất: Tạo file xác thực tạm thời thành công.")
-    except Exception as e:
-        # Nếu lỗi ghi file (ví dụ: lỗi I/O), dừng ngay
-        print(f"LỖI FATAL: Không thể ghi nội dung credentials vào file tạm: {e}")
-        raise e
-
-    # === BƯỚC 2: Xác thực Google Drive ===
-    print("Bắt đầu: Xác thực Google Drive...")
-    # creds sẽ đọc file tạm /tmp/drive-folder-temp.json
-    creds = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE)
-    drive_service = build("drive", "v3", credentials=creds)
-    print("Hoàn tất: Xác thực Google Drive thành công.")
-
-    # === BƯỚC 3, 4, 5: TẢI TÀI LIỆU VÀ TẠO VECTORSTORE ===
-    # 3. Tải tài liệu từ Drive
-    os.makedirs(TEMP_DATA_DIR, exist_ok=True)
-    print(f"Bắt đầu: Tải tài liệu từ Folder ID {DRIVE_FOLDER_ID}...")
-    
-    results = drive_service.files().list(
-        q=f"'{DRIVE_FOLDER_ID}' in parents and trashed=false",
-        fields="files(id, name)"
-    ).execute()
-    files = results.get("files", [])
-    
-    for file in files:
-        file_path = os.path.join(TEMP_DATA_DIR, file["name"])
-        if os.path.exists(file_path):
-            continue
-        
-        request = drive_service.files().get_media(fileId=file["id"])
-        with io.FileIO(file_path, "wb") as fh:
-            downloader = MediaIoBaseDownload(fh, request)
-            done = False
-            while not done:
-                _, done = downloader.next_chunk()
-        print(f"   -> Đã tải: {file['name']}")
-    
-    print("Hoàn tất: Tải tài liệu Drive.")
-
-    # 4. Tải và xử lý tài liệu (Load Documents)
-    print("Bắt đầu: Xử lý và chia nhỏ tài liệu...")
-    docs = []
-    for filename in os.listdir(TEMP_DATA_DIR):
-        filepath = os.path.join(TEMP_DATA_DIR, filename)
-        # Bổ sung kiểm tra size 0 byte để tránh lỗi Loader
-        if os.path.getsize(filepath) == 0: continue
-        
-        # Cần đảm bảo các loader (PyPDFLoader, Docx2txtLoader) đã được import
-        if filename.endswith(".pdf"):
-            docs.extend(PyPDFLoader(filepath).load())
-        elif filename.endswith(".txt"):
-            docs.extend(TextLoader(filepath).load())
-        elif filename.endswith(".docx"):
-            docs.extend(Docx2txtLoader(filepath).load())
-            
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=300, chunk_overlap=50)
-    splits = text_splitter.split_documents(docs)
-    
-    print(f"Hoàn tất: Đã chia thành {len(splits)} đoạn văn.")
-
-    # 5. Tạo Vectorstore (Chroma)
-    print("Bắt đầu: Tạo Vectorstore (Embedding)...")
-    # Cần đảm bảo rằng biến môi trường OPENAI_API_KEY đã được thiết lập.
-    embedding = OpenAIEmbeddings() 
-    vectorstore = Chroma.from_documents(
-        documents=splits,
-        embedding=embedding,
-        persist_directory=CHROMA_DB_DIR
-    )
-    print("✅ Hoàn tất: Vectorstore đã sẵn sàng.")
-    
-    return vectorstore
-
-# Khởi tạo vectorstore khi drive.py được import
-VECTORSTORE = setup_vectorstore()
-
-# Hàm getter để main.py có thể truy cập vectorstore
-def get_vectorstore():
-    return VECTORSTORE
+# ====================================================================
+# FILE: drive.py - Xử lý tải tài liệu từ Google Drive và tạo Vectorstore
+# ====================================================================
+
+import os
+import io
+import json
+import time
+import fcntl
+import shutil
+import requests
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from dotenv import load_dotenv
+
+# Thư viện Google Drive, document loader và text splitter chỉ cần khi DỰNG index
+# (build_index.py) nên được import trong hàm: web app chỉ mở snapshot, khởi động nhanh hơn.
+from langchain_community.vectorstores import Chroma
+
+from embedding_cache import get_embeddings
+from lexical_index import BM25Index
+from listing_metadata import annotate_chunks
+from metrics import timed, observe
+
+# Tải biến môi trường
+load_dotenv()
+
+# ==== Cấu hình API ====
+# CREDENTIALS_URL = os.getenv("CREDENTIALS_URL_PHP")
+# CREDENTIALS_TOKEN = os.getenv("CREDENTIALS_TOKEN")
+# JSON_ACCOUNT_FILE = os.getenv("JSON_ACCOUNT_FILE")
+JSON_CONTENT_CREDENTIALS= os.getenv("GCP_CREDENTIALS_JSON")
+# Thay thế bằng ID thư mục Google Drive của bạn
+DRIVE_FOLDER_ID = os.getenv("DRIVE_FOLDER_ID")
+TEMP_DATA_DIR = os.getenv("TEMP_DATA_DIR", "/tmp/data")
+# Thư mục gốc của index: snapshots/<version>/ (Chroma + manifest + BM25) và con trỏ "current"
+CHROMA_DB_DIR = os.getenv("CHROMA_DB_DIR", "/tmp/chroma_db")
+SNAPSHOTS_DIR = os.path.join(CHROMA_DB_DIR, "snapshots")
+CURRENT_POINTER = os.path.join(CHROMA_DB_DIR, "current")
+BUILD_LOCK_FILE = os.path.join(CHROMA_DB_DIR, ".build.lock")
+# Số snapshot giữ lại (snapshot đang dùng luôn được giữ)
+INDEX_KEEP_SNAPSHOTS = int(os.getenv("INDEX_KEEP_SNAPSHOTS", "3"))
+# false (mặc định): web app chỉ mở snapshot do `python build_index.py` tạo sẵn.
+# true: khi khởi động, web app tự đồng bộ với Drive (chỉ một worker dựng, các worker khác chờ).
+INDEX_BUILD_ON_STARTUP = os.getenv("INDEX_BUILD_ON_STARTUP", "false").lower() == "true"
+# Ghi đè endpoint Drive API (ví dụ "http://127.0.0.1:9100/drive/v3/" của fake Drive trong bench/)
+DRIVE_API_ENDPOINT = os.getenv("DRIVE_API_ENDPOINT")
+SERVICE_ACCOUNT_FILE = "/tmp/drive-folder-temp.json" 
+# Trong mỗi snapshot: manifest nằm cùng Chroma để hai thứ luôn bị xoá/giữ cùng nhau,
+# chỉ mục BM25 (tìm theo từ khoá) được cập nhật cùng lúc với collection
+MANIFEST_NAME = "drive_manifest.json"
+LEXICAL_INDEX_NAME = "lexical_index.json"
+SNAPSHOT_INFO_NAME = "snapshot.json"
+SUPPORTED_EXTENSIONS = (".pdf", ".txt", ".docx")
+# Đổi cách chia chunk/gắn metadata -> tăng version để xử lý lại file cũ (embedding lấy từ cache)
+# 1: metadata tin đăng (listing_metadata.py), 2: start_index để ghép các chunk liền kề,
+# 3: đọc giá "X tỷ Y triệu" và dấu chấm phân cách hàng nghìn, 4: "ban" (bán) không còn là stopword
+CHUNK_METADATA_VERSION = 4
+# Số luồng tải song song và số tiến trình đọc/parse tài liệu
+DOWNLOAD_WORKERS = int(os.getenv("DRIVE_DOWNLOAD_WORKERS", "8"))
+PARSE_WORKERS = int(os.getenv("DRIVE_PARSE_WORKERS", str(os.cpu_count() or 1)))
+
+# ====================================================================
+# MANIFEST: Ghi nhớ trạng thái từng file Drive đã được embedding
+# { file_id: {"name", "modifiedTime", "md5Checksum", "path", "chunk_ids", "metadata_version"} }
+# ====================================================================
+
+def load_manifest(path: str) -> dict:
+    """Đọc manifest từ đĩa; trả về dict rỗng nếu chưa có hoặc bị hỏng."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"⚠️ Manifest bị hỏng, sẽ xây lại từ đầu: {e}")
+        return {}
+
+def save_manifest(manifest: dict, path: str):
+    """Ghi manifest theo kiểu atomic (ghi file tạm rồi os.replace)."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+def is_file_changed(file: dict, entry: dict | None) -> bool:
+    """So sánh metadata Drive hiện tại với bản ghi trong manifest."""
+    if not entry:
+        return True
+    # File Google Docs gốc không có md5Checksum -> chỉ dựa vào modifiedTime
+    return (
+        entry.get("modifiedTime") != file.get("modifiedTime")
+        or entry.get("md5Checksum") != file.get("md5Checksum")
+        # Cách chia chunk/gắn metadata đã đổi -> xử lý lại (embedding vẫn lấy từ cache)
+        or entry.get("metadata_version") != CHUNK_METADATA_VERSION
+    )
+
+def local_path_for(file: dict) -> str:
+    """Tên file cục bộ có tiền tố ID để hai file trùng tên không ghi đè nhau."""
+    return os.path.join(TEMP_DATA_DIR, f"{file['id']}_{file['name']}")
+
+def load_file_documents(filepath: str, filename: str) -> list:
+    """Đọc một file thành danh sách Document theo phần mở rộng."""
+    from langchain_community.document_loaders import PyPDFLoader, TextLoader, Docx2txtLoader
+
+    # Bổ sung kiểm tra size 0 byte để tránh lỗi Loader
+    if os.path.getsize(filepath) == 0:
+        return []
+    if filename.endswith(".pdf"):
+        return PyPDFLoader(filepath).load()
+    elif filename.endswith(".txt"):
+        return TextLoader(filepath).load()
+    elif filename.endswith(".docx"):
+        return Docx2txtLoader(filepath).load()
+    return []
+
+def remove_file_chunks(vectorstore: Chroma, file_id: str, entry: dict | None, lexical: BM25Index = None):
+    """Xoá toàn bộ chunk của một file khỏi collection (theo manifest và metadata)."""
+    ids = set((entry or {}).get("chunk_ids", []))
+    # Phòng trường hợp lần chạy trước bị dừng giữa chừng, manifest chưa kịp ghi
+    ids.update(vectorstore.get(where={"drive_file_id": file_id}).get("ids", []))
+    if ids:
+        vectorstore.delete(ids=list(ids))
+        if lexical is not None:
+            lexical.remove(ids)
+
+# ====================================================================
+# TẢI SONG SONG TỪ DRIVE VÀ PARSE BẰNG PROCESS POOL
+# ====================================================================
+
+# Client googleapiclient (httplib2) không thread-safe -> mỗi luồng một service
+_thread_local = threading.local()
+
+def get_thread_drive_service(creds):
+    if getattr(_thread_local, "drive_service", None) is None:
+        _thread_local.drive_service = build_drive_service(creds)
+    return _thread_local.drive_service
+
+def list_drive_files(drive_service) -> list:
+    """Liệt kê toàn bộ file trong thư mục, đi qua mọi trang (nextPageToken)."""
+    files, page_token = [], None
+    while True:
+        results = drive_service.files().list(
+            q=f"'{DRIVE_FOLDER_ID}' in parents and trashed=false",
+            fields="nextPageToken, files(id, name, modifiedTime, md5Checksum)",
+            pageSize=1000,
+            pageToken=page_token,
+        ).execute()
+        files.extend(results.get("files", []))
+        page_token = results.get("nextPageToken")
+        if not page_token:
+            return files
+
+def download_file(creds, file: dict) -> str:
+    """Tải một file về TEMP_DATA_DIR (chạy trong thread pool)."""
+    from googleapiclient.http import MediaIoBaseDownload
+
+    file_path = local_path_for(file)
+    request = get_thread_drive_service(creds).files().get_media(fileId=file["id"])
+    with io.FileIO(file_path, "wb") as fh:
+        downloader = MediaIoBaseDownload(fh, request)
+        done = False
+        while not done:
+            _, done = downloader.next_chunk()
+    print(f"   -> Đã tải: {file['name']}")
+    return file_path
+
+def download_files(creds, files: list) -> list:
+    with ThreadPoolExecutor(max_workers=max(1, DOWNLOAD_WORKERS)) as pool:
+        return list(pool.map(lambda f: download_file(creds, f), files))
+
+def parse_files(paths: list, names: list) -> list:
+    """Đọc tài liệu bằng nhiều tiến trình để việc trích xuất PDF dùng hết số core."""
+    if PARSE_WORKERS <= 1 or len(paths) <= 1:
+        return [load_file_documents(p, n) for p, n in zip(paths, names)]
+    # 'spawn' an toàn hơn 'fork' khi tiến trình cha đang chạy nhiều thread (uvicorn)
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=min(PARSE_WORKERS, len(paths)), mp_context=ctx) as pool:
+        return list(pool.map(load_file_documents, paths, names))
+
+def get_drive_credentials():
+    """Tạo credentials Google Drive từ biến môi trường GCP_CREDENTIALS_JSON."""
+    from google.oauth2 import service_account
+    from google.auth.credentials import AnonymousCredentials
+
+    if DRIVE_API_ENDPOINT and not JSON_CONTENT_CREDENTIALS:
+        # Fake Drive cục bộ (bench/): không cần xác thực
+        return AnonymousCredentials()
+
+    # === BƯỚC 1: TẠO FILE CREDENTIALS TỪ BIẾN MÔI TRƯỜNG (Thay thế API) ===
+    print("Bắt đầu: Tải file xác thực từ biến môi trường...")
+    
+    # 1a. Kiểm tra nội dung JSON
+    if not JSON_CONTENT_CREDENTIALS:
+        # Nếu biến môi trường bị thiếu, dừng ngay quá trình khởi tạo RAG
+        raise Exception("LỖI FATAL: Không tìm thấy biến môi trường GCP_CREDENTIALS_JSON.")
+        
+    # 1b. Ghi nội dung JSON vào file tạm /tmp/drive-folder-temp.json
+    try:
+        # Ghi file ở chế độ 'w' (write) để ghi nội dung JSON (string)
+        with open(SERVICE_ACCOUNT_FILE, "w") as f:
+            f.write(JSON_CONTENT_CREDENTIALS) 
+        print("Hoàn tất: Tạo file xác thực tạm thời thành công.")
+    except Exception as e:
+        # Nếu lỗi ghi file (ví dụ: lỗi I/O), dừng ngay
+        print(f"LỖI FATAL: Không thể ghi nội dung credentials vào file tạm: {e}")
+        raise e
+
+    # creds sẽ đọc file tạm /tmp/drive-folder-temp.json
+    return service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE)
+
+def build_drive_service(creds):
+    from googleapiclient.discovery import build
+
+    if DRIVE_API_ENDPOINT:
+        return build("drive", "v3", credentials=creds, client_options={"api_endpoint": DRIVE_API_ENDPOINT})
+    return build("drive", "v3", credentials=creds)
+
+@timed("ingest_total")
+def setup_vectorstore(persist_dir: str):
+    """
+    Tải file xác thực từ Biến Môi trường, tải tài liệu từ Google Drive, xử lý chúng
+    và trả về Vectorstore (ChromaDB) đã được khởi tạo.
+
+    Chỉ những file mới hoặc đã thay đổi (theo modifiedTime/md5Checksum trong
+    manifest) mới được tải và embedding lại; chunk của file bị xoá/thay đổi
+    được gỡ khỏi collection hiện có trong persist_dir.
+    """
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    manifest_file = os.path.join(persist_dir, MANIFEST_NAME)
+    lexical_file = os.path.join(persist_dir, LEXICAL_INDEX_NAME)
+    
+    # === BƯỚC 1, 2: Xác thực Google Drive ===
+    creds = get_drive_credentials()
+    print("Bắt đầu: Xác thực Google Drive...")
+    drive_service = build_drive_service(creds)
+    print("Hoàn tất: Xác thực Google Drive thành công.")
+
+    # === BƯỚC 3: SO SÁNH DANH SÁCH FILE DRIVE VỚI MANIFEST ===
+    os.makedirs(TEMP_DATA_DIR, exist_ok=True)
+    os.makedirs(persist_dir, exist_ok=True)
+    print(f"Bắt đầu: Liệt kê tài liệu trong Folder ID {DRIVE_FOLDER_ID}...")
+    timings = {}
+
+    t0 = time.perf_counter()
+    files = [f for f in list_drive_files(drive_service) if f["name"].endswith(SUPPORTED_EXTENSIONS)]
+    timings["list"] = time.perf_counter() - t0
+
+    # Cần đảm bảo rằng biến môi trường OPENAI_API_KEY đã được thiết lập.
+    # Embedding đi qua cache trên đĩa: đoạn văn trùng lặp không bị gọi API lại
+    embedding = get_embeddings()
+    # Mở collection đã có (nếu có) thay vì tạo lại từ đầu
+    vectorstore = Chroma(persist_directory=persist_dir, embedding_function=embedding)
+
+    manifest = load_manifest(manifest_file)
+    if manifest and len(vectorstore) == 0:
+        # Collection bị mất (ví dụ /tmp bị dọn) nhưng manifest còn -> bỏ manifest
+        print("⚠️ Collection rỗng nhưng manifest còn, sẽ embedding lại toàn bộ.")
+        manifest = {}
+
+    lexical = BM25Index.load(lexical_file)
+    if len(lexical) != len(vectorstore):
+        # Chưa có chỉ mục BM25 (lần đầu nâng cấp) hoặc lệch với collection -> dựng lại
+        print("   -> Dựng lại chỉ mục BM25 từ collection hiện có...")
+        lexical.rebuild_from(vectorstore)
+
+    current_ids = {f["id"] for f in files}
+    changed = [f for f in files if is_file_changed(f, manifest.get(f["id"]))]
+    deleted = [fid for fid in manifest if fid not in current_ids]
+    print(f"   -> {len(files)} file, {len(changed)} mới/thay đổi, {len(deleted)} đã xoá.")
+
+    # 3a. Gỡ chunk của file đã xoá khỏi Drive
+    for file_id in deleted:
+        entry = manifest.pop(file_id)
+        remove_file_chunks(vectorstore, file_id, entry, lexical)
+        if entry.get("path") and os.path.exists(entry["path"]):
+            os.remove(entry["path"])
+        print(f"   -> Đã gỡ: {entry.get('name')}")
+
+    if not changed:
+        save_manifest(manifest, manifest_file)
+        lexical.save()
+        print("✅ Hoàn tất: Không có tài liệu mới, dùng lại Vectorstore hiện có.")
+        return vectorstore
+
+    # === BƯỚC 4: TẢI SONG SONG CÁC FILE MỚI/THAY ĐỔI ===
+    print(f"Bắt đầu: Tải {len(changed)} file ({DOWNLOAD_WORKERS} luồng)...")
+    t0 = time.perf_counter()
+    paths = download_files(creds, changed)
+    timings["download"] = time.perf_counter() - t0
+
+    # === BƯỚC 5: PARSE (PROCESS POOL) VÀ CHIA NHỎ ===
+    print("Bắt đầu: Xử lý và chia nhỏ tài liệu...")
+    t0 = time.perf_counter()
+    docs_per_file = parse_files(paths, [f["name"] for f in changed])
+    timings["parse"] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    # start_index: vị trí chunk trong tài liệu, để context_builder ghép các chunk chồng lấn
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=300, chunk_overlap=50, add_start_index=True)
+    all_splits, all_ids = [], []
+    for file, path, docs in zip(changed, paths, docs_per_file):
+        splits = text_splitter.split_documents(docs)
+        chunk_ids = [f"{file['id']}:{i}" for i in range(len(splits))]
+        for doc in splits:
+            doc.metadata["drive_file_id"] = file["id"]
+        # Quận/phường, giá, diện tích, loại nhà, pháp lý -> metadata để lọc khi tìm kiếm
+        annotate_chunks(docs, splits)
+        # Xoá chunk cũ của file (nếu là file thay đổi) trước khi thêm chunk mới
+        remove_file_chunks(vectorstore, file["id"], manifest.get(file["id"]), lexical)
+        all_splits.extend(splits)
+        all_ids.extend(chunk_ids)
+        manifest[file["id"]] = {
+            "name": file["name"],
+            "modifiedTime": file.get("modifiedTime"),
+            "md5Checksum": file.get("md5Checksum"),
+            "path": path,
+            "chunk_ids": chunk_ids,
+            "metadata_version": CHUNK_METADATA_VERSION,
+        }
+    timings["split"] = time.perf_counter() - t0
+
+    # === BƯỚC 6: EMBEDDING MỘT LẦN CHO TẤT CẢ CHUNK MỚI (CACHE + THEO LÔ) ===
+    print(f"Bắt đầu: Embedding {len(all_splits)} đoạn văn...")
+    t0 = time.perf_counter()
+    if all_splits:
+        vectorstore.add_documents(all_splits, ids=all_ids)
+    timings["embed"] = time.perf_counter() - t0
+
+    # === BƯỚC 7: CẬP NHẬT CHỈ MỤC BM25 (CỤC BỘ, KHÔNG GỌI API) ===
+    t0 = time.perf_counter()
+    lexical.add(all_ids, all_splits)
+    timings["lexical"] = time.perf_counter() - t0
+    # Chỉ ghi manifest khi embedding xong; nếu lỗi giữa chừng lần sau sẽ làm lại
+    save_manifest(manifest, manifest_file)
+    lexical.save()
+
+    print("⏱️ Thời gian từng bước: " + ", ".join(f"{k}={v:.2f}s" for k, v in timings.items()))
+    for name, seconds in timings.items():
+        observe(f"ingest_{name}", seconds)
+    print(f"✅ Hoàn tất: Đã embedding {len(all_splits)} đoạn văn từ {len(changed)} file.")
+
+    return vectorstore
+
+# ====================================================================
+# SNAPSHOT: index được dựng vào snapshots/<version>/ rồi mới chuyển con trỏ
+# "current" (symlink, đổi bằng os.replace nên luôn atomic). Web app chỉ mở
+# snapshot để đọc; nhiều worker uvicorn dùng chung một bản trên đĩa.
+# ====================================================================
+
+def current_snapshot():
+    """Đường dẫn snapshot mà con trỏ "current" đang trỏ tới (None nếu chưa có)."""
+    if not os.path.islink(CURRENT_POINTER):
+        return None
+    path = os.path.realpath(CURRENT_POINTER)
+    return path if os.path.isdir(path) else None
+
+def read_snapshot_info(path: str) -> dict:
+    try:
+        with open(os.path.join(path, SNAPSHOT_INFO_NAME), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+@contextmanager
+def build_lock():
+    """Khoá file: mỗi thời điểm chỉ một tiến trình (CLI hoặc worker) dựng index."""
+    os.makedirs(CHROMA_DB_DIR, exist_ok=True)
+    with open(BUILD_LOCK_FILE, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def publish_snapshot(path: str):
+    """Chuyển con trỏ "current" sang snapshot mới (atomic)."""
+    tmp_link = f"{CURRENT_POINTER}.tmp-{os.getpid()}"
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    # Đường dẫn tương đối để cả thư mục index có thể được mount/di chuyển nguyên vẹn
+    os.symlink(os.path.relpath(path, CHROMA_DB_DIR), tmp_link)
+    os.replace(tmp_link, CURRENT_POINTER)
+
+def prune_snapshots(keep: int = INDEX_KEEP_SNAPSHOTS):
+    """Xoá snapshot cũ, giữ lại `keep` bản mới nhất và bản đang dùng."""
+    if not os.path.isdir(SNAPSHOTS_DIR):
+        return
+    current = current_snapshot()
+    names = sorted(os.listdir(SNAPSHOTS_DIR), reverse=True)
+    for name in names[max(keep, 1):]:
+        path = os.path.join(SNAPSHOTS_DIR, name)
+        if path != current:
+            shutil.rmtree(path, ignore_errors=True)
+
+def build_snapshot(force: bool = False, keep: int = INDEX_KEEP_SNAPSHOTS, drive_service=None) -> str:
+    """
+    Dựng snapshot mới và công bố nó. Mặc định sao chép snapshot hiện tại rồi cập nhật
+    tăng dần (chỉ file Drive mới/thay đổi); force=True dựng lại từ thư mục rỗng.
+    Nếu Drive không đổi so với snapshot hiện tại (và không force) thì không sao chép,
+    không công bố gì: trả về luôn snapshot hiện tại. Trả về đường dẫn snapshot đang dùng.
+    """
+    base = None if force else current_snapshot()
+    if base:
+        service = drive_service or build_drive_service(get_drive_credentials())
+        if not has_drive_changes(service, base):
+            print(f"✅ Drive không thay đổi, giữ snapshot {os.path.basename(base)}.")
+            return base
+    # Có mili giây: drive_watcher có thể dựng hai snapshot trong cùng một giây
+    now = time.time()
+    version = time.strftime("%Y%m%d-%H%M%S", time.localtime(now)) + f".{int(now * 1000) % 1000:03d}-{os.getpid()}"
+    path = os.path.join(SNAPSHOTS_DIR, version)
+    if base:
+        print(f"Bắt đầu: Sao chép snapshot {os.path.basename(base)} làm nền...")
+        shutil.copytree(base, path)
+    else:
+        os.makedirs(path)
+    try:
+        vectorstore = setup_vectorstore(path)
+        info = {"version": version, "built_at": time.time(), "chunks": len(vectorstore),
+                "base": os.path.basename(base) if base else None}
+        with open(os.path.join(path, SNAPSHOT_INFO_NAME), "w", encoding="utf-8") as f:
+            json.dump(info, f)
+    except Exception:
+        shutil.rmtree(path, ignore_errors=True)
+        raise
+    publish_snapshot(path)
+    prune_snapshots(keep)
+    print(f"✅ Snapshot {version} đã được công bố ({info['chunks']} chunk).")
+    return path
+
+def has_drive_changes(drive_service, snapshot_path: str | None) -> bool:
+    """So danh sách file Drive với manifest của snapshot (một lần files.list, không tải file)."""
+    if not snapshot_path:
+        return True
+    manifest = load_manifest(os.path.join(snapshot_path, MANIFEST_NAME))
+    files = [f for f in list_drive_files(drive_service) if f["name"].endswith(SUPPORTED_EXTENSIONS)]
+    if {f["id"] for f in files} != set(manifest):
+        return True
+    return any(is_file_changed(f, manifest[f["id"]]) for f in files)
+
+def open_snapshot(path: str):
+    """Mở snapshot để đọc: trả về (Chroma, BM25Index). Web app không ghi vào snapshot."""
+    vectorstore = Chroma(persist_directory=path, embedding_function=get_embeddings())
+    lexical = BM25Index.load(os.path.join(path, LEXICAL_INDEX_NAME))
+    return vectorstore, lexical
+
+# ====================================================================
+# TRẠNG THÁI INDEX: Vectorstore được mở trong task nền (xem main.lifespan),
+# không còn chạy lúc import để server nhận webhook ngay khi khởi động.
+# (vectorstore, chỉ mục BM25, snapshot) được thay bằng MỘT phép gán nên khi
+# hot-swap (drive_watcher.py) request đang chạy vẫn dùng trọn bộ bản cũ.
+# ====================================================================
+ACTIVE_INDEX = None
+INDEX_STATUS = {"state": "pending", "error": None, "started_at": None, "finished_at": None, "snapshot": None}
+
+def ensure_snapshot() -> str:
+    """
+    Trả về snapshot để mở. Với INDEX_BUILD_ON_STARTUP, worker đầu tiên lấy được khoá
+    sẽ đồng bộ với Drive; các worker đang chờ khoá dùng luôn snapshot vừa được dựng.
+    """
+    if not INDEX_BUILD_ON_STARTUP:
+        path = current_snapshot()
+        if path is None:
+            raise Exception(f"Chưa có snapshot trong {CHROMA_DB_DIR}; hãy chạy `python build_index.py`.")
+        return path
+    requested_at = time.time()
+    with build_lock():
+        path = current_snapshot()
+        if path and read_snapshot_info(path).get("built_at", 0) >= requested_at:
+            return path
+        return build_snapshot()
+
+def activate_snapshot(path: str):
+    """Mở snapshot và đổi index đang dùng sang nó; trả về bộ index trước đó (hoặc None)."""
+    global ACTIVE_INDEX
+    vectorstore, lexical = open_snapshot(path)
+    previous = ACTIVE_INDEX
+    ACTIVE_INDEX = (vectorstore, lexical, path)
+    INDEX_STATUS.update(snapshot=os.path.basename(path))
+    return previous
+
+def release_index(index):
+    """Giải phóng Chroma của snapshot cũ (gọi khi request dùng bản cũ đã xong)."""
+    from chromadb.api.client import SharedSystemClient
+
+    vectorstore, _, path = index
+    if ACTIVE_INDEX is not None and ACTIVE_INDEX[2] == path:
+        return
+    system = SharedSystemClient._identifer_to_system.pop(vectorstore._client._identifier, None)
+    if system is not None:
+        system.stop()
+
+def init_vectorstore():
+    """Mở snapshot hiện tại (dựng nếu cần) và cập nhật INDEX_STATUS (gọi từ thread nền)."""
+    INDEX_STATUS.update(state="building", error=None, started_at=time.time(), finished_at=None)
+    try:
+        activate_snapshot(ensure_snapshot())
+        INDEX_STATUS.update(state="ready", finished_at=time.time())
+    except Exception as e:
+        INDEX_STATUS.update(state="failed", error=str(e), finished_at=time.time())
+        raise
+    return get_vectorstore()
+
+def is_ready() -> bool:
+    return INDEX_STATUS["state"] == "ready" and ACTIVE_INDEX is not None
+
+def get_index_status() -> dict:
+    return dict(INDEX_STATUS)
+
+def get_index():
+    """(vectorstore, chỉ mục BM25) đang dùng, đọc cùng một lúc; (None, None) nếu chưa sẵn sàng."""
+    index = ACTIVE_INDEX
+    return (index[0], index[1]) if index else (None, None)
+
+def active_snapshot_path():
+    index = ACTIVE_INDEX
+    return index[2] if index else None
+
+# Hàm getter để main.py có thể truy cập vectorstore
+def get_vectorstore():
+    return get_index()[0]
+
+def get_lexical_index():
+    return get_index()[1]
@@ -0,0 +1,195 @@
+# ====================================================================
+# FILE: drive_watcher.py - Theo dõi thay đổi trên Google Drive (changes.list)
+# và hot-swap index đang dùng sang snapshot mới mà không downtime
+# ====================================================================
+import os
+import json
+import time
+import fcntl
+import asyncio
+import logging
+
+import drive
+from metrics import stage
+
+logger = logging.getLogger(__name__)
+
+# ==== Cấu hình ====
+DRIVE_WATCH_ENABLED = os.getenv("DRIVE_WATCH_ENABLED", "true").lower() == "true"
+# Chu kỳ hỏi Drive "có gì thay đổi từ page token trước?" (một request nhỏ nếu không có gì)
+DRIVE_WATCH_INTERVAL_SECONDS = float(os.getenv("DRIVE_WATCH_INTERVAL_SECONDS", "60"))
+# Chu kỳ mỗi worker kiểm tra con trỏ "current" để chuyển sang snapshot mới (chỉ đọc symlink)
+INDEX_RELOAD_INTERVAL_SECONDS = float(os.getenv("INDEX_RELOAD_INTERVAL_SECONDS", "10"))
+# Giữ snapshot cũ mở thêm chừng này giây để request đang chạy trên nó kết thúc
+INDEX_SWAP_GRACE_SECONDS = float(os.getenv("INDEX_SWAP_GRACE_SECONDS", "120"))
+# Page token của changes.list được lưu cạnh các snapshot (dùng chung cho mọi worker)
+CHANGES_TOKEN_FILE = os.path.join(drive.CHROMA_DB_DIR, "drive_changes_token.json")
+WATCH_LOCK_FILE = os.path.join(drive.CHROMA_DB_DIR, ".watch.lock")
+
+
+def load_page_token():
+    try:
+        with open(CHANGES_TOKEN_FILE, "r", encoding="utf-8") as f:
+            return json.load(f).get("page_token")
+    except (OSError, ValueError):
+        return None
+
+def save_page_token(token: str):
+    tmp_path = CHANGES_TOKEN_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"page_token": token, "saved_at": time.time()}, f)
+    os.replace(tmp_path, CHANGES_TOKEN_FILE)
+
+def list_changes(drive_service, page_token: str):
+    """Mọi thay đổi kể từ page_token (đi qua mọi trang); trả về (changes, token kế tiếp)."""
+    changes = []
+    while True:
+        result = drive_service.changes().list(
+            pageToken=page_token,
+            fields="nextPageToken, newStartPageToken, "
+                   "changes(fileId, removed, file(id, name, parents, trashed, modifiedTime, md5Checksum))",
+            includeRemoved=True,
+            pageSize=1000,
+        ).execute()
+        changes.extend(result.get("changes", []))
+        if "newStartPageToken" in result:
+            return changes, result["newStartPageToken"]
+        page_token = result["nextPageToken"]
+
+def is_relevant(change: dict, known_ids) -> bool:
+    """Thay đổi chạm tới file đã có trong index hoặc file hỗ trợ trong thư mục đang theo dõi."""
+    if change.get("fileId") in known_ids:
+        return True
+    file = change.get("file") or {}
+    return (drive.DRIVE_FOLDER_ID in file.get("parents", [])
+            and file.get("name", "").endswith(drive.SUPPORTED_EXTENSIONS))
+
+
+class DriveWatcher:
+    """
+    Hai việc trong cùng một vòng lặp nền:
+    - Một worker duy nhất (giữ khoá WATCH_LOCK_FILE) hỏi Drive changes.list; có thay đổi
+      liên quan thì dựng snapshot mới tăng dần (bản sao của snapshot hiện tại) và công bố.
+    - Mọi worker theo dõi con trỏ "current"; đổi thì mở snapshot mới rồi thay index
+      đang dùng bằng một phép gán. Bản cũ được đóng sau INDEX_SWAP_GRACE_SECONDS.
+    """
+
+    def __init__(self):
+        self._task = None
+        self._lock_file = None
+        self._drive_service = None
+        self._next_poll = 0.0
+        self._retired = []  # [(thời điểm được đóng, index cũ)]
+        self._stats = {"leader": False, "polls": 0, "changes": 0, "rebuilds": 0,
+                       "swaps": 0, "released": 0, "errors": 0, "last_poll_at": None}
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+            self._stats["leader"] = False
+
+    # ---------- Vòng lặp nền ----------
+    async def _run(self):
+        while True:
+            await asyncio.sleep(INDEX_RELOAD_INTERVAL_SECONDS)
+            if not drive.is_ready():
+                # Lần tải đầu do main.build_index_in_background đảm nhận
+                continue
+            try:
+                if DRIVE_WATCH_ENABLED and time.monotonic() >= self._next_poll and self._is_leader():
+                    self._next_poll = time.monotonic() + DRIVE_WATCH_INTERVAL_SECONDS
+                    await asyncio.to_thread(self.poll_drive)
+                await asyncio.to_thread(self.reload_index)
+                self._release_retired()
+            except Exception as e:
+                self._stats["errors"] += 1
+                logger.error(f"❌ Lỗi theo dõi Drive/hot-swap index: {e}")
+
+    def _is_leader(self) -> bool:
+        """Khoá không chờ: worker đầu tiên lấy được sẽ giữ vai trò hỏi Drive cho tới khi dừng."""
+        if self._lock_file is None:
+            os.makedirs(drive.CHROMA_DB_DIR, exist_ok=True)
+            lock_file = open(WATCH_LOCK_FILE, "w")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                return False
+            self._lock_file = lock_file
+            self._stats["leader"] = True
+            logger.info("👀 Worker này theo dõi thay đổi trên Google Drive.")
+        return True
+
+    # ---------- Hỏi Drive ----------
+    def poll_drive(self) -> bool:
+        """Một lượt changes.list; dựng và công bố snapshot mới nếu cần. Trả về True nếu đã dựng."""
+        if self._drive_service is None:
+            self._drive_service = drive.build_drive_service(drive.get_drive_credentials())
+        service = self._drive_service
+        self._stats["polls"] += 1
+        self._stats["last_poll_at"] = time.time()
+
+        with stage("drive_watch_poll"):
+            token = load_page_token()
+            if token is None:
+                # Lần đầu: lấy token TRƯỚC khi so với Drive để không lỡ thay đổi xảy ra ở giữa
+                token = service.changes().getStartPageToken().execute()["startPageToken"]
+                relevant = True
+            else:
+                changes, token = list_changes(service, token)
+                known_ids = set(drive.load_manifest(
+                    os.path.join(drive.current_snapshot() or "", drive.MANIFEST_NAME)))
+                relevant = [c for c in changes if is_relevant(c, known_ids)]
+                self._stats["changes"] += len(relevant)
+
+        rebuilt = False
+        if relevant:
+            with drive.build_lock():
+                # Đổi tên/di chuyển file không làm nội dung thay đổi -> build_snapshot giữ bản cũ
+                previous = drive.current_snapshot()
+                with stage("drive_watch_rebuild"):
+                    rebuilt = drive.build_snapshot(drive_service=service) != previous
+                if rebuilt:
+                    logger.info("🔄 Drive có thay đổi, đã dựng snapshot mới (tăng dần).")
+                    self._stats["rebuilds"] += 1
+        # Chỉ lưu token khi đã xử lý xong: lỗi giữa chừng -> lượt sau đọc lại các thay đổi này
+        save_page_token(token)
+        return rebuilt
+
+    # ---------- Hot-swap ----------
+    def reload_index(self) -> bool:
+        """Chuyển sang snapshot mà "current" đang trỏ tới nếu khác bản đang dùng."""
+        path = drive.current_snapshot()
+        if path is None or path == drive.active_snapshot_path():
+            return False
+        previous = drive.activate_snapshot(path)
+        self._stats["swaps"] += 1
+        logger.info(f"♻️ Đã chuyển index sang snapshot {os.path.basename(path)}.")
+        if previous is not None:
+            self._retired.append((time.monotonic() + INDEX_SWAP_GRACE_SECONDS, previous))
+        return True
+
+    def _release_retired(self):
+        now = time.monotonic()
+        while self._retired and self._retired[0][0] <= now:
+            _, index = self._retired.pop(0)
+            try:
+                drive.release_index(index)
+                self._stats["released"] += 1
+            except Exception as e:
+                logger.warning(f"⚠️ Không đóng được snapshot cũ {index[2]}: {e}")
+
+    def stats(self) -> dict:
+        return {**self._stats, "snapshot": os.path.basename(drive.active_snapshot_path() or ""),
+                "retired_pending": len(self._retired)}
+
+
+DRIVE_WATCHER = DriveWatcher()
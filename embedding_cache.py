@@ -0,0 +1,152 @@
+# ====================================================================
+# FILE: embedding_cache.py - Cache Embedding trên đĩa (SQLite) + gọi theo lô
+# ====================================================================
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+
+logger = logging.getLogger(__name__)
+
+# ==== Cấu hình ====
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "/tmp/embedding_cache.sqlite3")
+EMBEDDING_MODEL = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-ada-002")
+# Một lô bị giới hạn cả theo số đoạn lẫn tổng số ký tự (xấp xỉ số token)
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "256"))
+EMBEDDING_BATCH_MAX_CHARS = int(os.getenv("EMBEDDING_BATCH_MAX_CHARS", "200000"))
+EMBEDDING_MAX_WORKERS = int(os.getenv("EMBEDDING_MAX_WORKERS", "4"))
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", "5"))
+# Tắt khi chạy offline (bench/): bỏ bước tokenize bằng tiktoken (cần tải bộ mã hoá)
+EMBEDDING_CHECK_CTX_LENGTH = os.getenv("EMBEDDING_CHECK_CTX_LENGTH", "true").lower() == "true"
+
+
+def cache_key(model: str, text: str) -> str:
+    """Khoá cache = sha256(tên model + nội dung đoạn văn)."""
+    return hashlib.sha256(f"{model}\x00{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Kho vector float32 trong SQLite, an toàn khi dùng từ nhiều thread."""
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get_many(self, keys: list) -> dict:
+        found = {}
+        with self._lock:
+            # SQLite giới hạn số tham số trong một câu lệnh -> chia nhỏ
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                placeholders = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", part
+                ).fetchall()
+                for key, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+        return found
+
+    def put_many(self, items: dict):
+        rows = [(key, array("f", vector).tobytes()) for key, vector in items.items()]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", rows
+            )
+            self._conn.commit()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Bọc OpenAIEmbeddings bằng cache trên đĩa. Chỉ những đoạn chưa có trong
+    cache mới được gửi lên API, theo lô lớn, song song có giới hạn và có retry.
+    """
+
+    def __init__(self, inner: Embeddings = None, cache: EmbeddingCache = None, model: str = EMBEDDING_MODEL):
+        self.model = model
+        self.inner = inner or OpenAIEmbeddings(model=model, check_embedding_ctx_length=EMBEDDING_CHECK_CTX_LENGTH)
+        self.cache = cache or EmbeddingCache()
+        self.stats = {"hits": 0, "misses": 0, "api_calls": 0}
+
+    def _make_batches(self, texts: list) -> list:
+        batches, current, current_chars = [], [], 0
+        for text in texts:
+            if current and (len(current) >= EMBEDDING_BATCH_SIZE
+                            or current_chars + len(text) > EMBEDDING_BATCH_MAX_CHARS):
+                batches.append(current)
+                current, current_chars = [], 0
+            current.append(text)
+            current_chars += len(text)
+        if current:
+            batches.append(current)
+        return batches
+
+    def _embed_batch(self, batch: list) -> list:
+        for attempt in range(EMBEDDING_MAX_RETRIES):
+            try:
+                self.stats["api_calls"] += 1
+                if not EMBEDDING_CHECK_CTX_LENGTH and isinstance(self.inner, OpenAIEmbeddings):
+                    # Khi bỏ tokenize, langchain gửi từng đoạn một -> tự gửi cả lô
+                    # (chunk 300 ký tự luôn nằm trong giới hạn context của model)
+                    response = self.inner.client.create(input=batch, model=self.model)
+                    return [item.embedding for item in response.data]
+                return self.inner.embed_documents(batch)
+            except Exception as e:
+                if attempt == EMBEDDING_MAX_RETRIES - 1:
+                    raise
+                delay = min(2 ** attempt, 30)
+                logger.warning(f"⚠️ Lỗi gọi Embedding API (lần {attempt + 1}), thử lại sau {delay}s: {e}")
+                time.sleep(delay)
+
+    def embed_documents(self, texts: list) -> list:
+        keys = [cache_key(self.model, t) for t in texts]
+        found = self.cache.get_many(list(set(keys)))
+
+        # Gom các đoạn chưa có trong cache (bỏ trùng lặp trong cùng lần gọi)
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        self.stats["hits"] += len(texts) - len(missing)
+        self.stats["misses"] += len(missing)
+
+        if missing:
+            batches = self._make_batches(list(missing.values()))
+            with ThreadPoolExecutor(max_workers=max(1, min(EMBEDDING_MAX_WORKERS, len(batches)))) as pool:
+                results = list(pool.map(self._embed_batch, batches))
+            vectors = [v for batch_vectors in results for v in batch_vectors]
+            new_items = dict(zip(missing.keys(), vectors))
+            self.cache.put_many(new_items)
+            found.update(new_items)
+
+        return [found[key] for key in keys]
+
+    def embed_query(self, text: str) -> list:
+        # Câu hỏi lặp lại của khách hàng sẽ không phải gọi API lần nữa
+        return self.embed_documents([text])[0]
+
+
+_EMBEDDINGS = None
+_EMBEDDINGS_LOCK = threading.Lock()
+
+def get_embeddings() -> CachedEmbeddings:
+    """Trả về đối tượng CachedEmbeddings dùng chung cho cả ingest và truy vấn."""
+    global _EMBEDDINGS
+    with _EMBEDDINGS_LOCK:
+        if _EMBEDDINGS is None:
+            _EMBEDDINGS = CachedEmbeddings()
+        return _EMBEDDINGS
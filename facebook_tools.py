@@ -1,139 +1,202 @@
-# ====================================================================
-# FILE: facebook_tools.py - Xử lý Graph API và Webhook Logic
-# ====================================================================
-import requests
-import os
-import logging 
-from dotenv import load_dotenv
-
-
-# Thiết lập logging
-logger = logging.getLogger(__name__)
-
-# ====================================================================
-# 1. GRAPH API TOOLS (Các hàm gọi API Facebook)
-# ====================================================================
-
-# Cần truyền access_token và page_id vào hàm
-def get_page_info(page_id: str, access_token: str) -> dict:
-    """Lấy thông tin Page cụ thể bằng ID và Access Token (Cần truyền từ main.py)."""
-    url = f"https://graph.facebook.com/v19.0/{page_id}"
-    params = {
-        "access_token": access_token, # SỬ DỤNG tham số access_token
-        "fields": "name,fan_count,about"
-    }
-    try:
-        res = requests.get(url, params=params, timeout=5)
-        res.raise_for_status() # Báo lỗi nếu status code không phải 2xx
-        data = res.json()
-        if "error" in data:
-            logger.error(f"Lỗi lấy thông tin Page {page_id}: {data['error']['message']}")
-        return data
-    except requests.exceptions.RequestException as e:
-        logger.error(f"❌ Lỗi mạng khi lấy thông tin Page {page_id}: {e}")
-        return {"error": str(e)}
-
-# Cần truyền access_token và page_id vào hàm
-def get_latest_posts(page_id: str, access_token: str, limit=3) -> dict:
-    """Lấy các bài đăng mới nhất (Cần truyền từ main.py)."""
-    url = f"https://graph.facebook.com/v19.0/{page_id}/posts"
-    params = {
-        "access_token": access_token, # SỬ DỤNG tham số access_token
-        "limit": limit,
-        "fields": "message,created_time"
-    }
-    try:
-        res = requests.get(url, params=params, timeout=5)
-        res.raise_for_status()
-        data = res.json()
-        if "error" in data:
-            logger.error(f"Lỗi lấy bài đăng Page {page_id}: {data['error']['message']}")
-        return data
-    except requests.exceptions.RequestException as e:
-        logger.error(f"❌ Lỗi mạng khi lấy bài đăng Page {page_id}: {e}")
-        return {"error": str(e)}
-
-# Cần truyền access_token vào hàm
-def reply_comment(comment_id: str, message: str, access_token: str) -> dict:
-    """Phản hồi một bình luận (Cần truyền từ main.py)."""
-    url = f"https://graph.facebook.com/v19.0/{comment_id}/comments"
-    params = {"access_token": access_token} # SỬ DỤNG tham số access_token
-    data = {"message": message}
-    try:
-        response = requests.post(url, params=params, data=data, timeout=5)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        logger.error(f"❌ Lỗi phản hồi bình luận {comment_id}: {e}")
-        return {"error": str(e)}
-
-# ====================================================================
-# 2. XỬ LÝ PAYLOAD WEBHOOK VÀ GHI DB
-# (Hàm này giữ nguyên cấu trúc cũ, chỉ dùng logging thay vì print)
-# ====================================================================
-
-def handle_webhook_data(data: dict, php_connect_url: str):
-    """
-    Trích xuất dữ liệu từ payload webhook và gửi tới connect.php.
-
-    Args:
-        data (dict): Dữ liệu JSON từ webhook POST request.
-        php_connect_url (str): URL của endpoint PHP để ghi DB.
-    """
-    
-    # Lọc dữ liệu: Chỉ xử lý sự kiện 'page'
-    if data.get('object') != 'page' or not data.get('entry'):
-        return
-
-    for entry in data['entry']:
-        # Lấy ID Page ngay ở đây để so sánh sau này
-        idpage = entry.get('id')
-
-        for change in entry.get('changes', []):
-            # Lọc sự kiện bình luận (comment) trong trường 'feed'
-            if change.get('field') == 'feed' and change.get('value', {}).get('item') == 'comment':
-                value = change['value']
-                
-                # --- 1. Trích xuất dữ liệu ---
-                idcomment = value.get('comment_id')
-                idpost = value.get('post_id')
-                idpersion = value.get('from', {}).get('id') # ID người comment
-                message = value.get('message', '').strip()
-                creatime = value.get('created_time') 
-                
-                # >>>>>> KIỂM TRA MỚI: BỎ QUA BÌNH LUẬN TỪ CHÍNH PAGE <<<<<<
-                if idpersion == idpage:
-                    logger.info(f"⏭️ Bỏ qua bình luận tự động của Page ID {idpage} để tránh vòng lặp.")
-                    continue
-                # >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
-                
-                # Bỏ qua nếu thiếu nội dung hoặc sự kiện không hợp lệ
-                if not message or not idcomment or idcomment == idpost:
-                    continue
-                    
-                # --- 2. Chuẩn bị Payload cho connect.php ---
-                db_payload = {
-                    "idpage": idpage,
-                    "idpersion": idpersion,
-                    "idpost": idpost,
-                    "idcomment": idcomment,
-                    "message": message,
-                    "creatime": creatime,
-                    "status": "PENDING",     
-                    "is_replied": 0,     
-                    "ai_response": None,
-                    "processed_at": None
-                }
-
-                # --- 3. Gửi yêu cầu POST tới connect.php ---
-                try:
-                    response = requests.post(php_connect_url, json=db_payload, timeout=5)
-                    
-                    if response.status_code == 200 and response.json().get('status') == 'success':
-                        logger.info(f"✅ Bình luận ID {idcomment} đã được ghi thành công qua PHP.")
-                    else:
-                        logger.error(f"❌ Lỗi ghi DB qua PHP. Code: {response.status_code}, Res: {response.text}")
-                except requests.exceptions.RequestException as e:
-                    logger.error(f"❌ Lỗi mạng khi gửi tới PHP: {e}")
-
-# ====================================================================
+# ====================================================================
+# FILE: facebook_tools.py - Xử lý Graph API và Webhook Logic
+# ====================================================================
+import httpx
+import asyncio
+import os
+import logging 
+from dotenv import load_dotenv
+
+from async_cache import AsyncTTLCache
+
+
+# Thiết lập logging
+logger = logging.getLogger(__name__)
+
+# ==== Cấu hình HTTP ====
+GRAPH_API_BASE = os.getenv("GRAPH_API_BASE", "https://graph.facebook.com/v19.0")
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "5"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3"))
+GRAPH_MAX_CONCURRENCY = int(os.getenv("GRAPH_MAX_CONCURRENCY", "10"))
+PHP_MAX_CONCURRENCY = int(os.getenv("PHP_MAX_CONCURRENCY", "5"))
+# Thời gian cache (giây) cho thông tin Page và danh sách bài đăng
+PAGE_INFO_TTL = float(os.getenv("PAGE_INFO_TTL", "300"))
+PAGE_POSTS_TTL = float(os.getenv("PAGE_POSTS_TTL", "60"))
+# Sau khi hết TTL vẫn trả bản cũ thêm chừng này giây, trong lúc làm mới ở nền
+GRAPH_CACHE_STALE_TTL = float(os.getenv("GRAPH_CACHE_STALE_TTL", "600"))
+
+# ====================================================================
+# 0. HTTP CLIENT BẤT ĐỒNG BỘ DÙNG CHUNG CHO TỪNG UPSTREAM
+# ====================================================================
+
+class UpstreamClient:
+    """
+    Một httpx.AsyncClient keep-alive dùng chung cho một upstream (Graph API hoặc PHP),
+    kèm semaphore giới hạn số request song song tới host đó.
+    """
+
+    def __init__(self, name: str, max_concurrency: int, timeout: float = HTTP_TIMEOUT):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.timeout = httpx.Timeout(timeout, connect=HTTP_CONNECT_TIMEOUT)
+        self._client = None
+        self._semaphore = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Tạo lười (lazy) để client gắn với event loop đang chạy của uvicorn
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency,
+                    max_keepalive_connections=self.max_concurrency,
+                ),
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        client = self.client
+        async with self._semaphore:
+            return await client.request(method, url, **kwargs)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+GRAPH_HTTP = UpstreamClient("graph", GRAPH_MAX_CONCURRENCY)
+PHP_HTTP = UpstreamClient("php", PHP_MAX_CONCURRENCY)
+
+async def aclose_http_clients():
+    """Đóng các client dùng chung (gọi khi tắt ứng dụng)."""
+    await GRAPH_HTTP.aclose()
+    await PHP_HTTP.aclose()
+
+# ====================================================================
+# 1. GRAPH API TOOLS (Các hàm gọi API Facebook)
+# ====================================================================
+
+# Mọi lời gọi đi qua GRAPH_HTTP (timeout + giới hạn song song dùng chung); phản hồi
+# bình luận gửi qua reply_dispatcher.ReplyDispatcher (Graph API batch)
+
+async def aget_page_info(page_id: str, access_token: str) -> dict:
+    """Lấy thông tin Page (tên, số người theo dõi, giới thiệu)."""
+    params = {"access_token": access_token, "fields": "name,fan_count,about"}
+    try:
+        res = await GRAPH_HTTP.request("GET", f"{GRAPH_API_BASE}/{page_id}", params=params)
+        res.raise_for_status()
+        data = res.json()
+        if "error" in data:
+            logger.error(f"Lỗi lấy thông tin Page {page_id}: {data['error']['message']}")
+        return data
+    except httpx.HTTPError as e:
+        logger.error(f"❌ Lỗi mạng khi lấy thông tin Page {page_id}: {e}")
+        return {"error": str(e)}
+
+async def aget_latest_posts(page_id: str, access_token: str, limit=3) -> dict:
+    """Lấy các bài đăng mới nhất của Page."""
+    params = {"access_token": access_token, "limit": limit, "fields": "message,created_time"}
+    try:
+        res = await GRAPH_HTTP.request("GET", f"{GRAPH_API_BASE}/{page_id}/posts", params=params)
+        res.raise_for_status()
+        data = res.json()
+        if "error" in data:
+            logger.error(f"Lỗi lấy bài đăng Page {page_id}: {data['error']['message']}")
+        return data
+    except httpx.HTTPError as e:
+        logger.error(f"❌ Lỗi mạng khi lấy bài đăng Page {page_id}: {e}")
+        return {"error": str(e)}
+
+# --- Bản có cache (dùng cho các endpoint bị gọi thường xuyên) ---
+
+GRAPH_CACHE = AsyncTTLCache(ttl=PAGE_INFO_TTL, stale_ttl=GRAPH_CACHE_STALE_TTL)
+
+def _is_cacheable(data: dict) -> bool:
+    # Không cache phản hồi lỗi để lần sau thử gọi lại
+    return isinstance(data, dict) and "error" not in data
+
+async def aget_page_info_cached(page_id: str, access_token: str) -> tuple:
+    """Trả về (data, age_seconds) của aget_page_info qua cache TTL + stale-while-revalidate."""
+    return await GRAPH_CACHE.get(
+        ("page_info", page_id), lambda: aget_page_info(page_id, access_token),
+        ttl=PAGE_INFO_TTL, is_cacheable=_is_cacheable,
+    )
+
+async def aget_latest_posts_cached(page_id: str, access_token: str, limit=3) -> tuple:
+    """Trả về (data, age_seconds) của aget_latest_posts qua cache TTL + stale-while-revalidate."""
+    return await GRAPH_CACHE.get(
+        ("page_posts", page_id, limit), lambda: aget_latest_posts(page_id, access_token, limit),
+        ttl=PAGE_POSTS_TTL, is_cacheable=_is_cacheable,
+    )
+
+# ====================================================================
+# 2. XỬ LÝ PAYLOAD WEBHOOK VÀ GHI DB
+# (ghi DB qua php_batcher.PhpWriteBatcher)
+# ====================================================================
+
+def parse_comment_events(data: dict) -> list:
+    """
+    Duyệt payload webhook MỘT LẦN và trả về danh sách bình luận hợp lệ
+    (đã bỏ bình luận của chính Page và sự kiện thiếu nội dung).
+
+    Mỗi phần tử là dict: idpage, idpersion, idpost, idcomment, message, creatime,
+    message_tags (None nếu webhook không gửi).
+    """
+    comments = []
+
+    # Lọc dữ liệu: Chỉ xử lý sự kiện 'page'
+    if data.get('object') != 'page' or not data.get('entry'):
+        return comments
+
+    for entry in data['entry']:
+        # Lấy ID Page ngay ở đây để so sánh sau này
+        idpage = entry.get('id')
+
+        for change in entry.get('changes', []):
+            # Lọc sự kiện bình luận (comment) trong trường 'feed'
+            if change.get('field') == 'feed' and change.get('value', {}).get('item') == 'comment':
+                value = change['value']
+                
+                # --- 1. Trích xuất dữ liệu ---
+                idcomment = value.get('comment_id')
+                idpost = value.get('post_id')
+                idpersion = value.get('from', {}).get('id') # ID người comment
+                message = (value.get('message') or '').strip()
+                creatime = value.get('created_time') 
+                
+                # >>>>>> KIỂM TRA MỚI: BỎ QUA BÌNH LUẬN TỪ CHÍNH PAGE <<<<<<
+                if idpersion == idpage:
+                    logger.info(f"⏭️ Bỏ qua bình luận tự động của Page ID {idpage} để tránh vòng lặp.")
+                    continue
+                # >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
+                
+                # Bỏ qua nếu thiếu nội dung hoặc sự kiện không hợp lệ
+                if not message or not idcomment or idcomment == idpost:
+                    continue
+
+                comments.append({
+                    "idpage": idpage,
+                    "idpersion": idpersion,
+                    "idpost": idpost,
+                    "idcomment": idcomment,
+                    "message": message,
+                    "creatime": creatime,
+                    "message_tags": value.get('message_tags'),
+                })
+    return comments
+
+def build_db_payload(comment: dict) -> dict:
+    """--- Chuẩn bị Payload cho connect.php ---"""
+    # message_tags chỉ dùng để phân loại, không ghi vào DB
+    return {
+        **{k: v for k, v in comment.items() if k != "message_tags"},
+        "status": "PENDING",     
+        "is_replied": 0,     
+        "ai_response": None,
+        "processed_at": None
+    }
+
+# ====================================================================
@@ -0,0 +1,344 @@
+# ====================================================================
+# FILE: job_queue.py - Hàng đợi công việc bền vững (SQLite WAL) + worker pool
+# ====================================================================
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import asyncio
+import logging
+import threading
+
+from metrics import observe, trace
+
+logger = logging.getLogger(__name__)
+
+# ==== Cấu hình ====
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", "/tmp/job_queue.sqlite3")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_RETRY_BASE_SECONDS = float(os.getenv("JOB_RETRY_BASE_SECONDS", "5"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1"))
+# Job 'running' quá thời hạn thuê (worker chết/treo) được đưa lại hàng đợi; handler bị
+# huỷ sau JOB_HANDLER_TIMEOUT_SECONDS, trước khi hết hạn thuê để không chạy song song bản retry
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "300"))
+JOB_HANDLER_TIMEOUT_SECONDS = float(os.getenv("JOB_HANDLER_TIMEOUT_SECONDS", "240"))
+
+# Chủ job đang chạy: nhiều worker uvicorn (tiến trình) dùng chung một file hàng đợi.
+# Có boot id để tiến trình mới trùng pid với tiến trình đã chết không bị nhầm là chủ cũ.
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class JobDeferred(Exception):
+    """Handler chưa thể chạy lúc này (ví dụ index chưa sẵn sàng): hoãn lại, không tính là lỗi."""
+
+    def __init__(self, delay: float = JOB_POLL_SECONDS * 5, reason: str = ""):
+        super().__init__(reason)
+        self.delay = delay
+
+
+def _owner_alive(owner: str, me: str) -> bool:
+    """Chủ job (host:pid:boot, cùng máy) còn sống không."""
+    try:
+        pid = int(owner.rsplit(":", 2)[1])
+    except (IndexError, ValueError):
+        return False
+    if pid == os.getpid():
+        return owner == me
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobQueue:
+    """
+    Hàng đợi lưu trong SQLite (chế độ WAL) nên không mất job khi redeploy/crash.
+    Trạng thái job: queued -> running -> (xoá khi xong) | queued (retry) | failed.
+    Job 'running' thuộc về một tiến trình (owner, claimed_at) trong JOB_LEASE_SECONDS.
+    """
+
+    def __init__(self, path: str = JOB_QUEUE_PATH, lease: float = JOB_LEASE_SECONDS, owner: str = WORKER_ID):
+        self.lease = lease
+        self.owner = owner
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        # isolation_level=None: tự quản lý transaction bằng BEGIN IMMEDIATE
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL,
+                available_at REAL NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                last_error TEXT,
+                coalesce_key TEXT,
+                owner TEXT,
+                claimed_at REAL
+            )
+        """)
+        # Hàng đợi tạo từ phiên bản trước chưa có các cột mới
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        for column, kind in (("coalesce_key", "TEXT"), ("owner", "TEXT"), ("claimed_at", "REAL")):
+            if column not in columns:
+                try:
+                    self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+                except sqlite3.OperationalError:
+                    pass  # Worker khác vừa thêm cột
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs (status, available_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_coalesce ON jobs (kind, coalesce_key, status)")
+        self.coalesced = 0
+
+    def enqueue(self, kind: str, payload: dict, delay: float = 0, max_attempts: int = JOB_MAX_ATTEMPTS) -> int:
+        now = time.time()
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO jobs (kind, payload, max_attempts, available_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, json.dumps(payload, ensure_ascii=False), max_attempts, now + delay, now, now),
+            )
+            return cur.lastrowid
+
+    def enqueue_coalesced(self, kind: str, key: str, payload: dict, merge, window: float, max_wait: float,
+                          max_attempts: int = JOB_MAX_ATTEMPTS):
+        """
+        Gộp vào job cùng `kind`/`key` đang chờ và chưa chạy lần nào: payload = merge(cũ, mới),
+        lùi thời điểm chạy tới `window` giây sau job mới nhất nhưng không quá `max_wait`
+        giây kể từ job đầu tiên. Không có job như vậy -> tạo job mới chạy sau `window` giây.
+        Trả về (job_id, True nếu đã gộp).
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT id, payload, created_at FROM jobs "
+                    "WHERE kind = ? AND coalesce_key = ? AND status = 'queued' AND attempts = 0 "
+                    "ORDER BY id DESC LIMIT 1",
+                    (kind, key),
+                ).fetchone()
+                if row:
+                    job_id, merged = row[0], True
+                    self._conn.execute(
+                        "UPDATE jobs SET payload = ?, available_at = ?, updated_at = ? WHERE id = ?",
+                        (json.dumps(merge(json.loads(row[1]), payload), ensure_ascii=False),
+                         min(now + window, row[2] + max_wait), now, job_id),
+                    )
+                    self.coalesced += 1
+                else:
+                    merged = False
+                    job_id = self._conn.execute(
+                        "INSERT INTO jobs (kind, payload, max_attempts, available_at, created_at, updated_at, "
+                        "coalesce_key) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (kind, json.dumps(payload, ensure_ascii=False), max_attempts, now + window, now, now, key),
+                    ).lastrowid
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return job_id, merged
+
+    def _requeue_expired(self, now: float) -> int:
+        """Job 'running' đã hết hạn thuê -> queued (tính là một lần thử) hoặc failed nếu hết lượt."""
+        cur = self._conn.execute(
+            "UPDATE jobs SET attempts = attempts + 1, last_error = 'lease expired', updated_at = ?, "
+            "owner = NULL, claimed_at = NULL, "
+            "status = CASE WHEN attempts + 1 >= max_attempts THEN 'failed' ELSE 'queued' END "
+            "WHERE status = 'running' AND (claimed_at IS NULL OR claimed_at < ?)",
+            (now, now - self.lease),
+        )
+        if cur.rowcount:
+            logger.warning(f"⚠️ {cur.rowcount} job quá hạn thuê {self.lease:.0f}s, đưa lại hàng đợi.")
+        return cur.rowcount
+
+    def claim(self):
+        """
+        Lấy job sẵn sàng sớm nhất và đánh dấu 'running' cho tiến trình này (atomic, an toàn
+        giữa nhiều tiến trình). Mỗi lần lấy cũng thu hồi các job đã hết hạn thuê.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._requeue_expired(now)
+                row = self._conn.execute(
+                    "SELECT id, kind, payload, attempts, created_at, available_at FROM jobs "
+                    "WHERE status = 'queued' AND available_at <= ? ORDER BY available_at, id LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if row:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'running', owner = ?, claimed_at = ?, updated_at = ? WHERE id = ?",
+                        (self.owner, now, now, row[0]),
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if not row:
+            return None
+        return {"id": row[0], "kind": row[1], "payload": json.loads(row[2]),
+                "attempts": row[3], "created_at": row[4], "available_at": row[5], "claimed_at": now}
+
+    # complete/fail/defer chỉ tác động khi job vẫn thuộc lần lấy này: job đã hết hạn thuê
+    # và được worker khác lấy lại thì kết quả của lần chạy cũ bị bỏ qua
+    _OWNED = "id = ? AND status = 'running' AND owner = ? AND claimed_at = ?"
+
+    def _owned(self, job: dict) -> tuple:
+        return (job["id"], self.owner, job["claimed_at"])
+
+    def complete(self, job: dict):
+        with self._lock:
+            self._conn.execute(f"DELETE FROM jobs WHERE {self._OWNED}", self._owned(job))
+
+    def fail(self, job: dict, error: str) -> bool:
+        """Ghi nhận lỗi; trả về True nếu job còn được retry (backoff luỹ thừa)."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT attempts, max_attempts FROM jobs WHERE {self._OWNED}", self._owned(job)
+            ).fetchone()
+            if row is None:
+                return False
+            attempts, max_attempts = row
+            attempts += 1
+            if attempts >= max_attempts:
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'failed', attempts = ?, last_error = ?, updated_at = ?, "
+                    f"owner = NULL, claimed_at = NULL WHERE {self._OWNED}",
+                    (attempts, error, now, *self._owned(job)),
+                )
+                return False
+            delay = JOB_RETRY_BASE_SECONDS * (2 ** (attempts - 1))
+            self._conn.execute(
+                "UPDATE jobs SET status = 'queued', attempts = ?, last_error = ?, available_at = ?, updated_at = ?, "
+                f"owner = NULL, claimed_at = NULL WHERE {self._OWNED}",
+                (attempts, error, now + delay, now, *self._owned(job)),
+            )
+            return True
+
+    def defer(self, job: dict, delay: float):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'queued', available_at = ?, updated_at = ?, owner = NULL, claimed_at = NULL "
+                f"WHERE {self._OWNED}",
+                (now + delay, now, *self._owned(job)),
+            )
+
+    def recover(self) -> int:
+        """
+        Khi khởi động: đưa lại hàng đợi job 'running' của tiến trình đã chết trên cùng máy
+        (crash/redeploy) mà không chờ hết hạn thuê. Job của worker khác còn sống không bị đụng tới.
+        """
+        host = self.owner.rsplit(":", 2)[0]
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, owner FROM jobs WHERE status = 'running' AND owner LIKE ?", (f"{host}:%",)
+            ).fetchall()
+            dead = [job_id for job_id, owner in rows if not _owner_alive(owner, self.owner)]
+            for job_id in dead:
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'queued', owner = NULL, claimed_at = NULL, updated_at = ? "
+                    "WHERE id = ? AND status = 'running'",
+                    (time.time(), job_id),
+                )
+            return len(dead)
+
+    def stats(self) -> dict:
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*), MIN(created_at) FROM jobs GROUP BY status"
+            ).fetchall()
+        stats = {"queued": 0, "running": 0, "failed": 0}
+        oldest = {}
+        for status, count, min_created in rows:
+            stats[status] = count
+            oldest[status] = round(now - min_created, 3) if min_created else None
+        stats["depth"] = stats["queued"] + stats["running"]
+        stats["coalesced"] = self.coalesced
+        stats["oldest_queued_age_seconds"] = oldest.get("queued")
+        stats["oldest_running_age_seconds"] = oldest.get("running")
+        return stats
+
+
+class JobWorkerPool:
+    """Pool gồm N worker asyncio lấy job từ JobQueue và gọi handler theo `kind`."""
+
+    def __init__(self, queue: JobQueue, size: int = JOB_WORKERS):
+        self.queue = queue
+        self.size = size
+        self.handlers = {}
+        self._tasks = []
+        self._wakeup = asyncio.Event()
+
+    def register(self, kind: str, handler):
+        """handler: coroutine function nhận payload (dict)."""
+        self.handlers[kind] = handler
+
+    def notify(self):
+        """Đánh thức worker ngay khi có job mới (không phải chờ hết chu kỳ poll)."""
+        self._wakeup.set()
+
+    def start(self):
+        recovered = self.queue.recover()
+        if recovered:
+            logger.info(f"♻️ Khôi phục {recovered} job đang chạy dở từ lần chạy trước.")
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.size)]
+
+    async def stop(self):
+        # Job đang chạy dở được trả lại hàng đợi ngay (xem _worker); nếu tiến trình bị kill,
+        # recover()/hết hạn thuê sẽ đưa chúng trở lại
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self, index: int):
+        while True:
+            job = self.queue.claim()
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            handler = self.handlers.get(job["kind"])
+            trace_id = job["payload"].get("idcomment") or f"job-{job['id']}"
+            try:
+                if handler is None:
+                    raise RuntimeError(f"Không có handler cho job kind '{job['kind']}'")
+                with trace(trace_id):
+                    # Tính từ lúc job được phép lấy: bỏ qua thời gian gộp bình luận và backoff retry
+                    observe("queue_wait", time.time() - job["available_at"])
+                    try:
+                        await asyncio.wait_for(handler(job["payload"]), timeout=JOB_HANDLER_TIMEOUT_SECONDS)
+                    except asyncio.TimeoutError:
+                        raise RuntimeError(f"Handler chạy quá {JOB_HANDLER_TIMEOUT_SECONDS:.0f}s")
+                self.queue.complete(job)
+            except asyncio.CancelledError:
+                self.queue.defer(job, 0)
+                raise
+            except JobDeferred as e:
+                self.queue.defer(job, e.delay)
+            except Exception as e:
+                will_retry = self.queue.fail(job, str(e))
+                logger.error(
+                    f"❌ Job {job['id']} ({job['kind']}) lỗi lần {job['attempts'] + 1}: {e}"
+                    + (" - sẽ thử lại." if will_retry else " - đã hết số lần thử.")
+                )
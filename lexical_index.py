@@ -0,0 +1,206 @@
+# ====================================================================
+# FILE: lexical_index.py - Chỉ mục BM25 tiếng Việt (tìm theo từ khoá, chạy cục bộ)
+# ====================================================================
+import os
+import re
+import json
+import math
+import logging
+import threading
+import unicodedata
+from collections import Counter
+
+from langchain_core.documents import Document
+
+logger = logging.getLogger(__name__)
+
+# ==== Cấu hình ====
+BM25_K1 = float(os.getenv("BM25_K1", "1.5"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+# Fast path: BM25 đủ chắc chắn -> bỏ qua embedding câu hỏi và tìm kiếm vector
+LEXICAL_FAST_PATH_ENABLED = os.getenv("LEXICAL_FAST_PATH_ENABLED", "true").lower() == "true"
+LEXICAL_FAST_PATH_MIN_TERMS = int(os.getenv("LEXICAL_FAST_PATH_MIN_TERMS", "2"))
+LEXICAL_FAST_PATH_COVERAGE = float(os.getenv("LEXICAL_FAST_PATH_COVERAGE", "0.8"))
+LEXICAL_FAST_PATH_MARGIN = float(os.getenv("LEXICAL_FAST_PATH_MARGIN", "1.3"))
+
+# Từ đệm/hư từ hay gặp trong bình luận (đã bỏ dấu): không mang thông tin để tìm kiếm.
+# Không có "ban": sau khi bỏ dấu "bạn" trùng với "bán" (từ khoá quan trọng của tin đăng).
+# Đổi danh sách -> tăng drive.CHUNK_METADATA_VERSION để dựng lại chỉ mục BM25 của file cũ.
+STOPWORDS = frozenset("""
+a ah ak anh bao cac cho chi chua co con cua da dang day de di duoc em gi ha hay hoi ko k khong la lam
+luon minh mot nao nay ne nhe nhi nhieu nhung oi roi sao se thi toi tren tu va vay voi vs vui xin ve
+""".split())
+
+_NUMBER_RE = re.compile(r"(\d)[.,](\d)")
+_TOKEN_RE = re.compile(r"\d+(?:\.\d+)?|[a-z][a-z0-9]*")
+
+
+# ====================================================================
+# Tách từ tiếng Việt
+# ====================================================================
+
+def strip_diacritics(text: str) -> str:
+    """Bỏ dấu tiếng Việt (kể cả đ -> d), giữ nguyên chữ hoa/thường."""
+    text = text.replace("đ", "d").replace("Đ", "D")
+    text = unicodedata.normalize("NFD", text)
+    return "".join(ch for ch in text if unicodedata.category(ch) != "Mn")
+
+def fold_vietnamese(text: str) -> str:
+    """Chữ thường, bỏ dấu để "Sổ đỏ" và "so do" khớp nhau."""
+    return strip_diacritics(text).lower()
+
+def tokenize(text: str) -> list:
+    """
+    Âm tiết đã bỏ dấu + cặp âm tiết liền nhau (từ ghép như "so_do", "dinh_bang").
+    Số thập phân giữ nguyên ("2,5 tỷ" -> "2.5", "ty"); "80m2" -> "80", "m2".
+    """
+    text = _NUMBER_RE.sub(r"\1.\2", fold_vietnamese(text))
+    words = [w for w in _TOKEN_RE.findall(text) if w not in STOPWORDS]
+    return words + [f"{a}_{b}" for a, b in zip(words, words[1:])]
+
+
+# ====================================================================
+# Chỉ mục BM25 cập nhật tăng dần, lưu cạnh collection Chroma
+# ====================================================================
+
+class BM25Index:
+    """
+    Inverted index BM25 trong bộ nhớ. Thêm/xoá theo chunk id giống Chroma nên
+    drive.setup_vectorstore cập nhật được cùng lúc với collection.
+    """
+
+    def __init__(self, path: str | None = None):
+        self.path = path
+        self._docs = {}        # chunk_id -> Document
+        self._tf = {}          # chunk_id -> Counter(term)
+        self._lengths = {}     # chunk_id -> số token
+        self._postings = {}    # term -> set(chunk_id)
+        self._total_length = 0
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    # ---------- Cập nhật ----------
+    def add(self, ids: list, documents: list):
+        with self._lock:
+            self.remove(ids)
+            for chunk_id, doc in zip(ids, documents):
+                terms = Counter(tokenize(doc.page_content))
+                self._docs[chunk_id] = Document(page_content=doc.page_content, metadata=dict(doc.metadata))
+                self._tf[chunk_id] = terms
+                length = sum(terms.values())
+                self._lengths[chunk_id] = length
+                self._total_length += length
+                for term in terms:
+                    self._postings.setdefault(term, set()).add(chunk_id)
+
+    def remove(self, ids):
+        with self._lock:
+            for chunk_id in ids:
+                if chunk_id not in self._docs:
+                    continue
+                for term in self._tf.pop(chunk_id):
+                    posting = self._postings.get(term)
+                    if posting is not None:
+                        posting.discard(chunk_id)
+                        if not posting:
+                            del self._postings[term]
+                self._total_length -= self._lengths.pop(chunk_id)
+                del self._docs[chunk_id]
+
+    def clear(self):
+        with self._lock:
+            self._docs, self._tf, self._lengths, self._postings = {}, {}, {}, {}
+            self._total_length = 0
+
+    def rebuild_from(self, vectorstore):
+        """Dựng lại toàn bộ từ nội dung đang có trong collection Chroma."""
+        data = vectorstore.get(include=["documents", "metadatas"])
+        documents = [Document(page_content=text or "", metadata=meta or {})
+                     for text, meta in zip(data["documents"], data["metadatas"])]
+        with self._lock:
+            self.clear()
+            self.add(data["ids"], documents)
+
+    # ---------- Lưu / đọc ----------
+    def save(self):
+        """Chỉ lưu văn bản + metadata (atomic); token được tính lại khi load."""
+        if not self.path:
+            return
+        with self._lock:
+            payload = {cid: {"text": doc.page_content, "metadata": doc.metadata} for cid, doc in self._docs.items()}
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        index = cls(path)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                payload = json.load(f)
+        except FileNotFoundError:
+            return index
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ Chỉ mục BM25 bị hỏng, sẽ dựng lại: {e}")
+            return index
+        ids = list(payload)
+        index.add(ids, [Document(page_content=payload[i]["text"], metadata=payload[i]["metadata"]) for i in ids])
+        return index
+
+    # ---------- Tìm kiếm ----------
+    def metadatas(self) -> list:
+        with self._lock:
+            return [doc.metadata for doc in self._docs.values()]
+
+    def search(self, query: str, k: int = 10, predicate=None) -> list:
+        """Trả về [(chunk_id, Document, score, coverage)] theo điểm BM25 giảm dần.
+        coverage = tỉ lệ âm tiết của câu hỏi xuất hiện trong đoạn văn.
+        predicate(metadata) -> bool: chỉ giữ đoạn thoả điều kiện (lọc trước khi xếp hạng)."""
+        query_terms = set(tokenize(query))
+        unigrams = {t for t in query_terms if "_" not in t}
+        with self._lock:
+            n_docs = len(self._docs)
+            if not n_docs or not query_terms:
+                return []
+            avg_length = self._total_length / n_docs or 1.0
+            scores = {}
+            for term in query_terms:
+                posting = self._postings.get(term)
+                if not posting:
+                    continue
+                idf = math.log(1 + (n_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+                for chunk_id in posting:
+                    if predicate is not None and not predicate(self._docs[chunk_id].metadata):
+                        continue
+                    tf = self._tf[chunk_id][term]
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[chunk_id] / avg_length)
+                    scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+            ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+            results = []
+            for chunk_id, score in ranked:
+                matched = sum(1 for t in unigrams if t in self._tf[chunk_id])
+                coverage = matched / len(unigrams) if unigrams else 0.0
+                results.append((chunk_id, self._docs[chunk_id], score, coverage))
+        return results
+
+
+def is_confident(results: list, query: str) -> bool:
+    """Kết quả BM25 đủ rõ ràng để bỏ qua tìm kiếm vector hay không."""
+    if not LEXICAL_FAST_PATH_ENABLED or not results:
+        return False
+    unigrams = {t for t in tokenize(query) if "_" not in t}
+    _, _, top_score, coverage = results[0]
+    if len(unigrams) < LEXICAL_FAST_PATH_MIN_TERMS or coverage < LEXICAL_FAST_PATH_COVERAGE:
+        return False
+    # Đoạn đứng đầu phải vượt hẳn đoạn tốt nhất của TÀI LIỆU KHÁC (các chunk cùng file
+    # thường có điểm gần nhau), nếu không để vector quyết định
+    top_doc = results[0][1]
+    top_source = top_doc.metadata.get("drive_file_id") or top_doc.page_content
+    for _, doc, score, _ in results[1:]:
+        if (doc.metadata.get("drive_file_id") or doc.page_content) != top_source:
+            return top_score >= LEXICAL_FAST_PATH_MARGIN * score
+    return True
@@ -0,0 +1,203 @@
+# ====================================================================
+# FILE: listing_metadata.py - Trích xuất thông tin tin đăng nhà đất và bộ lọc truy vấn
+# ====================================================================
+import os
+import re
+
+from lexical_index import fold_vietnamese, strip_diacritics
+
+# ==== Cấu hình ====
+# Đổi cách trích xuất -> tăng drive.CHUNK_METADATA_VERSION để xử lý lại file cũ
+# Trường dùng để lọc khi tìm kiếm. legal_status mặc định chỉ lưu, không lọc:
+# "sổ đỏ chưa ạ" là câu hỏi về pháp lý chứ không phải điều kiện tìm kiếm.
+LISTING_FILTER_FIELDS = [
+    f.strip() for f in os.getenv("LISTING_FILTER_FIELDS", "ward,district,property_type,price_vnd,area_m2").split(",")
+    if f.strip()
+]
+# "nhà" trong bình luận thường chỉ chung bất động sản ("nhà này còn không") -> không lọc theo loại
+QUERY_GENERIC_TYPES = {"nha"}
+# Khoảng dung sai khi câu hỏi nêu giá/diện tích cụ thể (0.2 = ±20%)
+LISTING_RANGE_TOLERANCE = float(os.getenv("LISTING_RANGE_TOLERANCE", "0.2"))
+
+# Lấy cụm xuất hiện sớm nhất; cùng vị trí thì khoá khai báo trước thắng ("nha xuong" trước "nha")
+PROPERTY_TYPES = {
+    "can_ho": ["chung cu", "can ho"],
+    "biet_thu": ["biet thu"],
+    "shophouse": ["shophouse", "nha pho thuong mai"],
+    "kho_xuong": ["nha xuong", "kho xuong", "nha kho"],
+    "nha": ["nha mat pho", "nha pho", "nha rieng", "nha o", "nha"],
+    "dat": ["dat nen", "lo dat", "dat o", "dat tho cu", "dat"],
+}
+LEGAL_STATUSES = {
+    "so_do": ["so do"],
+    "so_hong": ["so hong"],
+    "cho_so": ["cho so", "chua co so", "chua so"],
+    "hdmb": ["hop dong mua ban"],
+    "giay_tay": ["giay to tay", "giay tay"],
+}
+
+def _compile_phrases(table: dict) -> list:
+    return [(key, re.compile(rf"\b{phrase}\b")) for key, phrases in table.items() for phrase in phrases]
+
+_PROPERTY_TYPE_PATTERNS = _compile_phrases(PROPERTY_TYPES)
+_LEGAL_STATUS_PATTERNS = _compile_phrases(LEGAL_STATUSES)
+
+# "1.250" = 1250 (dấu chấm + đúng 3 chữ số là phân cách hàng nghìn); "2,5" / "2.5" = 2.5
+_NUM = r"(\d{1,3}(?:\.\d{3})+(?![.,]?\d)|\d+(?:[.,]\d+)?)"
+# "2 tỷ 5" = 2,5 tỷ; "2 tỷ 50 triệu" = 2 tỷ + 50 triệu; "2 tỷ 50m2" không phải giá lẻ
+_PRICE_TY_RE = re.compile(_NUM + r"\s*(?:ty|ti)\b(?:\s*(\d{1,3})(?:\s*(trieu|tr)\b|\b(?!\s*m)))?")
+_PRICE_TRIEU_RE = re.compile(_NUM + r"\s*(?:trieu|tr)\b")
+_AREA_RE = re.compile(_NUM + r"\s*(?:m2|m²|met vuong)")
+# Tên địa danh viết hoa ("phường Đình Bảng") -> không nhầm "xa" (xa) trong "không xa chợ"
+_DISTRICT_RE = re.compile(r"\b(?:[Tt]hi xa|[Hh]uyen|[Qq]uan|[Tt]hanh pho|TP\.?)\s+([A-Z0-9][a-z0-9]*(?:\s[A-Z][a-z]*)?)")
+_WARD_RE = re.compile(r"(?<![Tt]hi )\b(?:[Pp]huong|[Xx]a|[Tt]hi tran)\s+([A-Z0-9][a-z0-9]*(?:\s[A-Z][a-z]*)?)")
+_BELOW_RE = re.compile(r"\b(?:duoi|toi da|khong qua|max)\s*$")
+_ABOVE_RE = re.compile(r"\b(?:tren|hon|tu|toi thieu|min)\s*$")
+
+
+def _to_float(value: str) -> float:
+    if re.fullmatch(r"\d{1,3}(?:\.\d{3})+", value):
+        return float(value.replace(".", ""))
+    return float(value.replace(",", "."))
+
+def _phrases(text: str, patterns: list) -> list:
+    """Khoá của các cụm từ có trong text (đã bỏ dấu), theo vị trí xuất hiện."""
+    found = {}
+    for key, pattern in patterns:
+        for match in pattern.finditer(text):
+            found.setdefault(match.start(), key)
+    return [found[position] for position in sorted(found)]
+
+def _first_phrase(text: str, patterns: list):
+    found = _phrases(text, patterns)
+    return found[0] if found else None
+
+def _prices(text: str) -> list:
+    """[(giá VND, vị trí)] cho "2,5 tỷ", "2 tỷ 5", "2 tỷ 50 triệu", "800 triệu", "1.250 triệu"."""
+    prices, ty_spans = [], []
+    for match in _PRICE_TY_RE.finditer(text):
+        value = _to_float(match.group(1)) * 1e9
+        if match.group(3):
+            value += int(match.group(2)) * 1e6
+        elif match.group(2):
+            value += float(f"0.{match.group(2)}") * 1e9
+        prices.append((value, match.start()))
+        ty_spans.append(match.span())
+    for match in _PRICE_TRIEU_RE.finditer(text):
+        # Phần "triệu" của "X tỷ Y triệu" đã được tính ở trên
+        if not any(start <= match.start() < end for start, end in ty_spans):
+            prices.append((_to_float(match.group(1)) * 1e6, match.start()))
+    return sorted(prices, key=lambda item: item[1])
+
+def _areas(text: str) -> list:
+    return [(_to_float(m.group(1)), m.start()) for m in _AREA_RE.finditer(text)]
+
+# ====================================================================
+# Ingest: gắn metadata vào từng chunk
+# ====================================================================
+
+def _candidates(text: str) -> dict:
+    """Mọi giá trị nhận ra được cho từng trường, theo thứ tự xuất hiện."""
+    stripped = strip_diacritics(text)
+    folded = stripped.lower()
+    return {
+        "district": [" ".join(m.group(1).lower().split()) for m in _DISTRICT_RE.finditer(stripped)],
+        "ward": [" ".join(m.group(1).lower().split()) for m in _WARD_RE.finditer(stripped)],
+        "price_vnd": [value for value, _ in _prices(folded)],
+        "area_m2": [value for value, _ in _areas(folded)],
+        "property_type": _phrases(folded, _PROPERTY_TYPE_PATTERNS),
+        "legal_status": _phrases(folded, _LEGAL_STATUS_PATTERNS),
+    }
+
+def extract_listing_metadata(text: str) -> dict:
+    """Các trường nhận ra được trong một đoạn văn (bỏ qua trường không có)."""
+    return {key: values[0] for key, values in _candidates(text).items() if values}
+
+def annotate_chunks(docs: list, splits: list):
+    """
+    Gắn metadata tin đăng cho các chunk của MỘT file. Trường chunk không tự chứa
+    (ví dụ đoạn chỉ có giá) được lấy từ toàn văn bản nếu văn bản chỉ có một giá trị.
+    """
+    full_text = "\n".join(doc.page_content for doc in docs)
+    inherited = {key: values[0] for key, values in _candidates(full_text).items() if len(set(values)) == 1}
+    for chunk in splits:
+        chunk.metadata.update({**inherited, **extract_listing_metadata(chunk.page_content)})
+
+
+# ====================================================================
+# Truy vấn: nhận ra điều kiện trong bình luận -> bộ lọc metadata
+# ====================================================================
+
+class ListingFilterParser:
+    """
+    Chuyển câu hỏi thành bộ lọc `where` kiểu Chroma. Tên phường/xã, huyện/thị xã
+    được nhận ra theo danh sách giá trị đã có trong index (khách thường không gõ "phường").
+    """
+
+    def __init__(self, metadatas: list = (), fields: list = None):
+        self.fields = set(LISTING_FILTER_FIELDS if fields is None else fields)
+        self.places = {"ward": set(), "district": set()}
+        for meta in metadatas:
+            for key in self.places:
+                if meta and meta.get(key):
+                    self.places[key].add(meta[key])
+
+    def _find_place(self, folded: str, key: str):
+        # Tên dài trước để "dong nguyen" không bị "dong" chặn mất
+        for name in sorted(self.places[key], key=len, reverse=True):
+            if re.search(rf"\b{re.escape(name)}\b", folded):
+                return name
+        return None
+
+    def _range(self, folded: str, value: float, position: int) -> dict:
+        before = folded[:position]
+        if _BELOW_RE.search(before):
+            return {"$lte": value}
+        if _ABOVE_RE.search(before):
+            return {"$gte": value}
+        return {"$gte": value * (1 - LISTING_RANGE_TOLERANCE), "$lte": value * (1 + LISTING_RANGE_TOLERANCE)}
+
+    def parse(self, query: str) -> dict:
+        """Trả về {trường: điều kiện}; rỗng nếu câu hỏi không nêu điều kiện nào."""
+        folded = fold_vietnamese(query)
+        conditions = {}
+        for key in ("ward", "district"):
+            name = self._find_place(folded, key)
+            if name:
+                conditions[key] = {"$eq": name}
+        property_type = _first_phrase(folded, _PROPERTY_TYPE_PATTERNS)
+        if property_type and property_type not in QUERY_GENERIC_TYPES:
+            conditions["property_type"] = {"$eq": property_type}
+        legal_status = _first_phrase(folded, _LEGAL_STATUS_PATTERNS)
+        if legal_status:
+            conditions["legal_status"] = {"$eq": legal_status}
+        prices = _prices(folded)
+        if prices:
+            conditions["price_vnd"] = self._range(folded, *prices[0])
+        areas = _areas(folded)
+        if areas:
+            conditions["area_m2"] = self._range(folded, *areas[0])
+        return {key: cond for key, cond in conditions.items() if key in self.fields}
+
+
+def to_chroma_where(conditions: dict):
+    """{trường: {op: giá trị}} -> cú pháp where của Chroma (None nếu không lọc)."""
+    clauses = [{key: {op: value}} for key, cond in conditions.items() for op, value in cond.items()]
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+def matches(metadata: dict, conditions: dict) -> bool:
+    """Áp cùng bộ lọc cho kết quả BM25 (chạy trong bộ nhớ)."""
+    for key, cond in conditions.items():
+        value = metadata.get(key)
+        if value is None:
+            return False
+        for op, expected in cond.items():
+            if op == "$eq" and value != expected:
+                return False
+            if op == "$gte" and value < expected:
+                return False
+            if op == "$lte" and value > expected:
+                return False
+    return True
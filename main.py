@@ -3,19 +3,34 @@
 # Cập nhật lần cuối: 14/10/2025 (Đã sửa lỗi THỨ TỰ CẤU HÌNH LOGGING)
 # ====================================================================
 import uvicorn
+import asyncio
 import logging
 import requests
 import os
 import resend 
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, Request, BackgroundTasks 
+from fastapi import FastAPI, Request 
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
 
 # Import các file chức năng đã tách
-from facebook_tools import get_page_info, get_latest_posts, handle_webhook_data, reply_comment 
-from drive import get_vectorstore
-from agent import get_answer 
+from facebook_tools import (
+    aget_page_info_cached, aget_latest_posts_cached,
+    parse_comment_events, aclose_http_clients, GRAPH_CACHE,
+)
+from drive import get_index, init_vectorstore, is_ready, get_index_status
+from drive_watcher import DRIVE_WATCHER
+from agent import get_answerer
+from retrieval import RETRIEVAL_STATS
+from answer_cache import ANSWER_CACHE
+from job_queue import JobQueue, JobWorkerPool, JobDeferred
+from php_batcher import PhpWriteBatcher
+from reply_dispatcher import ReplyDispatcher
+from dedup import CommentDeduplicator
+from triage import CommentTriage, IGNORE, CANNED
+from embedding_cache import get_embeddings
+from metrics import METRICS_ENABLED, stage, register_stats, render_metrics
 
 from dotenv import load_dotenv
 
@@ -41,14 +56,75 @@ PAGE_ACCESS_TOKEN = os.getenv("FB_PAGE_ACCESS_TOKEN") # Token truy cập Page
 PAGE_ID = os.getenv("FB_PAGE_ID") # ID Page
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY") 
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN") # Nếu đặt, /admin/* yêu cầu ?token=...
 # Ghi log debug sau khi logging được cấu hình
 logging.info(f"DEBUG: PHP_CONNECT_URL đã đọc được: {PHP_CONNECT_URL}")
 logging.info(f"DEBUG: OPENAI_KEY LENGTH: {len(OPENAI_API_KEY) if OPENAI_API_KEY else 'NONE'}")
 # ========================================
 
 
+INDEX_RETRY_SECONDS = int(os.getenv("INDEX_RETRY_SECONDS", "60"))
+# Gộp các bình luận liên tiếp của cùng một người trên cùng bài viết ("giá?", "diện tích?", "ở đâu?")
+# thành một câu hỏi: chờ thêm chừng này giây sau bình luận mới nhất (0 = tắt),
+# nhưng không chờ quá COMMENT_COALESCE_MAX_WAIT_SECONDS kể từ bình luận đầu tiên
+COMMENT_COALESCE_WINDOW_SECONDS = float(os.getenv("COMMENT_COALESCE_WINDOW_SECONDS", "4"))
+COMMENT_COALESCE_MAX_WAIT_SECONDS = float(os.getenv("COMMENT_COALESCE_MAX_WAIT_SECONDS", "15"))
+
+# ==== HÀNG ĐỢI CÔNG VIỆC BỀN VỮNG (thay cho BackgroundTasks trong bộ nhớ) ====
+JOB_QUEUE = JobQueue()
+JOB_WORKERS = JobWorkerPool(JOB_QUEUE)
+# Ghi DB qua connect.php theo lô (write-behind, có spool khi PHP không truy cập được)
+PHP_BATCHER = PhpWriteBatcher(PHP_CONNECT_URL)
+# Phản hồi Facebook theo Graph API batch, tự giảm tốc theo X-App-Usage/X-Page-Usage
+REPLY_DISPATCHER = ReplyDispatcher()
+# Facebook gửi lại webhook bị timeout -> chỉ lần đầu của mỗi comment_id được xử lý
+COMMENT_DEDUP = CommentDeduplicator()
+# Phân loại trước khi gọi AI: emoji, "ib", tag bạn bè, link spam... không cần tới LLM
+COMMENT_TRIAGE = CommentTriage.from_file()
+
+# Xuất thống kê sẵn có của các thành phần ra /metrics
+register_stats("job_queue", JOB_QUEUE.stats)
+register_stats("answer_cache", ANSWER_CACHE.stats)
+register_stats("php_writes", PHP_BATCHER.stats)
+register_stats("replies", REPLY_DISPATCHER.stats)
+register_stats("dedup", COMMENT_DEDUP.stats)
+register_stats("triage", COMMENT_TRIAGE.stats)
+register_stats("embedding_cache", lambda: get_embeddings().stats)
+register_stats("graph_cache", GRAPH_CACHE.stats)
+register_stats("retrieval", lambda: dict(RETRIEVAL_STATS))
+register_stats("drive_watch", DRIVE_WATCHER.stats)
+
+# ==== TẢI VECTORSTORE TRONG TASK NỀN (KHÔNG CHẶN KHỞI ĐỘNG) ====
+async def build_index_in_background():
+    """Dựng/tải VECTORSTORE trong thread riêng, thử lại nếu lỗi."""
+    while True:
+        try:
+            await asyncio.to_thread(init_vectorstore)
+            logging.info("✅ VECTORSTORE đã được tải/khởi tạo thành công.")
+            # Job AI đang bị hoãn sẽ được worker lấy lại ngay
+            JOB_WORKERS.notify()
+            break
+        except Exception as e:
+            logging.error(f"❌ LỖI KHỞI TẠO RAG: Không thể tải VECTORSTORE: {e}. Thử lại sau {INDEX_RETRY_SECONDS}s.")
+            await asyncio.sleep(INDEX_RETRY_SECONDS)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    index_task = asyncio.create_task(build_index_in_background())
+    JOB_WORKERS.start()
+    PHP_BATCHER.start()
+    REPLY_DISPATCHER.start()
+    DRIVE_WATCHER.start()
+    yield
+    await DRIVE_WATCHER.stop()
+    await JOB_WORKERS.stop()
+    await REPLY_DISPATCHER.stop()
+    await PHP_BATCHER.stop()
+    index_task.cancel()
+    await aclose_http_clients()
+
 # ==== KHAI BÁO FASTAPI APP VÀ MIDDLEWARE ====
-app = FastAPI() 
+app = FastAPI(lifespan=lifespan) 
 
 app.add_middleware(
     CORSMiddleware,
@@ -58,17 +134,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# ==== TẢI VECTORSTORE (CHẠY ĐỒNG BỘ KHI KHỞI ĐỘNG) ====
-try:
-    # Nếu lỗi MissingSchema xảy ra ở đây, nó đến từ code trong drive.py/agent.py
-    VECTORSTORE = get_vectorstore()
-    logging.info("✅ VECTORSTORE đã được tải/khởi tạo thành công.")
-except Exception as e:
-    logging.error(f"❌ LỖI KHỞI TẠO RAG: Không thể tải VECTORSTORE: {e}")
-    VECTORSTORE = None
-# =====================================================
-
-
 # ========== 1. Các Hàm Hỗ trợ và Kiểm tra Kết Nối ==========
 
 # ==== Gửi email (Giữ nguyên) ====
@@ -85,15 +150,16 @@ def send_email(subject: str, content: str):
     except Exception as e:
         print("Lỗi gửi mail:", e)
 
-def test_facebook_connection():
+async def test_facebook_connection():
     # ... (giữ nguyên)
     try:
-        page_info = get_page_info(PAGE_ID, PAGE_ACCESS_TOKEN) 
+        page_info, age = await aget_page_info_cached(PAGE_ID, PAGE_ACCESS_TOKEN) 
         if "id" in page_info and "name" in page_info:
             return {
                 "facebook_connection": "success",
                 "page_id": page_info.get("id"),
-                "page_name": page_info.get("name")
+                "page_name": page_info.get("name"),
+                "cache_age_seconds": round(age, 1),
             }
         else:
             return {
@@ -110,47 +176,158 @@ def test_facebook_connection():
 # ========== 2. Các Endpoints API Cơ bản ==========
 
 @app.get("/api/page_info")
-def page_info_endpoint():
-    return get_page_info(PAGE_ID, PAGE_ACCESS_TOKEN)
+async def page_info_endpoint():
+    data, age = await aget_page_info_cached(PAGE_ID, PAGE_ACCESS_TOKEN)
+    return {**data, "cache_age_seconds": round(age, 1)}
 
 @app.get("/api/page_posts")
-def page_posts_endpoint():
-    return get_latest_posts(PAGE_ID, PAGE_ACCESS_TOKEN)
+async def page_posts_endpoint():
+    data, age = await aget_latest_posts_cached(PAGE_ID, PAGE_ACCESS_TOKEN)
+    return {**data, "cache_age_seconds": round(age, 1)}
+
+@app.get("/api/answer_cache")
+def answer_cache_endpoint():
+    """Thống kê cache câu trả lời: tỉ lệ hit và tổng thời gian đã tiết kiệm."""
+    return ANSWER_CACHE.stats()
 
 @app.get("/")
 async def root():
     """API gốc, trả về trạng thái kết nối của DB và Facebook Page."""
-    fb_status = test_facebook_connection()
+    fb_status = await test_facebook_connection()
     
     return {
         "message": "App is running",
         **fb_status,
-        "rag_status": "Ready" if VECTORSTORE else "Failed (Check Logs)" # Thêm trạng thái RAG
+        "rag_status": get_index_status()["state"], # pending / building / ready / failed
+        "queue_depth": JOB_QUEUE.stats()["depth"],
     }
 
+@app.get("/ready")
+async def ready():
+    """Readiness probe: 200 khi VECTORSTORE đã sẵn sàng, 503 khi đang dựng index."""
+    status = {**get_index_status(), "queue_depth": JOB_QUEUE.stats()["depth"]}
+    return JSONResponse(status, status_code=200 if is_ready() else 503)
+
+def is_admin(token: str) -> bool:
+    return not ADMIN_TOKEN or token == ADMIN_TOKEN
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus: histogram từng bước, token/chi phí OpenAI, thống kê các thành phần."""
+    if not METRICS_ENABLED:
+        return PlainTextResponse("metrics disabled", status_code=404)
+    body, content_type = render_metrics()
+    return Response(body, media_type=content_type)
+
+@app.get("/admin/queue")
+async def admin_queue(token: str = None):
+    """Độ sâu hàng đợi theo trạng thái và tuổi của job cũ nhất."""
+    if not is_admin(token):
+        return JSONResponse({"error": "forbidden"}, status_code=403)
+    return JOB_QUEUE.stats()
+
+@app.get("/admin/php_writes")
+async def admin_php_writes(token: str = None):
+    """Thống kê ghi connect.php theo lô: kích thước lô, thời gian flush, số bản ghi spool."""
+    if not is_admin(token):
+        return JSONResponse({"error": "forbidden"}, status_code=403)
+    return PHP_BATCHER.stats()
+
+@app.get("/admin/replies")
+async def admin_replies(token: str = None):
+    """Thống kê gửi phản hồi Facebook: số batch, retry, tốc độ hiện tại và mức usage."""
+    if not is_admin(token):
+        return JSONResponse({"error": "forbidden"}, status_code=403)
+    return REPLY_DISPATCHER.stats()
+
+@app.get("/admin/triage")
+async def admin_triage(token: str = None):
+    """Số bình luận theo từng lớp phân loại (ignore/canned/rag) và theo từng luật."""
+    if not is_admin(token):
+        return JSONResponse({"error": "forbidden"}, status_code=403)
+    return COMMENT_TRIAGE.stats()
+
+@app.get("/admin/dedup")
+async def admin_dedup(token: str = None):
+    """Số webhook bình luận trùng lặp đã bị bỏ qua."""
+    if not is_admin(token):
+        return JSONResponse({"error": "forbidden"}, status_code=403)
+    return COMMENT_DEDUP.stats()
+
 # ====================================================================
-# HÀM XỬ LÝ NỀN (BACKGROUND TASK) CHO AI VÀ PHẢN HỒI
+# HÀM XỬ LÝ NỀN (JOB TRONG HÀNG ĐỢI) CHO AI VÀ PHẢN HỒI
 # ====================================================================
-def process_ai_reply(idcomment: str, message: str, idpage: str, access_token: str):
-    # ... (giữ nguyên logic)
-    if not VECTORSTORE:
-        logging.error(f"❌ Không thể xử lý AI cho {idcomment}: VECTORSTORE không khả dụng.")
-        return
+async def process_ai_reply(idcomment: str, message: str, idpage: str, access_token: str):
+    """Gọi AI và phản hồi bình luận. Ném lỗi để hàng đợi retry khi thất bại."""
+    # Đọc vectorstore + BM25 cùng lúc: hot-swap giữa chừng không làm job dùng lẫn hai snapshot
+    vectorstore, lexical = get_index()
+    if not vectorstore:
+        # Index đang dựng: giữ job lại trong hàng đợi thay vì bỏ bình luận
+        raise JobDeferred(reason=f"VECTORSTORE chưa sẵn sàng cho {idcomment}")
         
     try:
         logging.info(f"⏳ Bắt đầu gọi AI cho bình luận: {idcomment}")
-        ai_response = get_answer(message, VECTORSTORE)
+        # Chain dựng sẵn; gọi LLM bất đồng bộ để không chiếm thread trong lúc chờ
+        ai_response = await get_answerer(vectorstore, lexical).aanswer(message)
         logging.info(f"✅ AI đã trả lời cho {idcomment}: {ai_response[:50]}...")
 
-        fb_response = reply_comment(idcomment, ai_response, access_token) 
+        # Kết quả riêng của bình luận này trong Graph batch (đã tự retry khi bị throttle)
+        with stage("facebook_reply"):
+            fb_response = await REPLY_DISPATCHER.reply(idcomment, ai_response, access_token)
         
         if 'id' in fb_response:
             logging.info(f"✅ Đã phản hồi thành công trên Facebook. ID phản hồi: {fb_response['id']}")
         else:
             logging.error(f"❌ Lỗi phản hồi Facebook cho {idcomment}: {fb_response}")
+            raise RuntimeError(f"Facebook reply lỗi: {fb_response}")
 
     except Exception as e:
         logging.error(f"❌ Lỗi xử lý AI/Facebook Reply cho {idcomment}: {e}")
+        raise
+
+async def handle_ai_reply_job(payload: dict):
+    # Access token không lưu trong hàng đợi, luôn lấy từ biến môi trường
+    await process_ai_reply(payload["idcomment"], payload["message"], payload["idpage"], PAGE_ACCESS_TOKEN)
+
+async def handle_canned_reply_job(payload: dict):
+    """Trả lời mẫu do bộ phân loại chọn: không retrieval, không gọi LLM."""
+    with stage("facebook_reply"):
+        fb_response = await REPLY_DISPATCHER.reply(payload["idcomment"], payload["message"], PAGE_ACCESS_TOKEN)
+    if 'id' not in fb_response:
+        logging.error(f"❌ Lỗi phản hồi mẫu cho {payload['idcomment']}: {fb_response}")
+        raise RuntimeError(f"Facebook reply lỗi: {fb_response}")
+    logging.info(f"✅ Đã phản hồi mẫu cho {payload['idcomment']}. ID phản hồi: {fb_response['id']}")
+
+JOB_WORKERS.register("ai_reply", handle_ai_reply_job)
+JOB_WORKERS.register("canned_reply", handle_canned_reply_job)
+
+def merge_ai_reply_payloads(queued: dict, new: dict) -> dict:
+    """Gộp bình luận mới vào job đang chờ: hỏi chung một câu, trả lời trên bình luận mới nhất."""
+    return {
+        **queued,
+        "idcomment": new["idcomment"],
+        "message": f"{queued['message']}\n{new['message']}",
+        "idcomments": queued.get("idcomments", [queued["idcomment"]]) + [new["idcomment"]],
+    }
+
+def enqueue_ai_reply(comment: dict):
+    payload = {
+        "idcomment": comment["idcomment"],
+        "message": comment["message"],
+        "idpage": comment["idpage"],
+    }
+    if COMMENT_COALESCE_WINDOW_SECONDS <= 0 or not comment.get("idpersion") or not comment.get("idpost"):
+        JOB_QUEUE.enqueue("ai_reply", payload)
+        logging.info(f"➡️ Đã thêm tác vụ AI cho comment ID: {comment['idcomment']}")
+        return
+    _, merged = JOB_QUEUE.enqueue_coalesced(
+        "ai_reply", f"{comment['idpersion']}:{comment['idpost']}", payload, merge_ai_reply_payloads,
+        window=COMMENT_COALESCE_WINDOW_SECONDS, max_wait=COMMENT_COALESCE_MAX_WAIT_SECONDS,
+    )
+    if merged:
+        logging.info(f"🧵 Gộp comment ID {comment['idcomment']} vào câu hỏi đang chờ của cùng người/bài viết.")
+    else:
+        logging.info(f"➡️ Đã thêm tác vụ AI cho comment ID: {comment['idcomment']}")
 
 # ========== 3. Endpoint Webhook Facebook ==========
 
@@ -170,42 +347,67 @@ async def verify_webhook(request: Request):
     return PlainTextResponse("Invalid token", status_code=403)
 
 
+def route_comment(comment: dict):
+    """Phân loại một bình luận mới và đưa job tương ứng vào hàng đợi (nếu cần trả lời)."""
+    idpage_payload = comment["idpage"]
+    idcomment = comment["idcomment"]
+
+    # 1. KÍCH HOẠT XỬ LÝ AI BẤT ĐỒNG BỘ
+    if idpage_payload != PAGE_ID:
+        logging.warning(f"⚠️ Webhook nhận từ ID Page không khớp: {idpage_payload}. Bỏ qua.")
+        return
+
+    # 2. PHÂN LOẠI NHANH: bỏ qua / trả lời mẫu / gọi AI
+    decision = COMMENT_TRIAGE.triage(comment["message"], idcomment, comment.get("message_tags"))
+    if decision["action"] == IGNORE:
+        return
+    if decision["action"] == CANNED:
+        JOB_QUEUE.enqueue("canned_reply", {
+            "idcomment": idcomment,
+            "message": decision["reply"],
+            "idpage": idpage_payload,
+        })
+        return
+
+    # 3. Bình luận liên tiếp của cùng người trên cùng bài viết được gộp thành một job
+    enqueue_ai_reply(comment)
+
+
 @app.post("/webhook")
-async def webhook(request: Request, background_tasks: BackgroundTasks):
-    # ... (giữ nguyên logic)
+async def webhook(request: Request):
+    """Chỉ parse và đưa job vào hàng đợi bền vững rồi trả 200 ngay; worker xử lý phần còn lại."""
     try:
         data = await request.json()
-        
-        # 1. Ghi DB
-        handle_webhook_data(data, PHP_CONNECT_URL) # Giữ nguyên
-
-        # 2. KÍCH HOẠT XỬ LÝ AI BẤT ĐỒNG BỘ
-        if data.get('object') == 'page' and data.get('entry'):
-            for entry in data['entry']:
-                idpage_payload = entry.get('id') 
-                
-                if idpage_payload != PAGE_ID:
-                    logging.warning(f"⚠️ Webhook nhận từ ID Page không khớp: {idpage_payload}. Bỏ qua.")
-                    continue
-                
-                for change in entry.get('changes', []):
-                    if change.get('field') == 'feed' and change.get('value', {}).get('item') == 'comment':
-                        value = change['value']
-                        idcomment = value.get('comment_id')
-                        message = value.get('message', '').strip()
-                        idpost = value.get('post_id')
-                        
-                        idpersion = value.get('from', {}).get('id') 
-
-                        if idpersion == idpage_payload:
-                            logging.info(f"⏭️ Bỏ qua bình luận tự động của Page ID {idpage_payload}.")
-                            continue
-                        
-                        if message and idcomment and idcomment != idpost: 
-                            background_tasks.add_task(
-                                process_ai_reply, idcomment, message, idpage_payload, PAGE_ACCESS_TOKEN
-                            )
-                            logging.info(f"➡️ Đã thêm tác vụ AI cho comment ID: {idcomment}")
+        # Duyệt payload MỘT LẦN, dùng chung cho ghi DB và xử lý AI
+        with stage("webhook_parse"):
+            comments = parse_comment_events(data)
+
+        failed = 0
+        for comment in comments:
+            idcomment = comment["idcomment"]
+
+            # 0. Bỏ qua bản gửi lại của bình luận đã xử lý (không ghi DB, không gọi AI)
+            if not COMMENT_DEDUP.first_seen(idcomment):
+                logging.info(f"⏭️ Bỏ qua webhook trùng lặp cho comment ID: {idcomment}")
+                continue
+
+            try:
+                route_comment(comment)
+            except Exception as e:
+                # Chưa vào hàng đợi -> bỏ đánh dấu để lần Facebook gửi lại được xử lý
+                COMMENT_DEDUP.forget(idcomment)
+                failed += 1
+                logging.error(f"❌ Lỗi đưa comment ID {idcomment} vào hàng đợi: {e}")
+                continue
+
+            # 4. Ghi DB: đưa vào lô ghi connect.php kế tiếp (sau khi đã nhận xử lý)
+            PHP_BATCHER.submit(comment)
+
+        if comments:
+            JOB_WORKERS.notify()
+        if failed:
+            # Trả lỗi để Facebook gửi lại webhook; bình luận đã nhận sẽ bị dedup bỏ qua
+            return JSONResponse({"status": "error", "failed": failed}, status_code=500)
 
     except Exception as e:
         logging.error(f"❌ Lỗi xử lý Webhook: {e}")
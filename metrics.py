@@ -0,0 +1,176 @@
+# ====================================================================
+# FILE: metrics.py - Đo độ trễ từng bước, token/chi phí OpenAI và endpoint /metrics
+# ====================================================================
+import os
+import time
+import asyncio
+import logging
+import functools
+import contextvars
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CollectorRegistry, Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST,
+)
+from prometheus_client.core import GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+# ==== Cấu hình ====
+# Tắt -> mọi hàm đo chỉ còn một phép kiểm tra bool, /metrics trả 404
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+# Ghi log từng bước kèm trace id (= comment_id) để lần theo một bình luận
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "false").lower() == "true"
+# Giá OpenAI (USD / 1 triệu token) để ước tính chi phí, mặc định gpt-4o-mini
+OPENAI_PRICE_INPUT_PER_1M = float(os.getenv("OPENAI_PRICE_INPUT_PER_1M", "0.15"))
+OPENAI_PRICE_OUTPUT_PER_1M = float(os.getenv("OPENAI_PRICE_OUTPUT_PER_1M", "0.60"))
+
+REGISTRY = CollectorRegistry()
+
+STAGE_SECONDS = Histogram(
+    "pipeline_stage_seconds", "Thời gian mỗi bước xử lý", ["stage"], registry=REGISTRY,
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300),
+)
+STAGE_ERRORS = Counter("pipeline_stage_errors_total", "Số lần một bước bị lỗi", ["stage"], registry=REGISTRY)
+OPENAI_TOKENS = Counter("openai_tokens_total", "Token OpenAI đã dùng", ["kind"], registry=REGISTRY)
+OPENAI_COST = Counter("openai_cost_usd_total", "Chi phí OpenAI ước tính (USD)", registry=REGISTRY)
+OPENAI_CALL_TOKENS = Histogram(
+    "openai_call_tokens", "Tổng token mỗi lời gọi LLM", registry=REGISTRY,
+    buckets=(100, 250, 500, 1000, 2000, 4000, 8000, 16000),
+)
+CONTEXT_CHARS = Histogram(
+    "rag_context_chars", "Số ký tự ngữ cảnh truy xuất được gửi vào LLM", registry=REGISTRY,
+    buckets=(250, 500, 1000, 1500, 2000, 3000, 5000, 10000),
+)
+CONTEXT_DOCS = Histogram(
+    "rag_context_documents", "Số đoạn văn truy xuất được", registry=REGISTRY,
+    buckets=(0, 1, 2, 3, 5, 8, 10, 15, 20),
+)
+
+CONTEXT_TOKENS = Histogram(
+    "rag_context_tokens", "Số token ngữ cảnh sau khi đóng gói (context_builder)", registry=REGISTRY,
+    buckets=(100, 250, 500, 750, 1000, 1500, 2000, 3000, 5000),
+)
+CONTEXT_TOKENS_SAVED = Counter(
+    "rag_context_tokens_saved_total", "Token ngữ cảnh bớt được nhờ ghép/loại trùng/ngân sách", registry=REGISTRY,
+)
+
+_trace_id = contextvars.ContextVar("trace_id", default=None)
+
+
+# ====================================================================
+# Trace id
+# ====================================================================
+
+@contextmanager
+def trace(trace_id: str):
+    """Gắn trace id (thường là comment_id) cho mọi bước chạy bên trong."""
+    token = _trace_id.set(trace_id)
+    try:
+        yield
+    finally:
+        _trace_id.reset(token)
+
+def current_trace_id():
+    return _trace_id.get()
+
+
+# ====================================================================
+# Đo từng bước
+# ====================================================================
+
+def observe(stage_name: str, seconds: float):
+    if not METRICS_ENABLED:
+        return
+    STAGE_SECONDS.labels(stage_name).observe(seconds)
+    if TRACE_ENABLED:
+        trace_id = _trace_id.get()
+        if trace_id:
+            logger.info(f"🔎 trace={trace_id} stage={stage_name} {seconds * 1000:.1f}ms")
+
+@contextmanager
+def stage(stage_name: str):
+    """with stage("retrieval"): ... -> ghi thời gian vào pipeline_stage_seconds."""
+    if not METRICS_ENABLED:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.labels(stage_name).inc()
+        raise
+    finally:
+        observe(stage_name, time.perf_counter() - started)
+
+def timed(stage_name: str):
+    """Decorator đo thời gian cho hàm sync hoặc async; không thay đổi kết quả trả về."""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with stage(stage_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def record_openai_usage(prompt_tokens: int, completion_tokens: int):
+    if not METRICS_ENABLED:
+        return
+    OPENAI_TOKENS.labels("prompt").inc(prompt_tokens)
+    OPENAI_TOKENS.labels("completion").inc(completion_tokens)
+    OPENAI_CALL_TOKENS.observe(prompt_tokens + completion_tokens)
+    OPENAI_COST.inc(
+        prompt_tokens * OPENAI_PRICE_INPUT_PER_1M / 1e6 + completion_tokens * OPENAI_PRICE_OUTPUT_PER_1M / 1e6
+    )
+
+def record_context(documents: list):
+    if not METRICS_ENABLED:
+        return
+    CONTEXT_DOCS.observe(len(documents))
+    CONTEXT_CHARS.observe(sum(len(doc.page_content) for doc in documents))
+
+def record_context_packing(tokens_before: int, tokens_after: int):
+    if not METRICS_ENABLED:
+        return
+    CONTEXT_TOKENS.observe(tokens_after)
+    CONTEXT_TOKENS_SAVED.inc(max(0, tokens_before - tokens_after))
+
+
+# ====================================================================
+# Thống kê sẵn có của các thành phần (hàng đợi, cache, batcher...) -> gauge
+# ====================================================================
+
+class _StatsCollector:
+    def __init__(self):
+        self.sources = {}
+
+    def collect(self):
+        family = GaugeMetricFamily("app_component_stat", "Thống kê của các thành phần", labels=["component", "key"])
+        for component, stats_fn in self.sources.items():
+            try:
+                stats = stats_fn()
+            except Exception as e:
+                logger.error(f"❌ Không đọc được thống kê {component}: {e}")
+                continue
+            for key, value in stats.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    family.add_metric([component, key], value)
+        yield family
+
+_STATS_COLLECTOR = _StatsCollector()
+REGISTRY.register(_STATS_COLLECTOR)
+
+def register_stats(component: str, stats_fn):
+    """Xuất dict thống kê (giá trị số) của một thành phần ra /metrics."""
+    _STATS_COLLECTOR.sources[component] = stats_fn
+
+def render_metrics() -> tuple:
+    """Trả về (body, content_type) theo định dạng Prometheus."""
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,274 @@
+# ====================================================================
+# FILE: php_batcher.py - Gom nhiều bình luận thành một lần ghi tới connect.php
+# ====================================================================
+import os
+import glob
+import json
+import time
+import fcntl
+import asyncio
+import logging
+import threading
+import uuid
+from contextlib import contextmanager
+
+import httpx
+
+from facebook_tools import PHP_HTTP, build_db_payload
+from metrics import stage
+
+logger = logging.getLogger(__name__)
+
+# ==== Cấu hình ====
+# Endpoint nhận nhiều bản ghi một lúc: POST {"records": [...]} -> {"status": "success"}.
+# Không đặt -> gửi từng bản ghi tới PHP_CONNECT_URL như trước (vẫn gom theo cửa sổ).
+PHP_BULK_URL = os.getenv("PHP_BULK_URL")
+PHP_BATCH_MAX_RECORDS = int(os.getenv("PHP_BATCH_MAX_RECORDS", "50"))
+PHP_BATCH_WINDOW_MS = int(os.getenv("PHP_BATCH_WINDOW_MS", "200"))
+# Bản ghi không gửi được (PHP không truy cập được) được ghi tạm vào đây để gửi lại
+PHP_SPOOL_PATH = os.getenv("PHP_SPOOL_PATH", "/tmp/php_spool.jsonl")
+# Chu kỳ thử gửi lại spool kể cả khi không có bình luận mới (và ngay khi khởi động)
+PHP_SPOOL_REPLAY_SECONDS = float(os.getenv("PHP_SPOOL_REPLAY_SECONDS", "30"))
+
+
+def _pid_alive(pid: str) -> bool:
+    try:
+        os.kill(int(pid), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class PhpUnreachable(Exception):
+    """connect.php không phản hồi (lỗi mạng/5xx) -> bản ghi cần được spool."""
+
+
+class PhpWriteBatcher:
+    """
+    Write-behind batcher: gom bản ghi trong PHP_BATCH_WINDOW_MS hoặc đủ
+    PHP_BATCH_MAX_RECORDS rồi gửi một lần. Nếu PHP không hỗ trợ bulk thì
+    gửi từng bản ghi; nếu PHP không truy cập được thì ghi vào spool file.
+    """
+
+    def __init__(self, url: str, bulk_url: str = PHP_BULK_URL, spool_path: str = PHP_SPOOL_PATH):
+        self.url = url
+        self.bulk_url = bulk_url
+        self.spool_path = spool_path
+        self.bulk_supported = bool(bulk_url)
+        self._queue = asyncio.Queue()
+        self._task = None
+        self._replay_task = None
+        # PID lặp lại giữa các lần khởi động container -> tên file .replay kèm id riêng mỗi lần chạy
+        self._boot_id = uuid.uuid4().hex[:8]
+        # Spool dùng chung giữa các worker uvicorn: threading.Lock trong tiến trình + fcntl giữa tiến trình
+        self._spool_lock = threading.Lock()
+        self._stats = {"batches": 0, "records": 0, "max_batch_size": 0, "bulk_requests": 0,
+                       "single_requests": 0, "spooled": 0, "replayed": 0,
+                       "flush_seconds_total": 0.0, "flush_seconds_max": 0.0, "last_flush_seconds": 0.0}
+
+    # ---------- Vòng đời ----------
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        self._replay_task = asyncio.create_task(self._replay_loop())
+
+    async def stop(self):
+        """Dừng vòng lặp và gửi nốt bản ghi còn trong bộ nhớ."""
+        for task in (self._task, self._replay_task):
+            if task:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._task = self._replay_task = None
+        remaining = []
+        while not self._queue.empty():
+            remaining.append(self._queue.get_nowait())
+        if remaining:
+            await self.flush(remaining)
+
+    def submit(self, comment: dict):
+        """Đưa một bình luận (đã parse) vào lô kế tiếp; không chờ mạng."""
+        self._queue.put_nowait(build_db_payload(comment))
+
+    # ---------- Gom lô ----------
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            deadline = time.monotonic() + PHP_BATCH_WINDOW_MS / 1000
+            while len(batch) < PHP_BATCH_MAX_RECORDS:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self.flush(batch)
+            except Exception as e:
+                logger.error(f"❌ Lỗi không mong đợi khi gửi lô PHP, ghi vào spool: {e}")
+                self._spool(batch)
+
+    async def flush(self, batch: list):
+        started = time.perf_counter()
+        try:
+            with stage("php_write"):
+                await self._send(batch)
+        except PhpUnreachable as e:
+            logger.error(f"❌ connect.php không truy cập được ({e}); ghi {len(batch)} bản ghi vào spool.")
+            self._spool(batch)
+        else:
+            # PHP đã hoạt động lại -> gửi lại những gì còn trong spool
+            await self._replay_spool()
+        elapsed = time.perf_counter() - started
+
+        stats = self._stats
+        stats["batches"] += 1
+        stats["records"] += len(batch)
+        stats["max_batch_size"] = max(stats["max_batch_size"], len(batch))
+        stats["flush_seconds_total"] += elapsed
+        stats["flush_seconds_max"] = max(stats["flush_seconds_max"], elapsed)
+        stats["last_flush_seconds"] = elapsed
+
+    async def _send(self, batch: list):
+        if self.bulk_supported and len(batch) > 1:
+            if await self._send_bulk(batch):
+                return
+        failed = []
+        results = await asyncio.gather(*(self._send_one(r) for r in batch), return_exceptions=True)
+        for record, result in zip(batch, results):
+            if isinstance(result, PhpUnreachable):
+                failed.append(record)
+        if failed:
+            # Chỉ spool phần không gửi được; phần đã ghi thành công không lặp lại
+            if len(failed) < len(batch):
+                self._spool(failed)
+                return
+            raise PhpUnreachable(f"{len(failed)} bản ghi thất bại")
+
+    async def _send_bulk(self, batch: list) -> bool:
+        """Trả về True nếu gửi bulk thành công; False nếu PHP không hỗ trợ (chuyển sang gửi lẻ)."""
+        self._stats["bulk_requests"] += 1
+        try:
+            response = await PHP_HTTP.request("POST", self.bulk_url, json={"records": batch})
+        except httpx.HTTPError as e:
+            raise PhpUnreachable(str(e))
+        if response.status_code >= 500:
+            raise PhpUnreachable(f"HTTP {response.status_code}")
+        try:
+            ok = response.status_code == 200 and response.json().get("status") == "success"
+        except ValueError:
+            ok = False
+        if ok:
+            logger.info(f"✅ Đã ghi {len(batch)} bình luận qua PHP (bulk).")
+            return True
+        if response.status_code in (400, 404, 405, 501):
+            logger.warning(f"⚠️ PHP không hỗ trợ ghi bulk (HTTP {response.status_code}), chuyển sang gửi từng bản ghi.")
+            self.bulk_supported = False
+        else:
+            logger.error(f"❌ Lỗi ghi bulk qua PHP. Code: {response.status_code}, Res: {response.text}")
+        return False
+
+    async def _send_one(self, record: dict):
+        self._stats["single_requests"] += 1
+        idcomment = record.get("idcomment")
+        try:
+            response = await PHP_HTTP.request("POST", self.url, json=record)
+        except httpx.HTTPError as e:
+            raise PhpUnreachable(str(e))
+        if response.status_code >= 500:
+            raise PhpUnreachable(f"HTTP {response.status_code}")
+        try:
+            ok = response.status_code == 200 and response.json().get('status') == 'success'
+        except ValueError:
+            ok = False
+        if ok:
+            logger.info(f"✅ Bình luận ID {idcomment} đã được ghi thành công qua PHP.")
+        else:
+            logger.error(f"❌ Lỗi ghi DB qua PHP. Code: {response.status_code}, Res: {response.text}")
+
+    # ---------- Spool file ----------
+    # Ghi thêm và "lấy" spool đều giữ khoá fcntl trên <spool>.lock. Khi lấy, file được đổi
+    # tên thành <spool>.<pid>-<boot id>.replay rồi mới đọc: bản ghi worker khác ghi sau đó vào file
+    # spool mới, không bị xoá nhầm. File .replay chỉ bị xoá khi đã gửi xong hoặc trả về spool.
+    @contextmanager
+    def _locked_spool(self):
+        os.makedirs(os.path.dirname(self.spool_path) or ".", exist_ok=True)
+        with self._spool_lock, open(self.spool_path + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _append_spool(self, records: list):
+        with open(self.spool_path, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def _spool(self, records: list):
+        with self._locked_spool():
+            self._append_spool(records)
+        self._stats["spooled"] += len(records)
+
+    def _take_spool(self):
+        """Trả về (records, đường dẫn file .replay) hoặc ([], None) nếu spool rỗng."""
+        pid = str(os.getpid())
+        taken_path = f"{self.spool_path}.{pid}-{self._boot_id}.replay"
+        with self._locked_spool():
+            # File .replay của tiến trình đã chết (crash khi đang gửi lại) -> gộp lại vào spool.
+            # Cùng PID nhưng khác boot id = tiến trình trước đó tình cờ có cùng PID với mình.
+            for orphan in glob.glob(f"{glob.escape(self.spool_path)}.*.replay"):
+                owner_pid = orphan[len(self.spool_path) + 1:-len(".replay")].split("-")[0]
+                if orphan != taken_path and (owner_pid == pid or not _pid_alive(owner_pid)):
+                    with open(orphan, "r", encoding="utf-8") as f:
+                        self._append_spool([json.loads(line) for line in f if line.strip()])
+                    os.remove(orphan)
+            if os.path.exists(taken_path) or not os.path.exists(self.spool_path):
+                return [], None
+            if os.path.getsize(self.spool_path) == 0:
+                return [], None
+            os.replace(self.spool_path, taken_path)
+        with open(taken_path, "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()], taken_path
+
+    async def _replay_spool(self):
+        records, taken_path = self._take_spool()
+        if not records:
+            if taken_path:
+                os.remove(taken_path)
+            return
+        logger.info(f"▶️ Gửi lại {len(records)} bản ghi từ spool tới connect.php.")
+        self._stats["replayed"] += len(records)
+        sent = 0
+        try:
+            for sent in range(0, len(records), PHP_BATCH_MAX_RECORDS):
+                await self._send(records[sent:sent + PHP_BATCH_MAX_RECORDS])
+            sent = len(records)
+        except PhpUnreachable:
+            # Lại mất kết nối: trả toàn bộ phần chưa gửi về spool
+            pass
+        finally:
+            # Cả khi bị huỷ (stop) hay lỗi bất ngờ: phần chưa gửi quay về spool rồi mới xoá .replay
+            if sent < len(records):
+                self._spool(records[sent:])
+            os.remove(taken_path)
+
+    async def _replay_loop(self):
+        """Gửi lại spool khi khởi động và định kỳ, không phụ thuộc vào bình luận mới."""
+        while True:
+            try:
+                await self._replay_spool()
+            except Exception as e:
+                logger.error(f"❌ Lỗi gửi lại spool PHP: {e}")
+            await asyncio.sleep(PHP_SPOOL_REPLAY_SECONDS)
+
+    def stats(self) -> dict:
+        stats = dict(self._stats)
+        stats["avg_batch_size"] = round(stats["records"] / stats["batches"], 2) if stats["batches"] else 0
+        stats["avg_flush_seconds"] = (
+            round(stats["flush_seconds_total"] / stats["batches"], 4) if stats["batches"] else 0
+        )
+        stats["bulk_supported"] = self.bulk_supported
+        stats["pending"] = self._queue.qsize()
+        return stats
@@ -0,0 +1,267 @@
+# ====================================================================
+# FILE: reply_dispatcher.py - Gửi phản hồi bình luận theo Graph API batch
+# có điều tiết tốc độ theo header X-App-Usage / X-Page-Usage
+# ====================================================================
+import os
+import json
+import time
+import asyncio
+import logging
+from urllib.parse import urlencode
+
+import httpx
+
+from facebook_tools import GRAPH_HTTP, GRAPH_API_BASE
+from metrics import stage
+
+logger = logging.getLogger(__name__)
+
+# ==== Cấu hình ====
+REPLY_BATCH_MAX = min(int(os.getenv("REPLY_BATCH_MAX", "50")), 50)  # Graph API cho tối đa 50/batch
+REPLY_BATCH_WINDOW_MS = int(os.getenv("REPLY_BATCH_WINDOW_MS", "300"))
+REPLY_RATE_PER_SECOND = float(os.getenv("REPLY_RATE_PER_SECOND", "5"))
+REPLY_BURST = float(os.getenv("REPLY_BURST", "50"))
+REPLY_MAX_ATTEMPTS = int(os.getenv("REPLY_MAX_ATTEMPTS", "4"))
+REPLY_RETRY_BASE_SECONDS = float(os.getenv("REPLY_RETRY_BASE_SECONDS", "2"))
+# Bắt đầu giảm tốc khi mức sử dụng (%) vượt ngưỡng này
+REPLY_USAGE_SLOWDOWN_PCT = float(os.getenv("REPLY_USAGE_SLOWDOWN_PCT", "50"))
+# Thời gian tối đa một lời gọi reply() chờ kết quả (gồm cả các lần thử lại); phải nhỏ hơn
+# JOB_HANDLER_TIMEOUT_SECONDS để job nhận lỗi và được hàng đợi retry thay vì bị huỷ
+REPLY_TIMEOUT_SECONDS = float(os.getenv("REPLY_TIMEOUT_SECONDS", "90"))
+
+# Mã lỗi Graph API do bị giới hạn tốc độ / lỗi tạm thời -> đáng để thử lại
+RETRYABLE_ERROR_CODES = {1, 2, 4, 17, 32, 341, 613, 80001}
+
+
+class TokenBucket:
+    """Token bucket bất đồng bộ; `rate` có thể chỉnh lúc chạy."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def set_rate(self, rate: float):
+        self._refill()
+        self.rate = max(rate, 0.01)
+
+    async def acquire(self, amount: float):
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+def usage_percent(headers):
+    """Lấy mức sử dụng cao nhất (%) từ X-App-Usage / X-Page-Usage (JSON); None nếu không có header."""
+    highest = None
+    for name in ("x-app-usage", "x-page-usage"):
+        raw = headers.get(name)
+        if not raw:
+            continue
+        try:
+            usage = json.loads(raw)
+        except ValueError:
+            continue
+        for key in ("call_count", "total_cputime", "total_time"):
+            value = usage.get(key)
+            if isinstance(value, (int, float)):
+                highest = max(highest or 0.0, float(value))
+    return highest
+
+
+class ReplyDispatcher:
+    """
+    Gom phản hồi đang chờ thành Graph API batch (tối đa 50 mục/lần), điều tiết
+    bằng token bucket theo header usage, chỉ thử lại những mục thất bại.
+    Mỗi lời gọi `reply()` nhận về kết quả riêng của bình luận đó.
+    """
+
+    def __init__(self):
+        self.bucket = TokenBucket(REPLY_RATE_PER_SECOND, REPLY_BURST)
+        self._queue = asyncio.Queue()
+        self._task = None
+        self._retries = {}  # id(item) -> (handle, item): thử lại đã hẹn giờ nhưng chưa vào hàng đợi
+        self._stats = {"batches": 0, "items": 0, "succeeded": 0, "failed": 0,
+                       "retried": 0, "last_usage_pct": 0.0}
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # Trả lỗi cho các lời gọi còn đang chờ (trong hàng đợi hoặc đã hẹn thử lại)
+        # để job được hàng đợi retry sau
+        pending = [self._queue.get_nowait() for _ in range(self._queue.qsize())]
+        for handle, item in self._retries.values():
+            handle.cancel()
+            pending.append(item)
+        self._retries.clear()
+        for item in pending:
+            if not item["future"].done():
+                item["future"].set_result({"error": "Reply dispatcher đã dừng"})
+
+    async def reply(self, comment_id: str, message: str, access_token: str) -> dict:
+        """Xếp phản hồi vào batch kế tiếp; trả về body Graph API ({'id': ...}) hoặc {'error': ...}."""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait({
+            "comment_id": comment_id, "message": message, "access_token": access_token,
+            "attempts": 0, "future": future,
+        })
+        try:
+            return await asyncio.wait_for(future, REPLY_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            # future đã bị huỷ -> mục này bị bỏ qua nếu chưa được gửi
+            logger.error(f"❌ Quá {REPLY_TIMEOUT_SECONDS:.0f}s chờ phản hồi bình luận {comment_id}.")
+            return {"error": "Reply timeout"}
+
+    # ---------- Vòng lặp gom batch ----------
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            deadline = time.monotonic() + REPLY_BATCH_WINDOW_MS / 1000
+            while len(batch) < REPLY_BATCH_MAX:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Mỗi batch chỉ dùng một access token; bỏ mục mà người gọi đã hết hạn chờ
+            by_token = {}
+            for item in batch:
+                if item["future"].done():
+                    continue
+                by_token.setdefault(item["access_token"], []).append(item)
+            for token, items in by_token.items():
+                await self.bucket.acquire(len(items))
+                try:
+                    with stage("facebook_reply_batch"):
+                        await self._send_batch(token, items)
+                except Exception as e:
+                    logger.error(f"❌ Lỗi gửi batch phản hồi Facebook: {e}")
+                    for item in items:
+                        self._retry_or_fail(item, {"error": str(e)})
+
+    async def _send_batch(self, access_token: str, items: list):
+        requests_payload = [
+            {
+                "method": "POST",
+                "relative_url": f"{item['comment_id']}/comments",
+                "body": urlencode({"message": item["message"]}),
+            }
+            for item in items
+        ]
+        self._stats["batches"] += 1
+        self._stats["items"] += len(items)
+        try:
+            response = await GRAPH_HTTP.request(
+                "POST", f"{GRAPH_API_BASE}/",
+                data={"access_token": access_token, "batch": json.dumps(requests_payload),
+                      "include_headers": "true"},
+            )
+        except httpx.HTTPError as e:
+            for item in items:
+                self._retry_or_fail(item, {"error": str(e)})
+            return
+
+        self._adjust_rate(usage_percent(response.headers))
+        if response.status_code != 200:
+            logger.error(f"❌ Graph batch lỗi HTTP {response.status_code}: {response.text}")
+            for item in items:
+                self._retry_or_fail(item, {"error": response.text})
+            return
+
+        try:
+            results = response.json()
+        except ValueError:
+            results = None
+        if not isinstance(results, list):
+            logger.error(f"❌ Graph batch trả về không phải danh sách: {response.text[:200]}")
+            results = []
+        for item, result in zip(items, results):
+            self._handle_item_result(item, result)
+        # Mục không có kết quả tương ứng (phản hồi ngắn hơn yêu cầu) vẫn phải được giải quyết
+        for item in items[len(results):]:
+            self._retry_or_fail(item, {"error": "Graph batch thiếu kết quả"})
+
+    def _handle_item_result(self, item: dict, result):
+        if result is None:
+            # Graph trả null khi mục đó bị timeout phía Facebook
+            self._retry_or_fail(item, {"error": "Graph batch timeout"})
+            return
+        headers = {h.get("name", "").lower(): h.get("value") for h in result.get("headers") or []}
+        self._adjust_rate(usage_percent(headers))
+        try:
+            body = json.loads(result.get("body") or "{}")
+        except ValueError:
+            body = {"error": result.get("body")}
+
+        if result.get("code") == 200 and "id" in body:
+            self._stats["succeeded"] += 1
+            if not item["future"].done():
+                item["future"].set_result(body)
+            return
+
+        error = body.get("error") if isinstance(body.get("error"), dict) else {}
+        if result.get("code", 500) >= 500 or error.get("code") in RETRYABLE_ERROR_CODES:
+            self._retry_or_fail(item, body)
+        else:
+            self._fail(item, body)
+
+    def _retry_or_fail(self, item: dict, error: dict):
+        item["attempts"] += 1
+        if item["attempts"] >= REPLY_MAX_ATTEMPTS:
+            self._fail(item, error)
+            return
+        if item["future"].done():
+            return
+        self._stats["retried"] += 1
+        delay = REPLY_RETRY_BASE_SECONDS * (2 ** (item["attempts"] - 1))
+        handle = asyncio.get_running_loop().call_later(delay, self._requeue, item)
+        self._retries[id(item)] = (handle, item)
+
+    def _requeue(self, item: dict):
+        self._retries.pop(id(item), None)
+        if not item["future"].done():
+            self._queue.put_nowait(item)
+
+    def _fail(self, item: dict, error: dict):
+        self._stats["failed"] += 1
+        logger.error(f"❌ Lỗi phản hồi bình luận {item['comment_id']}: {error}")
+        if not item["future"].done():
+            item["future"].set_result(error if "error" in error else {"error": error})
+
+    def _adjust_rate(self, pct: float):
+        """Giảm tốc tuyến tính khi usage vượt ngưỡng; gần 100% thì gần như dừng hẳn."""
+        if pct is None:
+            # Không có header usage -> giữ nguyên tốc độ hiện tại
+            return
+        self._stats["last_usage_pct"] = pct
+        if pct < REPLY_USAGE_SLOWDOWN_PCT:
+            self.bucket.set_rate(REPLY_RATE_PER_SECOND)
+            return
+        headroom = max(0.0, (100 - pct) / (100 - REPLY_USAGE_SLOWDOWN_PCT))
+        self.bucket.set_rate(REPLY_RATE_PER_SECOND * max(headroom, 0.01))
+        if pct >= 90:
+            logger.warning(f"⚠️ Mức sử dụng Graph API {pct:.0f}%, giảm tốc gửi phản hồi.")
+
+    def stats(self) -> dict:
+        return {**self._stats, "rate_per_second": round(self.bucket.rate, 3), "pending": self._queue.qsize(),
+                "retry_scheduled": len(self._retries)}
@@ -0,0 +1,103 @@
+# ====================================================================
+# FILE: retrieval.py - Truy xuất lai BM25 + vector, lọc theo metadata tin đăng
+# ====================================================================
+import os
+from typing import Any, List
+
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun, AsyncCallbackManagerForRetrieverRun
+
+from lexical_index import is_confident
+from listing_metadata import to_chroma_where, matches
+
+# ==== Cấu hình ====
+# Số ứng viên lấy từ mỗi nguồn trước khi trộn bằng Reciprocal Rank Fusion
+HYBRID_FETCH_K = int(os.getenv("HYBRID_FETCH_K", "20"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+RETRIEVAL_STATS = {"fast_path": 0, "hybrid": 0, "vector_only": 0, "filtered": 0, "filter_fallback": 0}
+
+
+def reciprocal_rank_fusion(rankings: list, k: int = RRF_K) -> list:
+    """Trộn nhiều danh sách Document đã xếp hạng; khoá là nội dung đoạn văn."""
+    scores, docs = {}, {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            key = doc.page_content
+            docs.setdefault(key, doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+    return [docs[key] for key in sorted(scores, key=scores.get, reverse=True)]
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    BM25 + vector (Chroma) trộn bằng RRF; BM25 chắc chắn -> chỉ dùng BM25.
+    Nếu câu hỏi nêu phường/huyện, loại nhà, giá, diện tích thì cả hai nguồn chỉ
+    tìm trong các đoạn khớp điều kiện; không còn đoạn nào thì tìm lại không lọc.
+    """
+
+    vectorstore: Any
+    lexical: Any = None
+    filter_parser: Any = None
+    k: int = 5
+    fetch_k: int = HYBRID_FETCH_K
+
+    def _conditions(self, query: str) -> dict:
+        return self.filter_parser.parse(query) if self.filter_parser is not None else {}
+
+    def _lexical_search(self, query: str, conditions: dict) -> list:
+        if self.lexical is None:
+            return []
+        predicate = (lambda metadata: matches(metadata, conditions)) if conditions else None
+        return self.lexical.search(query, self.fetch_k, predicate)
+
+    def _pick_fast_path(self, query: str, results: list):
+        if is_confident(results, query):
+            RETRIEVAL_STATS["fast_path"] += 1
+            return [doc for _, doc, _, _ in results[:self.k]]
+        return None
+
+    def fast_path(self, query: str):
+        """Trả về top-k của BM25 nếu đủ chắc chắn, ngược lại None (không gọi mạng)."""
+        return self._pick_fast_path(query, self._lexical_search(query, self._conditions(query)))
+
+    def _fuse(self, lexical_results: list, vector_docs: list, conditions: dict) -> list:
+        if conditions:
+            RETRIEVAL_STATS["filtered"] += 1
+        if not lexical_results:
+            RETRIEVAL_STATS["vector_only"] += 1
+            return vector_docs[:self.k]
+        RETRIEVAL_STATS["hybrid"] += 1
+        lexical_docs = [doc for _, doc, _, _ in lexical_results]
+        return reciprocal_rank_fusion([lexical_docs, vector_docs])[:self.k]
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun, conditions: dict = None
+    ) -> List[Document]:
+        conditions = self._conditions(query) if conditions is None else conditions
+        results = self._lexical_search(query, conditions)
+        docs = self._pick_fast_path(query, results)
+        if docs is not None:
+            return docs
+        vector_docs = self.vectorstore.similarity_search(query, k=self.fetch_k, filter=to_chroma_where(conditions))
+        if conditions and not results and not vector_docs:
+            RETRIEVAL_STATS["filter_fallback"] += 1
+            return self._get_relevant_documents(query, run_manager=run_manager, conditions={})
+        return self._fuse(results, vector_docs, conditions)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun, conditions: dict = None
+    ) -> List[Document]:
+        conditions = self._conditions(query) if conditions is None else conditions
+        results = self._lexical_search(query, conditions)
+        docs = self._pick_fast_path(query, results)
+        if docs is not None:
+            return docs
+        vector_docs = await self.vectorstore.asimilarity_search(
+            query, k=self.fetch_k, filter=to_chroma_where(conditions)
+        )
+        if conditions and not results and not vector_docs:
+            RETRIEVAL_STATS["filter_fallback"] += 1
+            return await self._aget_relevant_documents(query, run_manager=run_manager, conditions={})
+        return self._fuse(results, vector_docs, conditions)
@@ -0,0 +1,23 @@
+from answer_cache import AnswerCache, filter_scope
+
+
+def test_similar_hit_requires_same_listing_filters():
+    cache = AnswerCache(enabled=True)
+    ward_a = filter_scope({"ward": {"$eq": "dinh bang"}})
+    ward_b = filter_scope({"ward": {"$eq": "dong nguyen"}})
+    cache.store("nhà phường Đình Bảng còn không", "A", 1.0, [1.0, 0.0], ward_a)
+
+    assert cache.lookup_similar([1.0, 0.01], ward_b) is None
+    assert cache.lookup_exact("nhà phường Đình Bảng còn không", ward_b) is None
+    assert cache.lookup_similar([1.0, 0.01], ward_a) == "A"
+    assert cache.lookup_exact("Nhà phường Đình Bảng còn không?", ward_a) == "A"
+
+
+def test_hit_rate_counts_every_miss():
+    cache = AnswerCache(enabled=True)
+    cache.store("giá bao nhiêu", "2 tỷ", 1.0)
+    cache.record_miss()  # ví dụ: fast path BM25, không tra gần trùng
+    assert cache.lookup_exact("giá bao nhiêu") == "2 tỷ"
+
+    stats = cache.stats()
+    assert (stats["misses"], stats["hits_exact"], stats["hit_rate"]) == (1, 1, 0.5)
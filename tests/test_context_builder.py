@@ -0,0 +1,33 @@
+from langchain_core.documents import Document
+
+import context_builder
+
+
+def _splits(source: str, n: int, size: int = 100) -> list:
+    text = "".join(f"[{source}-{i:02d}]".ljust(size - 1, "x") + "\n" for i in range(n))
+    return [Document(page_content=text[i * size:(i + 1) * size], metadata={"source": source, "start_index": i * size})
+            for i in range(n)]
+
+
+def test_best_ranked_chunk_at_end_of_adjacent_run_is_packed(monkeypatch):
+    # Ước lượng token theo ký tự để kết quả không phụ thuộc tiktoken
+    monkeypatch.setattr(context_builder, "_encoding", False)
+    splits = _splits("a.txt", 9)
+    other = Document(page_content="Tin BN2: nhà phố, giá 3 tỷ", metadata={"source": "b.txt", "start_index": 0})
+
+    packed = context_builder.build_context([splits[8]] + splits[:8] + [other], budget=200)
+
+    text = "\n".join(doc.page_content for doc in packed)
+    assert splits[8].page_content in text
+    assert other.page_content in text
+    assert sum(context_builder.count_tokens(doc.page_content) for doc in packed) <= 200
+
+
+def test_adjacent_chunks_still_merge_within_budget(monkeypatch):
+    monkeypatch.setattr(context_builder, "_encoding", False)
+    splits = _splits("a.txt", 3)
+
+    packed = context_builder.build_context([splits[1], splits[0], splits[2]], budget=600)
+
+    assert len(packed) == 1
+    assert packed[0].page_content == "".join(doc.page_content for doc in splits)
@@ -0,0 +1,6 @@
+from lexical_index import tokenize
+
+
+def test_ban_sell_is_not_a_stopword():
+    assert "ban" in tokenize("Bán nhà phố Đình Bảng")
+    assert "ban_nha" in tokenize("cần bán nhà gấp")
@@ -0,0 +1,33 @@
+import pytest
+
+from lexical_index import fold_vietnamese
+from listing_metadata import ListingFilterParser, _prices, extract_listing_metadata, matches
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("2 tỷ 50 triệu", 2.05e9),
+    ("2 tỷ 50 tr", 2.05e9),
+    ("1.250 triệu", 1.25e9),
+    ("2,5 tỷ", 2.5e9),
+    ("2.5 tỷ", 2.5e9),
+    ("2 tỷ 5", 2.5e9),
+    ("800 triệu", 8e8),
+])
+def test_price_forms(text, expected):
+    assert [value for value, _ in _prices(fold_vietnamese(text))] == [pytest.approx(expected)]
+
+
+def test_price_followed_by_area_is_not_a_fraction():
+    assert extract_listing_metadata("Giá 3 tỷ 50m2 sổ đỏ") == {
+        "price_vnd": pytest.approx(3e9), "area_m2": 50.0, "legal_status": "so_do",
+    }
+
+
+def test_thousands_separator_in_area():
+    assert extract_listing_metadata("Diện tích 1.200 m2")["area_m2"] == 1200.0
+
+
+def test_query_range_matches_stored_listing():
+    metadata = extract_listing_metadata("Bán nhà phố phường Đình Bảng, giá 2 tỷ 50 triệu")
+    conditions = ListingFilterParser([metadata], fields=["price_vnd"]).parse("nhà tầm 2 tỷ 50 triệu còn không")
+    assert matches(metadata, conditions)
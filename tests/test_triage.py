@@ -0,0 +1,24 @@
+import pytest
+
+from triage import CommentTriage, CANNED, IGNORE, RAG
+
+
+@pytest.fixture
+def triage():
+    return CommentTriage.from_file(enabled=True)
+
+
+@pytest.mark.parametrize("message", ["Gần Trường Học", "Tuyệt Vời", "Chính Chủ Không", "Nguyễn Văn An"])
+def test_title_case_without_tags_goes_to_rag(triage, message):
+    assert triage.classify(message)["action"] == RAG
+
+
+def test_tag_only_needs_message_tags(triage):
+    tags = [{"name": "Nguyễn Văn An"}, {"name": "Trần Bình"}]
+    assert triage.classify("Nguyễn Văn An Trần Bình", tags)["action"] == IGNORE
+    assert triage.classify("Trần Bình xem nhà này", tags[1:])["action"] == RAG
+
+
+def test_inbox_request_gets_canned_reply(triage):
+    decision = triage.classify("ib e nhé")
+    assert decision["action"] == CANNED and decision["reply"]
@@ -0,0 +1,243 @@
+# ====================================================================
+# FILE: triage.py - Phân loại nhanh bình luận trước khi gọi AI:
+# bỏ qua / trả lời mẫu (không retrieval, không LLM) / RAG đầy đủ
+#
+#   python triage.py replay comments.jsonl   # đo lượng lời gọi LLM được bỏ bớt
+# ====================================================================
+import os
+import re
+import csv
+import json
+import math
+import random
+import logging
+import threading
+from collections import Counter
+
+from lexical_index import strip_diacritics, tokenize
+
+logger = logging.getLogger(__name__)
+
+# ==== Cấu hình ====
+TRIAGE_ENABLED = os.getenv("TRIAGE_ENABLED", "true").lower() == "true"
+# Luật + bộ phân loại được đọc từ file JSON (sửa luật không cần sửa code)
+TRIAGE_CONFIG_PATH = os.getenv(
+    "TRIAGE_CONFIG_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "triage_config.json")
+)
+
+IGNORE, CANNED, RAG = "ignore", "canned", "rag"
+ACTIONS = (IGNORE, CANNED, RAG)
+
+
+def _text_views(message: str, tags: list = None) -> dict:
+    """
+    Các dạng văn bản mà luật có thể khớp: nguyên gốc, bỏ dấu giữ hoa/thường, bỏ dấu chữ thường.
+    Khi webhook có message_tags: thêm "untagged" = nội dung sau khi bỏ tên những người được tag.
+    """
+    raw = " ".join(message.split())
+    stripped = strip_diacritics(raw)
+    views = {"raw": raw, "stripped": stripped, "folded": stripped.lower()}
+    if tags is not None:
+        untagged = raw
+        for tag in tags:
+            if tag.get("name"):
+                untagged = untagged.replace(" ".join(tag["name"].split()), " ")
+        views["untagged"] = " ".join(untagged.split())
+    return views
+
+
+class CommentTriage:
+    """
+    Quyết định cho mỗi bình luận, theo thứ tự:
+    1. Luật regex trong config (luật đầu tiên khớp thắng). Luật "on": "untagged" chỉ chạy
+       khi webhook có message_tags (không đoán tag theo tên viết hoa: bỏ qua là quyết định cuối).
+    2. Bộ phân loại tuyến tính theo từ khoá (điểm = bias + tổng trọng số token, softmax)
+       cho bình luận ngắn; chỉ nhận khi đủ chắc chắn.
+    3. Mặc định: RAG đầy đủ (không chắc thì để AI trả lời).
+    Trả về dict: action, reason, reply (chỉ với canned).
+    """
+
+    def __init__(self, config: dict = None, enabled: bool = TRIAGE_ENABLED):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._stats = Counter()
+        self._load(config or {})
+
+    @classmethod
+    def from_file(cls, path: str = TRIAGE_CONFIG_PATH, enabled: bool = TRIAGE_ENABLED) -> "CommentTriage":
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                config = json.load(f)
+        except (OSError, ValueError) as e:
+            # Thiếu/hỏng config -> mọi bình luận đi RAG như trước đây
+            logger.warning(f"⚠️ Không đọc được cấu hình phân loại {path} ({e}), mọi bình luận sẽ qua AI.")
+            config = {}
+        return cls(config, enabled)
+
+    def _load(self, config: dict):
+        self.templates = {
+            name: [value] if isinstance(value, str) else list(value)
+            for name, value in config.get("templates", {}).items()
+        }
+        self.rules = []
+        for rule in config.get("rules", []):
+            self._check_action(rule)
+            self.rules.append({**rule, "regex": re.compile(rule["pattern"]), "on": rule.get("on", "folded")})
+        classifier = config.get("classifier", {})
+        self.max_words = classifier.get("max_words", 0)
+        self.min_confidence = classifier.get("min_confidence", 1.0)
+        self.classes = []
+        for cls in classifier.get("classes", []):
+            self._check_action(cls)
+            self.classes.append(cls)
+
+    def _check_action(self, item: dict):
+        if item["action"] not in ACTIONS:
+            raise ValueError(f"Hành động phân loại không hợp lệ: {item['action']}")
+        if item["action"] == CANNED and item.get("template") not in self.templates:
+            raise ValueError(f"Thiếu mẫu trả lời '{item.get('template')}' cho {item.get('reason')}")
+
+    # ---------- Phân loại ----------
+    def _decision(self, item: dict) -> dict:
+        decision = {"action": item["action"], "reason": item["reason"], "reply": None}
+        if item["action"] == CANNED:
+            decision["reply"] = random.choice(self.templates[item["template"]])
+        return decision
+
+    def _match_rules(self, views: dict, n_words: int):
+        for rule in self.rules:
+            if rule.get("max_words") and n_words > rule["max_words"]:
+                continue
+            if rule["on"] not in views:
+                continue
+            if rule["regex"].search(views[rule["on"]]):
+                return rule
+        return None
+
+    def _classify(self, message: str, n_words: int):
+        if not self.classes or n_words > self.max_words:
+            return None
+        terms = set(tokenize(message))
+        scores = [cls.get("bias", 0.0) + sum(cls.get("weights", {}).get(t, 0.0) for t in terms)
+                  for cls in self.classes]
+        top = max(scores)
+        weights = [math.exp(score - top) for score in scores]
+        best = scores.index(top)
+        if weights[best] / sum(weights) >= self.min_confidence:
+            return self.classes[best]
+        return None
+
+    def classify(self, message: str, tags: list = None) -> dict:
+        """Chỉ phân loại (không ghi thống kê); dùng cho replay. `tags`: message_tags của webhook (nếu có)."""
+        if not self.enabled:
+            return {"action": RAG, "reason": "disabled", "reply": None}
+        views = _text_views(message, tags)
+        n_words = len(views["raw"].split())
+        item = self._match_rules(views, n_words) or self._classify(message, n_words)
+        if item is None:
+            return {"action": RAG, "reason": "default", "reply": None}
+        return self._decision(item)
+
+    def triage(self, message: str, comment_id: str = "", tags: list = None) -> dict:
+        """Phân loại bình luận đến từ webhook, ghi log và đếm theo từng lớp."""
+        decision = self.classify(message, tags)
+        with self._lock:
+            self._stats[decision["action"]] += 1
+            self._stats[f"reason:{decision['reason']}"] += 1
+        if decision["action"] != RAG:
+            logger.info(f"🚦 Phân loại {comment_id}: {decision['action']} ({decision['reason']})")
+        return decision
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        total = sum(stats.get(action, 0) for action in ACTIONS)
+        skipped = stats.get(IGNORE, 0) + stats.get(CANNED, 0)
+        return {**{action: stats.get(action, 0) for action in ACTIONS}, **stats,
+                "total": total, "llm_skipped_ratio": round(skipped / total, 4) if total else 0.0}
+
+
+# ====================================================================
+# REPLAY: chạy bình luận cũ qua bộ phân loại để đo lượng lời gọi LLM bỏ được
+# ====================================================================
+
+def iter_messages(path: str):
+    """
+    Đọc bình luận lịch sử thành các cặp (message, message_tags hoặc None) từ:
+    - .jsonl: mỗi dòng {"message": ..., "message_tags": [...]} hoặc payload webhook Facebook nguyên bản
+    - .csv: cột "message" (hoặc cột đầu tiên)
+    - file khác: mỗi dòng một bình luận
+    """
+    if path.endswith(".jsonl"):
+        from facebook_tools import parse_comment_events
+
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                if isinstance(item, str):
+                    yield item, None
+                elif item.get("object") == "page":
+                    yield from ((c["message"], c.get("message_tags")) for c in parse_comment_events(item))
+                elif item.get("message"):
+                    yield item["message"], item.get("message_tags")
+    elif path.endswith(".csv"):
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            reader = csv.reader(f)
+            header = next(reader, [])
+            column = header.index("message") if "message" in header else 0
+            if "message" not in header and header:
+                yield header[0], None
+            for row in reader:
+                if len(row) > column and row[column].strip():
+                    yield row[column], None
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            yield from ((line.strip(), None) for line in f if line.strip())
+
+
+def replay(triage: CommentTriage, messages, samples: int = 3) -> dict:
+    actions, reasons, examples = Counter(), Counter(), {}
+    for message, tags in messages:
+        decision = triage.classify(message, tags)
+        actions[decision["action"]] += 1
+        reasons[(decision["action"], decision["reason"])] += 1
+        bucket = examples.setdefault(decision["reason"], [])
+        if len(bucket) < samples:
+            bucket.append(message)
+    total = sum(actions.values())
+    return {
+        "total": total,
+        "actions": dict(actions),
+        "reasons": {f"{action}/{reason}": count for (action, reason), count in reasons.most_common()},
+        "llm_calls_skipped": actions[IGNORE] + actions[CANNED],
+        "llm_skipped_ratio": round((actions[IGNORE] + actions[CANNED]) / total, 4) if total else 0.0,
+        "examples": examples,
+    }
+
+
+def main(argv=None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Phân loại bình luận trước khi gọi AI.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    replay_parser = sub.add_parser("replay", help="Chạy bình luận lịch sử qua bộ phân loại")
+    replay_parser.add_argument("path", help=".jsonl (message/payload webhook), .csv hoặc file văn bản")
+    replay_parser.add_argument("--config", default=TRIAGE_CONFIG_PATH)
+    replay_parser.add_argument("--samples", type=int, default=3, help="Số ví dụ in ra cho mỗi lý do")
+    args = parser.parse_args(argv)
+
+    report = replay(CommentTriage.from_file(args.config, enabled=True), iter_messages(args.path), args.samples)
+    print(f"Tổng: {report['total']} bình luận, bỏ được {report['llm_calls_skipped']} lời gọi LLM "
+          f"({report['llm_skipped_ratio']:.1%}).")
+    for action in ACTIONS:
+        print(f"  {action:7s}: {report['actions'].get(action, 0)}")
+    for key, count in report["reasons"].items():
+        reason = key.split("/", 1)[1]
+        print(f"  - {key}: {count}  ví dụ: {report['examples'].get(reason, [])}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())